@@ -38,6 +38,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'mailing.middleware.MetricsMiddleware',
 ]
 
 ROOT_URLCONF = 'config.urls'
@@ -129,6 +130,8 @@ EMAIL_HOST_USER = os.getenv('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = os.getenv('EMAIL_HOST_PASSWORD')
 EMAIL_USE_TLS = os.getenv('EMAIL_USE_TLS', False) == 'True'
 EMAIL_USE_SSL = os.getenv('EMAIL_USE_SSL', False) == 'True'
+# Таймаут SMTP-соединения в секундах: без него зависший релей блокирует отправку до таймаута TCP
+EMAIL_TIMEOUT = int(os.getenv('EMAIL_TIMEOUT', 10))
 
 SERVER_EMAIL = EMAIL_HOST_USER
 DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
@@ -136,6 +139,82 @@ EMAIL_ADMIN = EMAIL_HOST_USER
 
 SCHEDULER_AUTOSTART = True
 
+# Пул SMTP-соединений для рассылок
+MAILING_SMTP_POOL_SIZE = int(os.getenv('MAILING_SMTP_POOL_SIZE', 4))
+MAILING_SMTP_POOL_MAX_IDLE = int(os.getenv('MAILING_SMTP_POOL_MAX_IDLE', 300))
+MAILING_SMTP_BATCH_SIZE = int(os.getenv('MAILING_SMTP_BATCH_SIZE', 100))
+
+# Сколько писем отдельным получателям собирается и отправляется за раз
+MAILING_FANOUT_CHUNK_SIZE = int(os.getenv('MAILING_FANOUT_CHUNK_SIZE', 500))
+
+# Движок отправки: 'sync' — последовательно, 'threads' — в пуле потоков, 'async' — в цикле событий
+MAILING_DISPATCH_ENGINE = os.getenv('MAILING_DISPATCH_ENGINE', 'sync')
+MAILING_DISPATCH_WORKERS = int(os.getenv('MAILING_DISPATCH_WORKERS', 8))
+# Сколько порций одновременно отправляется через один SMTP-релей
+MAILING_RELAY_CONCURRENCY = int(os.getenv('MAILING_RELAY_CONCURRENCY', 4))
+# Сколько SMTP-сессий одновременно открывает асинхронный движок
+MAILING_ASYNC_CONCURRENCY = int(os.getenv('MAILING_ASYNC_CONCURRENCY', 50))
+# Сколько строк попыток, доставок и рассылок записывается одним запросом
+MAILING_WRITE_BATCH_SIZE = int(os.getenv('MAILING_WRITE_BATCH_SIZE', 1000))
+# После скольких отправленных писем журнал доставки фиксируется в базе (контрольная точка).
+# Доставка «как минимум один раз»: после сбоя получатели, отправленные после последней контрольной
+# точки, получат письмо повторно (с тем же Message-ID). Меньшее значение сужает это окно ценой
+# более частых записей в базу
+MAILING_CHECKPOINT_SIZE = int(os.getenv('MAILING_CHECKPOINT_SIZE', 500))
+# Сколько рассылок обработчик захватывает за тик и на сколько секунд
+MAILING_CLAIM_LIMIT = int(os.getenv('MAILING_CLAIM_LIMIT', 500))
+MAILING_LEASE_SECONDS = int(os.getenv('MAILING_LEASE_SECONDS', 600))
+# Планировщик спит до ближайшей отправки, но не дольше MAILING_SCHEDULER_MAX_SLEEP секунд,
+# и держит в памяти MAILING_SCHEDULER_HEAP_SIZE ближайших отправок
+MAILING_SCHEDULER_MAX_SLEEP = int(os.getenv('MAILING_SCHEDULER_MAX_SLEEP', 3600))
+MAILING_SCHEDULER_HEAP_SIZE = int(os.getenv('MAILING_SCHEDULER_HEAP_SIZE', 100))
+# Ограничения скорости отправки в письмах в секунду (0 — без ограничения): на SMTP-релей,
+# на домен получателей, на владельца рассылок. MAILING_DOMAIN_RATES задаёт скорость для отдельных
+# доменов в виде "gmail.com=20,mail.ru=10". Ведра жетонов общие для процессов через Redis из CACHES
+MAILING_RELAY_RATE = float(os.getenv('MAILING_RELAY_RATE', 0))
+MAILING_DOMAIN_RATE = float(os.getenv('MAILING_DOMAIN_RATE', 0))
+MAILING_DOMAIN_RATES = {
+    domain.strip().lower(): float(rate)
+    for domain, rate in (item.split('=') for item in os.getenv('MAILING_DOMAIN_RATES', '').split(',') if item)
+}
+MAILING_OWNER_RATE = float(os.getenv('MAILING_OWNER_RATE', 0))
+# Запас жетонов: сколько секунд разрешённой скорости можно отправить разом
+MAILING_RATE_BURST_SECONDS = float(os.getenv('MAILING_RATE_BURST_SECONDS', 1))
+# Повтор рассылки после временных ошибок: задержка удваивается от MAILING_RETRY_BASE_SECONDS
+# до MAILING_RETRY_MAX_SECONDS, после MAILING_RETRY_MAX_ATTEMPTS повторов прогон прекращается
+MAILING_RETRY_BASE_SECONDS = int(os.getenv('MAILING_RETRY_BASE_SECONDS', 60))
+MAILING_RETRY_MAX_SECONDS = int(os.getenv('MAILING_RETRY_MAX_SECONDS', 6 * 60 * 60))
+MAILING_RETRY_MAX_ATTEMPTS = int(os.getenv('MAILING_RETRY_MAX_ATTEMPTS', 8))
+# Автоматический выключатель SMTP-релея: размыкается после MAILING_BREAKER_THRESHOLD ошибок
+# соединения подряд и пропускает пробную отправку через MAILING_BREAKER_RESET_SECONDS секунд
+MAILING_BREAKER_THRESHOLD = int(os.getenv('MAILING_BREAKER_THRESHOLD', 5))
+MAILING_BREAKER_RESET_SECONDS = int(os.getenv('MAILING_BREAKER_RESET_SECONDS', 30))
+# Клиенты рассылки группируются по домену адреса. Письмо без подстановок полей клиента уходит одной SMTP-транзакцией
+# сразу MAILING_RCPT_BATCH_SIZE получателям (1 — отдельное письмо каждому), на один домен одновременно
+# отправляется не больше MAILING_DOMAIN_CONCURRENCY порций. MAILING_DOMAIN_RESOLVER — путь к функции,
+# которая по домену возвращает SMTP-релей "хост:порт" или None для релея из настроек EMAIL_*
+MAILING_RCPT_BATCH_SIZE = int(os.getenv('MAILING_RCPT_BATCH_SIZE', 50))
+MAILING_DOMAIN_CONCURRENCY = int(os.getenv('MAILING_DOMAIN_CONCURRENCY', 2))
+MAILING_DOMAIN_RESOLVER = os.getenv('MAILING_DOMAIN_RESOLVER', 'mailing.domains.default_resolver')
+# Как часто обработчик рассылок (run_dispatcher) обновляет отметку работоспособности, в секундах
+MAILING_HEARTBEAT_SECONDS = int(os.getenv('MAILING_HEARTBEAT_SECONDS', 30))
+# Как часто процесс отправляет накопленные метрики в Redis, в секундах
+MAILING_METRICS_FLUSH_SECONDS = float(os.getenv('MAILING_METRICS_FLUSH_SECONDS', 10))
+# Токен для доступа к /metrics (заголовок Authorization: Bearer <токен>); пустой — метрики видят только сотрудники
+MAILING_METRICS_TOKEN = os.getenv('MAILING_METRICS_TOKEN', '')
+# Сколько строк файла клиентов проверяется и сохраняется за раз при импорте
+MAILING_IMPORT_BATCH_SIZE = int(os.getenv('MAILING_IMPORT_BATCH_SIZE', 5000))
+# Сколько секунд хранится состояние импорта, запущенного из веб-интерфейса
+MAILING_IMPORT_PROGRESS_TTL = int(os.getenv('MAILING_IMPORT_PROGRESS_TTL', 24 * 60 * 60))
+# Через сколько секунд без обновления состояния незавершённый импорт из веб-интерфейса считается прерванным
+MAILING_IMPORT_STALE_SECONDS = int(os.getenv('MAILING_IMPORT_STALE_SECONDS', 10 * 60))
+# Сколько строк читается из базы и отправляется одной частью при выгрузке в CSV
+MAILING_EXPORT_CHUNK_SIZE = int(os.getenv('MAILING_EXPORT_CHUNK_SIZE', 2000))
+# Сколько клиентов сегмента читается из базы за раз при отправке рассылки на сегмент
+MAILING_SEGMENT_FETCH_SIZE = int(os.getenv('MAILING_SEGMENT_FETCH_SIZE', 2000))
+# Сколько клиентов возвращает одна страница поиска при выборе получателей рассылки
+MAILING_CLIENT_SEARCH_PAGE_SIZE = int(os.getenv('MAILING_CLIENT_SEARCH_PAGE_SIZE', 20))
+
 CACHE_ENABLED = True
 if CACHE_ENABLED:
     CACHES = {
@@ -1,11 +1,11 @@
 from django.contrib import admin
-from .models import Client, Message, Mailing, MailingAttempt
+from .models import Client, Message, Mailing, MailingAttempt, MailingDelivery, DispatcherHeartbeat, Segment
 
 
 @admin.register(Client)
 class ClientAdmin(admin.ModelAdmin):
-    list_display = ("id", "email", "full_name", "comment")
-    list_filter = ("email",)
+    list_display = ("id", "email", "full_name", "comment", "tag", "created_at")
+    list_filter = ("email", "tag")
     search_fields = ("email", "full_name")
 
 
@@ -15,9 +15,15 @@ class MessageAdmin(admin.ModelAdmin):
     search_fields = ("subject", "body")
 
 
+@admin.register(Segment)
+class SegmentAdmin(admin.ModelAdmin):
+    list_display = ("id", "name", "owner", "tag", "comment_contains", "created_from", "created_to")
+    search_fields = ("name", "tag")
+
+
 @admin.register(Mailing)
 class MailingAdmin(admin.ModelAdmin):
-    list_display = ("id", "start_datetime", "periodicity", "status", "get_message_subject", "get_clients")
+    list_display = ("id", "start_datetime", "periodicity", "status", "get_message_subject", "segment", "get_clients")
     search_fields = ("status", "periodicity", "message__subject", "clients__email")
 
     def get_message_subject(self, obj):
@@ -33,3 +39,15 @@ class MailingAdmin(admin.ModelAdmin):
 class MailingAttemptAdmin(admin.ModelAdmin):
     list_display = ("id", "mailing", "attempt_datetime", "status")
     search_fields = ("status", "mailing__message__subject", "mailing__clients__email")
+
+
+@admin.register(MailingDelivery)
+class MailingDeliveryAdmin(admin.ModelAdmin):
+    list_display = ("id", "mailing", "client", "run", "status", "reply_code")
+    list_filter = ("status",)
+    search_fields = ("client__email", "mailing__message__subject")
+
+
+@admin.register(DispatcherHeartbeat)
+class DispatcherHeartbeatAdmin(admin.ModelAdmin):
+    list_display = ("worker_id", "started_at", "last_seen", "in_flight")
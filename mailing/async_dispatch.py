@@ -0,0 +1,189 @@
+import asyncio
+from collections import defaultdict
+
+import aiosmtplib
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+
+from .breaker import get_breaker
+from .dispatch import build_batch_message, chunked, draining, pending_clients, rcpt_batch_size
+from .domains import domain_chunks, recipient_domain, resolve_relay
+from .metrics import PHASE_SECONDS
+from .mime import message_bytes
+from .ratelimit import get_rate_limiter
+
+# Ошибки, после которых SMTP-сессия считается потерянной и открывается заново
+RECONNECT_ERRORS = (aiosmtplib.SMTPServerDisconnected, aiosmtplib.SMTPConnectError, OSError)
+
+
+class AsyncEngine:
+    """
+    Асинхронный движок отправки: множество SMTP-сессий работает в одном цикле событий.
+
+    Порции получателей попадают в ограниченную очередь, которую разбирают concurrency
+    сессий, поэтому выборка получателей не убегает вперёд отправки. Загрузка получателей
+    и вызовы writer выполняются через sync_to_async в вызывающем потоке, который остаётся
+    единственным писателем в базу данных.
+
+    Как и синхронные движки, отправляет клиентов одного домена пачками по rcpt_batch_size
+    получателей на письмо через релей, который резолвер вернул для домена.
+
+    Атрибуты:
+    - concurrency (int): Количество одновременных SMTP-сессий.
+    - chunk_size (int): Сколько получателей отправляется одной задачей.
+    """
+
+    def __init__(self, concurrency=None, chunk_size=None):
+        self.concurrency = concurrency or settings.MAILING_ASYNC_CONCURRENCY
+        self.chunk_size = chunk_size or settings.MAILING_FANOUT_CHUNK_SIZE
+
+    def run(self, mailings, pool, writer):
+        """
+        Отправляет рассылки порциями получателей. Результаты каждой порции передаются
+        в writer.checkpoint, итог рассылки — в writer.record.
+
+        Пул синхронных соединений не используется: сессии открываются через aiosmtplib
+        с параметрами EMAIL_* из настроек.
+        """
+        mailings = list(mailings)
+        for mailing in mailings:
+            mailing.message  # загружаем сообщение до входа в цикл событий
+        async_to_sync(self._run)(mailings, writer)
+
+    async def _run(self, mailings, writer):
+        jobs = asyncio.Queue(maxsize=self.concurrency)
+        progress = {}
+        domain_slots = defaultdict(lambda: asyncio.Semaphore(settings.MAILING_DOMAIN_CONCURRENCY))
+        async with asyncio.TaskGroup() as group:
+            workers = [
+                group.create_task(self._worker(jobs, progress, writer, domain_slots))
+                for _ in range(self.concurrency)
+            ]
+            for mailing in mailings:
+                # Порции читаются по одной в вызывающем потоке, где открыт курсор выборки получателей
+                chunks = domain_chunks(await sync_to_async(pending_clients)(mailing), self.chunk_size)
+                entry = progress[mailing.pk] = {
+                    'mailing': mailing, 'results': [], 'left': 0, 'submitted': False, 'lost': False,
+                }
+                while (chunk := await sync_to_async(next)(chunks, None)) is not None:
+                    if draining.is_set() or entry['lost']:
+                        break  # не полностью поставленная в очередь рассылка не записывается в writer.record
+                    entry['left'] += 1
+                    await jobs.put((mailing, chunk))
+                else:
+                    entry['submitted'] = True
+                    await self._finish(mailing.pk, progress, writer)
+            await jobs.join()
+            for worker in workers:
+                worker.cancel()
+
+    async def _worker(self, jobs, progress, writer, domain_slots):
+        sessions = {}  # сессия на каждый релей, с которым работал этот обработчик
+        # Резервирование жетонов — обращение к Redis, поэтому выполняется в пуле потоков, не блокируя цикл событий
+        reserve = sync_to_async(get_rate_limiter().reserve, thread_sensitive=False)
+        try:
+            while True:
+                mailing, chunk = await jobs.get()
+                entry = progress[mailing.pk]
+                try:
+                    if entry['lost']:
+                        continue  # аренду забрал другой обработчик: порция не отправляется
+                    domain = recipient_domain(chunk[0].email)
+                    relay = await sync_to_async(resolve_relay, thread_sensitive=False)(domain)
+                    breaker = get_breaker(relay)
+                    chunk_results = []
+                    async with domain_slots[domain]:
+                        for batch in chunked(chunk, rcpt_batch_size(mailing)):
+                            delay = await reserve(mailing, batch[0].email, relay, count=len(batch))
+                            if delay > 0:
+                                await asyncio.sleep(delay)
+                            with PHASE_SECONDS.time(phase='render'):
+                                message = build_batch_message(mailing, batch)
+                            sessions[relay], errors = await self._send(sessions.get(relay), relay, message, breaker)
+                            chunk_results.extend(zip(batch, errors))
+                    if not await sync_to_async(writer.checkpoint)(mailing, chunk_results):
+                        entry['lost'] = True
+                    entry['results'].extend(chunk_results)
+                    entry['left'] -= 1
+                    await self._finish(mailing.pk, progress, writer)
+                finally:
+                    jobs.task_done()
+        finally:
+            for smtp in sessions.values():
+                if smtp is not None:
+                    await self._close(smtp)
+
+    @staticmethod
+    async def _finish(pk, progress, writer):
+        entry = progress[pk]
+        if entry['submitted'] and entry['left'] == 0:
+            del progress[pk]
+            await sync_to_async(writer.record)(entry['mailing'], entry['results'])
+
+    @staticmethod
+    def _session(relay=None):
+        # Как и SMTP-бэкенд Django, авторизуемся только при заданных логине и пароле
+        credentials = {}
+        if settings.EMAIL_HOST_USER and settings.EMAIL_HOST_PASSWORD:
+            credentials = {'username': settings.EMAIL_HOST_USER, 'password': settings.EMAIL_HOST_PASSWORD}
+        host, port = settings.EMAIL_HOST, settings.EMAIL_PORT
+        if relay is not None:
+            host, _, port = relay.rpartition(':')
+        return aiosmtplib.SMTP(
+            hostname=host,
+            port=int(port) if port else None,
+            **credentials,
+            use_tls=settings.EMAIL_USE_SSL,
+            start_tls=settings.EMAIL_USE_TLS,
+            timeout=settings.EMAIL_TIMEOUT,
+        )
+
+    @staticmethod
+    async def _close(smtp):
+        try:
+            await smtp.quit()
+        except Exception:
+            smtp.close()
+
+    async def _send(self, smtp, relay, message, breaker):
+        """
+        Отправляет одно письмо всем его получателям одной транзакцией, один раз переподключаясь
+        при обрыве сессии. Пока выключатель релея разомкнут, письмо не отправляется.
+        Возвращает пару (сессия, список ошибок или None по получателям письма).
+        """
+        recipients = message.recipients()
+        for can_retry in (True, False):
+            if not breaker.allow():
+                return smtp, [breaker.error()] * len(recipients)
+            try:
+                if smtp is None:
+                    smtp = self._session(relay)
+                    with PHASE_SECONDS.time(phase='connect'):
+                        await smtp.connect()
+                with PHASE_SECONDS.time(phase='send'):
+                    refused, _ = await smtp.sendmail(
+                        message.from_email,
+                        recipients,
+                        message_bytes(message),
+                    )
+                breaker.success()
+                return smtp, [
+                    aiosmtplib.SMTPRecipientRefused(refused[recipient].code, refused[recipient].message, recipient)
+                    if recipient in refused else None
+                    for recipient in recipients
+                ]
+            except RECONNECT_ERRORS as error:
+                breaker.failure()
+                if smtp is not None:
+                    smtp.close()
+                smtp = None
+                if not can_retry:
+                    return smtp, [error] * len(recipients)
+            except aiosmtplib.SMTPRecipientsRefused as error:
+                # Отказано всем получателям письма, у каждого свой ответ сервера
+                breaker.success()
+                refused = {item.recipient: item for item in error.recipients}
+                return smtp, [refused.get(recipient, error) for recipient in recipients]
+            except aiosmtplib.SMTPException as error:
+                breaker.success()  # сервер ответил отказом, значит релей доступен
+                return smtp, [error] * len(recipients)
@@ -0,0 +1,100 @@
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import F
+
+from .models import AudienceCounter, Client, ClientEmail
+
+# Ключ счётчика уникальных адресов среди всех клиентов
+DISTINCT_EMAILS = 'emails'
+
+
+def owner_key(owner_id):
+    """
+    Возвращает ключ счётчика клиентов владельца.
+    """
+    return f'clients:{owner_id}'
+
+
+def change_clients(added=(), removed=()):
+    """
+    Обновляет счётчики аудитории после добавления и удаления клиентов.
+
+    added и removed — пары (owner_id, email). Для каждого адреса в нижнем регистре ведётся число
+    клиентов с ним (ClientEmail); счётчик уникальных адресов меняется, когда адрес появляется
+    впервые или исчезает у последнего клиента. Изменения выполняются в транзакции под блокировкой
+    строки счётчика уникальных адресов, поэтому параллельные изменения не теряются.
+
+    Сигналы вызывают эту функцию при сохранении и удалении отдельного клиента. QuerySet.update(),
+    bulk_create и bulk_update сигналов не отправляют: код, который так добавляет клиентов или меняет
+    их владельца или адрес, должен сам передать сюда изменения (как importer.ClientImporter).
+    """
+    owners, emails = Counter(), Counter()
+    for sign, clients in ((1, added), (-1, removed)):
+        for owner_id, email in clients:
+            owners[owner_id] += sign
+            emails[email.lower()] += sign
+    owners = {owner_id: delta for owner_id, delta in owners.items() if delta}
+    emails = {email: delta for email, delta in emails.items() if delta}
+    if not owners and not emails:
+        return
+
+    with transaction.atomic():
+        distinct, _ = AudienceCounter.objects.select_for_update().get_or_create(key=DISTINCT_EMAILS)
+        references = {reference.email: reference for reference in ClientEmail.objects.filter(email__in=emails)}
+        created, changed, deleted = [], [], []
+        for email, delta in emails.items():
+            reference = references.get(email)
+            if reference is None:
+                if delta > 0:
+                    created.append(ClientEmail(email=email, clients=delta))
+            elif reference.clients + delta > 0:
+                reference.clients += delta
+                changed.append(reference)
+            else:
+                deleted.append(reference.pk)
+        ClientEmail.objects.bulk_create(created)
+        ClientEmail.objects.bulk_update(changed, ['clients'])
+        ClientEmail.objects.filter(pk__in=deleted).delete()
+        distinct.value += len(created) - len(deleted)
+        distinct.save(update_fields=['value'])
+
+        for owner_id, delta in owners.items():
+            add_owner_clients(owner_id, delta)
+
+
+def add_owner_clients(owner_id, delta):
+    key = owner_key(owner_id)
+    if not AudienceCounter.objects.filter(key=key).update(value=F('value') + delta):
+        AudienceCounter.objects.create(key=key, value=delta)
+
+
+def release_owner_clients(owner_id):
+    """
+    Переносит клиентов владельца в счётчик клиентов без владельца перед удалением пользователя:
+    внешний ключ обнуляется запросом UPDATE (on_delete=SET_NULL) без сигналов сохранения клиентов.
+    Количество клиентов пересчитывается по таблице, адреса клиентов не меняются.
+    """
+    with transaction.atomic():
+        count = Client.objects.filter(owner_id=owner_id).count()
+        AudienceCounter.objects.filter(key=owner_key(owner_id)).delete()
+        if count:
+            add_owner_clients(None, count)
+
+
+def counter_value(key):
+    return AudienceCounter.objects.filter(key=key).values_list('value', flat=True).first() or 0
+
+
+def distinct_emails_count():
+    """
+    Возвращает количество уникальных адресов среди всех клиентов одним запросом по ключу.
+    """
+    return counter_value(DISTINCT_EMAILS)
+
+
+def owner_clients_count(owner):
+    """
+    Возвращает количество клиентов владельца одним запросом по ключу.
+    """
+    return counter_value(owner_key(owner.pk))
@@ -0,0 +1,300 @@
+import math
+import re
+import socket
+import sys
+import time
+import uuid
+from contextlib import ExitStack, contextmanager
+from datetime import timedelta
+
+from django.core import mail
+from django.db import connection, transaction
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from users.models import Users
+from .models import Client, Mailing, Message
+from .personalize import compile_message
+from .pool import get_pool
+from .tasks import send_mailing
+
+
+class SinkHandler:
+    """
+    Обработчик aiosmtpd, который принимает и отбрасывает письма, считая получателей и транзакции DATA.
+    """
+
+    def __init__(self):
+        self.received = 0
+        self.messages = 0
+
+    async def handle_DATA(self, server, session, envelope):
+        self.received += len(envelope.rcpt_tos)
+        self.messages += 1
+        return '250 OK'
+
+
+@contextmanager
+def local_smtp_sink(hostname='127.0.0.1', handler=None):
+    """
+    Поднимает локальный SMTP-приёмник aiosmtpd на свободном порту и направляет
+    на него отправку писем через настройки EMAIL_*. handler — обработчик приёмника,
+    по умолчанию SinkHandler.
+
+    Возвращает обработчик приёмника с количеством принятых получателей.
+    """
+    from aiosmtpd.controller import Controller
+
+    with socket.socket() as probe:
+        probe.bind((hostname, 0))
+        port = probe.getsockname()[1]
+    handler = handler or SinkHandler()
+    controller = Controller(handler, hostname=hostname, port=port)
+    controller.start()
+    try:
+        with override_settings(
+            EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+            EMAIL_HOST=hostname,
+            EMAIL_PORT=port,
+            EMAIL_HOST_USER='bench@example.com',
+            EMAIL_HOST_PASSWORD='',
+            EMAIL_USE_TLS=False,
+            EMAIL_USE_SSL=False,
+        ):
+            yield handler
+    finally:
+        controller.stop()
+
+
+def create_mailing(clients_count):
+    """
+    Создаёт сообщение, clients_count клиентов и рассылку на них, сохраняя клиентов пачками.
+    """
+    now = timezone.now()
+    message = Message.objects.create(subject='Бенчмарк', body='Тестовое письмо')
+    clients = Client.objects.bulk_create(
+        Client(email=f'client{number}@example.com', full_name=f'Клиент {number}')
+        for number in range(clients_count)
+    )
+    mailing = Mailing.objects.create(
+        start_datetime=now,
+        end_datetime=now + timedelta(days=1),
+        periodicity=Mailing.DAILY,
+        message=message,
+    )
+    mailing.clients.set(clients)
+    return mailing
+
+
+# Домены адресов клиентов в наборе данных: отправка группируется по доменам получателей
+DATASET_DOMAINS = ('example.com', 'example.org', 'example.net', 'mail.example', 'corp.example')
+
+
+def create_dataset(owners, clients, messages, mailings, personalized=False, batch_size=1000):
+    """
+    Создаёт owners владельцев, у каждого clients клиентов, messages сообщений и mailings рассылок
+    на всех своих клиентов. Все строки, включая связи рассылок с клиентами, вставляются пачками
+    по batch_size через bulk_create. Рассылки сразу подходят к отправке.
+
+    Возвращает количество получателей во всех рассылках.
+    """
+    now = timezone.now()
+    tag = uuid.uuid4().hex[:8]  # адреса владельцев уникальны, даже если в базе остались данные прошлых замеров
+    users = Users.objects.bulk_create(
+        [Users(email=f'bench-{tag}-{number}@example.com', password='!') for number in range(owners)],
+        batch_size=batch_size,
+    )
+    subject, body = 'Бенчмарк', 'Тестовое письмо\n\n' + 'Текст рассылки. ' * 60
+    if personalized:
+        subject, body = '{{ full_name }}, новости недели', 'Здравствуйте, {{ full_name }}!\n\n' + 'Текст рассылки. ' * 60
+    all_clients = Client.objects.bulk_create(
+        [
+            Client(
+                email=f'client{owner.pk}.{number}@{DATASET_DOMAINS[number % len(DATASET_DOMAINS)]}',
+                full_name=f'Клиент {number}',
+                owner=owner,
+            )
+            for owner in users for number in range(clients)
+        ],
+        batch_size=batch_size,
+    )
+    all_messages = Message.objects.bulk_create(
+        [Message(subject=subject, body=body, owner=owner) for owner in users for _ in range(messages)],
+        batch_size=batch_size,
+    )
+    all_mailings = Mailing.objects.bulk_create(
+        [
+            Mailing(
+                start_datetime=now,
+                end_datetime=now + timedelta(days=1),
+                periodicity=Mailing.DAILY,
+                message=all_messages[index * messages + number % messages],
+                owner=owner,
+                next_send_at=now,
+            )
+            for index, owner in enumerate(users) for number in range(mailings)
+        ],
+        batch_size=batch_size,
+    )
+    Mailing.clients.through.objects.bulk_create(
+        (
+            Mailing.clients.through(mailing_id=mailing.pk, client_id=client.pk)
+            for index in range(owners)
+            for mailing in all_mailings[index * mailings:(index + 1) * mailings]
+            for client in all_clients[index * clients:(index + 1) * clients]
+        ),
+        batch_size=batch_size,
+    )
+    return owners * mailings * clients
+
+
+class QueryCounter:
+    """
+    Считает SQL-запросы через execute_wrapper соединения, не сохраняя их текст.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def percentile(values, fraction):
+    """
+    Возвращает перцентиль отсортированного списка методом ближайшего ранга.
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, math.ceil(fraction * len(values)) - 1))]
+
+
+def proc_status_bytes(field):
+    """
+    Возвращает поле VmRSS или VmHWM из /proc/self/status в байтах или None не в Linux.
+    """
+    try:
+        with open('/proc/self/status') as file:
+            match = re.search(rf'^{field}:\s+(\d+) kB', file.read(), re.MULTILINE)
+    except OSError:
+        return None
+    return int(match.group(1)) * 1024 if match else None
+
+
+def peak_rss():
+    """
+    Возвращает пиковый размер резидентной памяти процесса в байтах или None, если он недоступен.
+    """
+    peak = proc_status_bytes('VmHWM')
+    if peak is not None:
+        return peak
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def reset_peak_rss():
+    """
+    Сбрасывает пик памяти процесса до текущего размера и возвращает базовую линию для замера в байтах.
+
+    В Linux пик сбрасывается через /proc/self/clear_refs, и peak_rss после замера показывает пик
+    именно этого замера. Где сброс недоступен, возвращается пик за всё время процесса: тогда
+    прирост над базовой линией показывает только то, насколько замер превысил прежний пик.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+    except OSError:
+        return peak_rss()
+    return proc_status_bytes('VmRSS')
+
+
+def measure_pipeline(engine, backend, owners=1, clients=1000, messages=1, mailings=1, personalized=False,
+                     claim_limit=None):
+    """
+    Создаёт набор данных (см. create_dataset) и отправляет его тиками send_mailing движком engine,
+    пока остаются подошедшие рассылки. backend — 'locmem' или 'smtp' (приёмник local_smtp_sink).
+
+    Данные создаются в транзакции, которая откатывается после замера. send_mailing обрабатывает
+    все подошедшие рассылки базы, поэтому замер нужно запускать на отдельной базе.
+
+    Возвращает словарь с результатами: скорость в письмах в секунду, перцентили длительности тика,
+    количество SQL-запросов тиков, пиковый размер памяти процесса во время замера и его прирост
+    над размером до замера (см. reset_peak_rss).
+    """
+    pool = get_pool()
+    pool.close()  # в пуле не должно остаться соединений с почтовым бэкендом прошлого замера
+    with ExitStack() as stack:
+        stack.callback(pool.close)
+        if backend == 'smtp':
+            sink = stack.enter_context(local_smtp_sink())
+        else:
+            stack.enter_context(override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'))
+            mail.outbox = []
+        if claim_limit:
+            stack.enter_context(override_settings(MAILING_CLAIM_LIMIT=claim_limit))
+        stack.enter_context(transaction.atomic())
+        baseline_rss = reset_peak_rss()
+        recipients = create_dataset(owners, clients, messages, mailings, personalized)
+        counter = QueryCounter()
+        ticks = []
+        with connection.execute_wrapper(counter):
+            while True:
+                started = time.perf_counter()
+                claimed = send_mailing(engine)
+                if not claimed:
+                    break
+                ticks.append(time.perf_counter() - started)
+        if backend == 'smtp':
+            delivered, transactions = sink.received, sink.messages
+        else:
+            delivered = sum(len(message.recipients()) for message in mail.outbox)
+            transactions = len(mail.outbox)
+            mail.outbox = []
+        transaction.set_rollback(True)
+
+    peak = peak_rss()
+    elapsed = sum(ticks)
+    ticks.sort()
+    return {
+        'engine': engine,
+        'backend': backend,
+        'mailings': owners * mailings,
+        'recipients': recipients,
+        'delivered': delivered,
+        'smtp_transactions': transactions,
+        'ticks': len(ticks),
+        'seconds': round(elapsed, 4),
+        'msgs_per_sec': round(delivered / elapsed, 1) if elapsed else None,
+        'tick_latency': {
+            name: round(percentile(ticks, fraction), 4) if ticks else None
+            for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1))
+        },
+        'queries': counter.count,
+        'peak_rss_bytes': peak,
+        'rss_growth_bytes': max(peak - baseline_rss, 0) if baseline_rss is not None else None,
+    }
+
+
+def measure_render(renders):
+    """
+    Отрисовывает тему и текст персонализированного сообщения renders раз и возвращает
+    скорость в отрисовках в секунду. Компиляция шаблона в замер не входит.
+    """
+    message = Message(
+        pk=0,
+        subject='{{ full_name }}, новости недели',
+        body='Здравствуйте, {{ full_name }}!\n\n' + 'Текст рассылки. ' * 60 + '\n\nПисьмо отправлено на {{ email }}.',
+    )
+    clients = [Client(email=f'client{number}@example.com', full_name=f'Клиент {number}') for number in range(1000)]
+    compiled = compile_message(message)
+    started = time.perf_counter()
+    for number in range(renders):
+        client = clients[number % len(clients)]
+        compiled.subject.render(client)
+        compiled.body.render(client)
+    return renders / (time.perf_counter() - started)
@@ -0,0 +1,81 @@
+import threading
+import time
+
+from django.conf import settings
+
+
+class CircuitOpenError(Exception):
+    """
+    Письмо не отправлялось: SMTP-релей недоступен, и автоматический выключатель разомкнут.
+    """
+
+
+class CircuitBreaker:
+    """
+    Автоматический выключатель вокруг подключений к SMTP-релею.
+
+    После threshold ошибок соединения подряд выключатель размыкается, и отправка сразу
+    завершается ошибкой CircuitOpenError вместо ожидания таймаута соединения. Через
+    reset_timeout секунд выключатель пропускает одну пробную отправку: при успехе он
+    замыкается, при ошибке снова размыкается.
+
+    Атрибуты:
+    - threshold (int): Сколько ошибок соединения подряд размыкают выключатель.
+    - reset_timeout (int): Через сколько секунд после размыкания пропускается пробная отправка.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold=None, reset_timeout=None):
+        self.threshold = threshold or settings.MAILING_BREAKER_THRESHOLD
+        self.reset_timeout = reset_timeout or settings.MAILING_BREAKER_RESET_SECONDS
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        Проверяет, можно ли обращаться к релею. В полуоткрытом состоянии разрешает одну пробу.
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.threshold:
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def error(self):
+        """
+        Возвращает ошибку для письма, которое не отправлялось из-за разомкнутого выключателя.
+        """
+        return CircuitOpenError(f"SMTP-релей недоступен, отправка отложена на {self.reset_timeout} с")
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(relay=None):
+    """
+    Возвращает общий для процесса выключатель SMTP-релея, по умолчанию — релея из настроек EMAIL_*.
+    """
+    relay = relay or f"{settings.EMAIL_HOST}:{settings.EMAIL_PORT}"
+    with _breakers_lock:
+        if relay not in _breakers:
+            _breakers[relay] = CircuitBreaker()
+        return _breakers[relay]
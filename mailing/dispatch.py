@@ -0,0 +1,327 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives
+from django.core.mail.utils import DNS_NAME
+from django.utils.module_loading import import_string
+
+from .domains import RECIPIENT_DOMAIN, domain_chunks, domain_order, domain_slots, recipient_domain, resolve_relay
+from .metrics import PHASE_SECONDS
+from .mime import PreparedEmailMessage, prepare_message
+from .models import Mailing, MailingDelivery
+from .personalize import compile_message
+from .pool import get_pool
+from .ratelimit import get_rate_limiter
+
+
+def chunked(items, size):
+    """
+    Разбивает последовательность на списки длиной не больше size, не загружая её целиком.
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def delivered_clients(mailing):
+    """
+    Возвращает подзапрос id клиентов, которым в текущем прогоне рассылки письмо доставлено
+    или отклонено сервером окончательно.
+    """
+    return MailingDelivery.objects.filter(
+        mailing=mailing, run=mailing.run, status__in=MailingDelivery.FINAL_STATUSES,
+    ).values('client_id')
+
+
+def pending_clients(mailing):
+    """
+    Возвращает клиентов рассылки, которым письмо ещё предстоит отправить, по порядку доменов
+    их адресов (см. domains.domain_chunks).
+
+    При повторе неудачной попытки (статус STARTED) письмо уходит только тем клиентам,
+    которым в текущем прогоне оно ещё не доставлено и не отклонено сервером окончательно.
+    Если клиенты и такие доставки были загружены заранее (см. tasks.load_mailings),
+    дополнительных запросов не выполняется.
+
+    Клиенты сегмента отбираются одним запросом в момент отправки, уже отсортированными базой,
+    и читаются итератором порциями по MAILING_SEGMENT_FETCH_SIZE (в PostgreSQL — через серверный
+    курсор), поэтому список получателей не загружается в память целиком.
+    """
+    if mailing.segment_id is not None:
+        clients = mailing.segment.get_clients().only('id', 'email', 'full_name')
+        if mailing.status == Mailing.STARTED:
+            clients = clients.exclude(id__in=delivered_clients(mailing))
+        return clients.annotate(domain=RECIPIENT_DOMAIN).order_by('domain', 'pk').iterator(
+            chunk_size=settings.MAILING_SEGMENT_FETCH_SIZE,
+        )
+    if mailing.status != Mailing.STARTED:
+        clients = mailing.clients.all()
+    elif hasattr(mailing, 'delivered'):
+        delivered = {delivery.client_id for delivery in mailing.delivered}
+        clients = [client for client in mailing.clients.all() if client.id not in delivered]
+    else:
+        clients = mailing.clients.exclude(id__in=delivered_clients(mailing))
+    return sorted(clients, key=domain_order)
+
+
+def reply_code(error):
+    """
+    Возвращает SMTP-код ответа для результата отправки: 250 при успехе,
+    код из исключения smtplib или aiosmtplib либо None, если кода нет.
+    """
+    if error is None:
+        return 250
+    code = getattr(error, 'smtp_code', None) or getattr(error, 'code', None)
+    refused = getattr(error, 'recipients', None)
+    if code is None and isinstance(refused, dict) and refused:
+        code = next(iter(refused.values()))[0]
+    elif code is None and refused:
+        code = getattr(refused[0], 'code', None)
+    return code if isinstance(code, int) and 0 < code < 1000 else None
+
+
+def is_permanent(error):
+    """
+    Проверяет, что ошибка отправки окончательная (код 5xx) и письмо не нужно отправлять повторно.
+    Коды 4xx, обрывы соединения и ошибки без кода считаются временными.
+    """
+    code = reply_code(error)
+    return code is not None and 500 <= code < 600
+
+
+def message_id(mailing, client):
+    """
+    Возвращает Message-ID, однозначно определяемый ключом (рассылка, прогон, клиент).
+
+    Письмо, повторно отправленное после сбоя (см. writer.TickWriter), получает тот же Message-ID,
+    и почтовые системы, которые удаляют дубликаты по Message-ID, покажут его один раз.
+    """
+    return f"<mailing-{mailing.pk}.{mailing.run}.{client.pk}@{DNS_NAME}>"
+
+
+def build_message(mailing, client):
+    """
+    Собирает отдельное письмо рассылки для одного клиента: получатель не видит адресов других клиентов.
+    Подстановки в теме, тексте и HTML-версии заменяются полями клиента.
+
+    Письмо без подстановок не кодируется заново для каждого клиента: его MIME-части берутся
+    из подготовленного письма прогона (см. mime.prepare_message).
+    """
+    compiled = compile_message(mailing.message)
+    headers = {'Message-ID': message_id(mailing, client)}
+    if not compiled.personalized:
+        return prepared_message(mailing, compiled, to=[client.email], headers=headers)
+    message = EmailMultiAlternatives(
+        subject=compiled.subject.render(client),
+        body=compiled.body.render(client),
+        from_email=settings.EMAIL_HOST_USER,
+        to=[client.email],
+        headers=headers,
+    )
+    if compiled.html:
+        message.attach_alternative(compiled.html.render(client), 'text/html')
+    return message
+
+
+def build_batch_message(mailing, clients):
+    """
+    Собирает одно письмо рассылки сразу для нескольких клиентов: адреса передаются только
+    в конверте (RCPT TO), поэтому получатели не видят друг друга, а сервер принимает
+    текст письма один раз на всю пачку.
+
+    Письмо для одного клиента собирается как обычно (см. build_message). Пачкой можно отправлять
+    только сообщение без подстановок (см. rcpt_batch_size).
+    """
+    if len(clients) == 1:
+        return build_message(mailing, clients[0])
+    return prepared_message(
+        mailing,
+        compile_message(mailing.message),
+        bcc=[client.email for client in clients],
+        headers={
+            'To': 'undisclosed-recipients:;',
+            'Message-ID': f"<mailing-{mailing.pk}.{mailing.run}.{clients[0].pk}-{clients[-1].pk}@{DNS_NAME}>",
+        },
+    )
+
+
+def prepared_message(mailing, compiled, **kwargs):
+    """
+    Собирает письмо сообщения без подстановок на основе подготовленного письма прогона рассылки.
+    """
+    message = mailing.message
+    alternatives = [(message.html_body, 'text/html')] if message.html_body else None
+    return PreparedEmailMessage(
+        prepare_message(mailing, compiled),
+        subject=message.subject,
+        body=message.body,
+        from_email=settings.EMAIL_HOST_USER,
+        alternatives=alternatives,
+        **kwargs,
+    )
+
+
+# Устанавливается при остановке обработчика: движки перестают брать новые порции,
+# а уже отправляемые завершаются и попадают в журнал доставки
+draining = threading.Event()
+
+_relay_slots = {}
+_relay_slots_lock = threading.Lock()
+
+
+def relay_slots(relay=None):
+    """
+    Возвращает семафор, ограничивающий число одновременных отправок через SMTP-релей.
+    """
+    relay = relay or f"{settings.EMAIL_HOST}:{settings.EMAIL_PORT}"
+    with _relay_slots_lock:
+        if relay not in _relay_slots:
+            _relay_slots[relay] = threading.BoundedSemaphore(settings.MAILING_RELAY_CONCURRENCY)
+        return _relay_slots[relay]
+
+
+def rcpt_batch_size(mailing):
+    """
+    Возвращает, скольким получателям рассылки можно отправить одно письмо: MAILING_RCPT_BATCH_SIZE
+    для сообщения без подстановок и 1 для персонализированного.
+    """
+    return 1 if compile_message(mailing.message).personalized else settings.MAILING_RCPT_BATCH_SIZE
+
+
+def send_chunk(mailing, chunk, pool):
+    """
+    Отправляет порцию писем рассылки клиентам одного домена (см. domains.domain_chunks)
+    и возвращает список пар (клиент, исключение или None).
+
+    Клиенты разбиваются на пачки по rcpt_batch_size, каждая пачка уходит одним
+    письмом через соединение с релеем, который резолвер вернул для домена; без отдельного
+    релея используется пул pool. Число одновременных отправок ограничено на релей и на домен.
+
+    Не обращается к базе данных, поэтому может выполняться в рабочем потоке.
+    Каждое письмо уходит не раньше, чем это разрешат ограничения скорости.
+    """
+    domain = recipient_domain(chunk[0].email)
+    relay = resolve_relay(domain)
+    if relay is not None:
+        pool = get_pool(relay)
+    with PHASE_SECONDS.time(phase='render'):
+        messages = [build_batch_message(mailing, batch) for batch in chunked(chunk, rcpt_batch_size(mailing))]
+    with domain_slots(domain), relay_slots(relay):
+        errors = pool.send_messages(messages, before_send=partial(get_rate_limiter().wait, mailing, relay=relay))
+    return list(zip(chunk, errors))
+
+
+class SyncEngine:
+    """
+    Движок последовательной отправки: рассылки и их порции обрабатываются по очереди.
+    """
+
+    def __init__(self, chunk_size=None):
+        self.chunk_size = chunk_size or settings.MAILING_FANOUT_CHUNK_SIZE
+
+    def run(self, mailings, pool, writer):
+        """
+        Отправляет рассылки порциями получателей. Результаты каждой порции передаются
+        в writer.checkpoint, итог рассылки — в writer.record.
+
+        При остановке обработчика или потере аренды рассылка, отправленная не полностью,
+        не записывается в writer.record.
+        """
+        for mailing in mailings:
+            results = []
+            for chunk in domain_chunks(pending_clients(mailing), self.chunk_size):
+                if draining.is_set():
+                    break
+                chunk_results = send_chunk(mailing, chunk, pool)
+                if not writer.checkpoint(mailing, chunk_results):
+                    break
+                results.extend(chunk_results)
+            else:
+                writer.record(mailing, results)
+
+
+class ThreadEngine:
+    """
+    Движок параллельной отправки: порции получателей отправляются в пуле потоков.
+
+    Рабочие потоки только отправляют письма. Выборка получателей и вызовы writer
+    остаются в вызывающем потоке, который остаётся единственным писателем в базу данных.
+
+    Атрибуты:
+    - workers (int): Количество рабочих потоков.
+    - chunk_size (int): Сколько получателей отправляется одной задачей.
+    - max_in_flight (int): Сколько порций может одновременно ждать отправки.
+    """
+
+    def __init__(self, workers=None, chunk_size=None):
+        self.workers = workers or settings.MAILING_DISPATCH_WORKERS
+        self.chunk_size = chunk_size or settings.MAILING_FANOUT_CHUNK_SIZE
+        self.max_in_flight = self.workers * 2
+
+    def run(self, mailings, pool, writer):
+        """
+        Отправляет рассылки порциями получателей. Результаты каждой порции передаются
+        в writer.checkpoint, итог рассылки — в writer.record сразу после отправки всех её порций.
+        """
+        progress = {}
+        in_flight = {}
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='mailing') as executor:
+            for mailing in mailings:
+                mailing.message  # загружаем сообщение до передачи рассылки в рабочие потоки
+                entry = progress[mailing.pk] = {
+                    'mailing': mailing, 'results': [], 'left': 0, 'submitted': False, 'lost': False,
+                }
+                for chunk in domain_chunks(pending_clients(mailing), self.chunk_size):
+                    if draining.is_set() or entry['lost']:
+                        break
+                    in_flight[executor.submit(send_chunk, mailing, chunk, pool)] = mailing.pk
+                    progress[mailing.pk]['left'] += 1
+                    while len(in_flight) >= self.max_in_flight:
+                        self._collect(in_flight, progress, writer)
+                else:
+                    progress[mailing.pk]['submitted'] = True
+                    self._finish(mailing.pk, progress, writer)
+            while in_flight:
+                self._collect(in_flight, progress, writer)
+
+    def _collect(self, in_flight, progress, writer):
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            entry = progress[in_flight.pop(future)]
+            chunk_results = future.result()
+            if not writer.checkpoint(entry['mailing'], chunk_results):
+                entry['lost'] = True  # аренду забрал другой обработчик: оставшиеся порции не отправляются
+            entry['results'].extend(chunk_results)
+            entry['left'] -= 1
+            self._finish(entry['mailing'].pk, progress, writer)
+
+    @staticmethod
+    def _finish(pk, progress, writer):
+        entry = progress[pk]
+        if entry['submitted'] and entry['left'] == 0:
+            del progress[pk]
+            writer.record(entry['mailing'], entry['results'])
+
+
+ENGINES = {
+    'sync': 'mailing.dispatch.SyncEngine',
+    'threads': 'mailing.dispatch.ThreadEngine',
+    'async': 'mailing.async_dispatch.AsyncEngine',
+}
+
+
+def get_engine(name=None):
+    """
+    Возвращает движок отправки по имени, по умолчанию — из настройки MAILING_DISPATCH_ENGINE.
+
+    Движки импортируются лениво, чтобы асинхронному движку не требовался aiosmtplib,
+    пока он не выбран.
+    """
+    return import_string(ENGINES[name or settings.MAILING_DISPATCH_ENGINE])()
@@ -0,0 +1,72 @@
+import threading
+from itertools import groupby
+
+from django.conf import settings
+from django.db.models import Value
+from django.db.models.functions import Lower, StrIndex, Substr
+from django.utils.module_loading import import_string
+
+# Домен адреса клиента в SQL: для сортировки получателей по домену на стороне базы
+RECIPIENT_DOMAIN = Lower(Substr('email', StrIndex('email', Value('@')) + 1))
+
+
+def recipient_domain(email):
+    """
+    Возвращает домен адреса электронной почты в нижнем регистре.
+    """
+    return email.rpartition('@')[2].lower()
+
+
+def domain_order(client):
+    """
+    Ключ сортировки клиентов по домену адреса, а внутри домена — по id.
+    """
+    return recipient_domain(client.email), client.pk
+
+
+def domain_chunks(clients, size):
+    """
+    Разбивает клиентов, упорядоченных по домену адреса (см. domain_order), на порции не больше size
+    клиентов одного домена.
+
+    Клиенты читаются по мере выдачи порций, поэтому потоковая выборка из базы не загружается целиком.
+    """
+    for _, group in groupby(clients, key=lambda client: recipient_domain(client.email)):
+        chunk = []
+        for client in group:
+            chunk.append(client)
+            if len(chunk) == size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def default_resolver(domain):
+    """
+    Резолвер по умолчанию: все домены отправляются через SMTP-релей из настроек EMAIL_*.
+    """
+    return None
+
+
+def resolve_relay(domain):
+    """
+    Возвращает SMTP-релей "хост:порт" для домена получателей или None для релея из настроек EMAIL_*.
+
+    Резолвер задаётся настройкой MAILING_DOMAIN_RESOLVER — путём к функции, принимающей домен.
+    """
+    return import_string(settings.MAILING_DOMAIN_RESOLVER)(domain)
+
+
+_domain_slots = {}
+_domain_slots_lock = threading.Lock()
+
+
+def domain_slots(domain):
+    """
+    Возвращает семафор, ограничивающий число одновременных отправок на домен получателей.
+    """
+    with _domain_slots_lock:
+        if domain not in _domain_slots:
+            _domain_slots[domain] = threading.BoundedSemaphore(settings.MAILING_DOMAIN_CONCURRENCY)
+        return _domain_slots[domain]
@@ -1,5 +1,9 @@
+import os
+
 from django import forms
-from .models import Client, Message, Mailing, MailingAttempt
+from django.urls import reverse_lazy
+from .importer import EXTENSIONS
+from .models import Client, Message, Mailing, MailingAttempt, Segment
 
 class ClientForm(forms.ModelForm):
     """
@@ -12,12 +16,24 @@ class ClientForm(forms.ModelForm):
     """
     class Meta:
         model = Client
-        fields = ['email', 'full_name', 'comment']
+        fields = ['email', 'full_name', 'comment', 'tag']
         widgets = {
             'full_name': forms.TextInput(attrs={'placeholder': 'Введите ФИО'}),
             'comment': forms.Textarea(attrs={'placeholder': 'Оставьте комментарий'}),
+            'tag': forms.TextInput(attrs={'placeholder': 'Метка для сегментов (необязательно)'}),
         }
 
+    def clean_email(self):
+        """
+        Проверяет, что у владельца клиента нет другого клиента с тем же адресом без учёта регистра.
+        """
+        email = self.cleaned_data['email']
+        owner_id = self.instance.owner_id
+        if owner_id is not None and Client.objects.filter(owner_id=owner_id, email__iexact=email).exclude(
+                pk=self.instance.pk).exists():
+            raise forms.ValidationError('Клиент с таким email уже есть')
+        return email
+
 
 class ClientModeratorForm(forms.ModelForm):
     """
@@ -32,6 +48,22 @@ class ClientModeratorForm(forms.ModelForm):
         fields = ['full_name']
 
 
+class ClientImportForm(forms.Form):
+    """
+    Форма загрузки файла клиентов в формате CSV или XLSX.
+
+    В файле должен быть столбец email, необязательные столбцы — full_name, comment и tag.
+    Без строки заголовка столбцы идут в этом порядке.
+    """
+    file = forms.FileField(label='Файл CSV или XLSX', help_text='Столбцы: email, full_name, comment, tag')
+
+    def clean_file(self):
+        file = self.cleaned_data['file']
+        if os.path.splitext(file.name)[1].lower() not in EXTENSIONS:
+            raise forms.ValidationError('Поддерживаются только файлы CSV и XLSX')
+        return file
+
+
 class MessageForm(forms.ModelForm):
     """
     Форма для создания и редактирования сообщения.
@@ -43,34 +75,145 @@ class MessageForm(forms.ModelForm):
     """
     class Meta:
         model = Message
-        fields = ['subject', 'body']
+        fields = ['subject', 'body', 'html_body']
         widgets = {
             'subject': forms.TextInput(attrs={'placeholder': 'Тема сообщения'}),
-            'body': forms.Textarea(attrs={'placeholder': 'Текст сообщения'}),
+            'body': forms.Textarea(attrs={'placeholder': 'Текст сообщения. Подстановки: {{ full_name }}, {{ email }}'}),
+            'html_body': forms.Textarea(attrs={'placeholder': 'HTML-версия сообщения (необязательно)'}),
         }
 
 
+def client_label(client):
+    """
+    Возвращает подпись клиента в списке выбора: имя и адрес.
+    """
+    return f'{client.full_name} <{client.email}>' if client.full_name else client.email
+
+
+class ClientPickerWidget(forms.SelectMultiple):
+    """
+    Множественный выбор клиентов с поиском: выводятся только выбранные клиенты, остальные
+    подгружаются по мере ввода запроса страницами из представления ClientSearchView (static/js/client_picker.js).
+    """
+
+    def __init__(self, attrs=None):
+        super().__init__({'class': 'client-picker', 'data-search-url': reverse_lazy('mailing:client-search'),
+                          **(attrs or {})})
+
+    class Media:
+        js = ('js/client_picker.js',)
+
+    def optgroups(self, name, value, attrs=None):
+        selected = [pk for pk in value if str(pk).isdigit()]
+        if not selected:
+            return []
+        clients = self.choices.queryset.filter(pk__in=selected).only('id', 'email', 'full_name')
+        label = self.choices.field.label_from_instance
+        return [(None, [
+            self.create_option(name, client.pk, label(client), True, index, attrs=attrs)
+            for index, client in enumerate(clients)
+        ], 0)]
+
+
+class ClientMultipleChoiceField(forms.ModelMultipleChoiceField):
+    """
+    Поле выбора клиентов, которое не загружает все варианты: переданные id проверяются
+    одним запросом количества по queryset поля.
+    """
+    widget = ClientPickerWidget
+
+    def label_from_instance(self, obj):
+        return client_label(obj)
+
+    def _check_values(self, value):
+        try:
+            ids = {int(getattr(pk, 'pk', pk)) for pk in value}
+        except (TypeError, ValueError):
+            raise forms.ValidationError(self.error_messages['invalid_pk_value'], code='invalid_pk_value',
+                                        params={'pk': next(iter(value))})
+        queryset = self.queryset.filter(pk__in=ids)
+        if queryset.count() != len(ids):
+            found = set(queryset.values_list('pk', flat=True))
+            raise forms.ValidationError(self.error_messages['invalid_choice'], code='invalid_choice',
+                                        params={'value': min(ids - found)})
+        return queryset
+
+
 class MailingForm(forms.ModelForm):
     """
     Форма для создания и редактирования рассылки.
 
     Атрибуты:
         model: Указывает модель, с которой связана форма (Mailing).
-        fields: Поля модели, которые будут доступны для редактирования (дата начала, периодичность, статус, сообщение, клиенты).
+        fields: Поля модели, которые будут доступны для редактирования (дата начала, периодичность, статус, сообщение,
+            клиенты или сегмент).
         widgets: Виджеты для отображения полей формы, включая выбор даты и времени, выпадающие списки и множественный выбор.
+
+    Параметр owner — владелец рассылки: выбрать можно только его клиентов и сегменты.
     """
     class Meta:
         model = Mailing
-        fields = ['start_datetime', 'end_datetime', 'periodicity', 'status', 'message', 'clients']
+        fields = ['start_datetime', 'end_datetime', 'periodicity', 'status', 'message', 'segment', 'clients']
         widgets = {
             'start_datetime': forms.DateTimeInput(attrs={'type': 'datetime-local'}),
             'end_datetime': forms.DateTimeInput(attrs={'type': 'datetime-local'}),
             'periodicity': forms.Select(),
             'status': forms.Select(),
             'message': forms.Select(),
-            'clients': forms.CheckboxSelectMultiple(),
+            'segment': forms.Select(),
+        }
+        field_classes = {
+            'clients': ClientMultipleChoiceField,
+        }
+        help_texts = {
+            'segment': 'Клиенты сегмента отбираются при каждой отправке',
+            'clients': 'Начните вводить имя или email клиента',
+        }
+
+    def __init__(self, *args, owner=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['clients'].queryset = Client.objects.filter(owner=owner)
+        self.fields['segment'].queryset = Segment.objects.filter(owner=owner)
+
+    def clean(self):
+        """
+        Проверяет, что получатели заданы одним способом: сегментом или выбором клиентов.
+        """
+        cleaned_data = super().clean()
+        if cleaned_data.get('segment') and cleaned_data.get('clients'):
+            raise forms.ValidationError('Выберите сегмент или клиентов, но не то и другое')
+        if not cleaned_data.get('segment') and not cleaned_data.get('clients'):
+            raise forms.ValidationError('Выберите сегмент или клиентов рассылки')
+        return cleaned_data
+
+
+class SegmentForm(forms.ModelForm):
+    """
+    Форма для создания и редактирования сегмента клиентов.
+
+    Атрибуты:
+        model: Указывает модель, с которой связана форма (Segment).
+        fields: Название и условия отбора клиентов; пустые условия не ограничивают выборку.
+        widgets: Виджеты для полей формы, включая выбор даты и времени.
+    """
+    class Meta:
+        model = Segment
+        fields = ['name', 'tag', 'comment_contains', 'created_from', 'created_to']
+        widgets = {
+            'name': forms.TextInput(attrs={'placeholder': 'Название сегмента'}),
+            'tag': forms.TextInput(attrs={'placeholder': 'Любая'}),
+            'comment_contains': forms.TextInput(attrs={'placeholder': 'Любой'}),
+            'created_from': forms.DateTimeInput(attrs={'type': 'datetime-local'}),
+            'created_to': forms.DateTimeInput(attrs={'type': 'datetime-local'}),
         }
 
+    def clean(self):
+        cleaned_data = super().clean()
+        created_from, created_to = cleaned_data.get('created_from'), cleaned_data.get('created_to')
+        if created_from and created_to and created_from > created_to:
+            raise forms.ValidationError('Начало периода добавления клиентов позже его конца')
+        return cleaned_data
+
 
 class MailingAttemptForm(forms.ModelForm):
     """
@@ -0,0 +1,264 @@
+import csv
+import os
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.validators import EmailValidator
+from django.db import close_old_connections, transaction
+from django.db.models.functions import Lower
+
+from .audience import change_clients
+from .models import Client
+
+# Названия столбцов в строке заголовка, по которым находятся поля клиента
+COLUMNS = {
+    'email': {'email', 'e-mail', 'почта', 'электронная почта'},
+    'full_name': {'full_name', 'name', 'фио', 'имя'},
+    'comment': {'comment', 'комментарий'},
+    'tag': {'tag', 'метка'},
+}
+# Порядок столбцов в файле без строки заголовка
+DEFAULT_COLUMNS = {'email': 0, 'full_name': 1, 'comment': 2, 'tag': 3}
+EXTENSIONS = ('.csv', '.xlsx')
+DELIMITERS = (',', ';', '\t')
+
+validate_email = EmailValidator()
+
+
+class ClientImportError(Exception):
+    """
+    Файл нельзя импортировать: неизвестный формат или нет openpyxl для XLSX.
+    """
+
+
+def read_csv(path, encoding='utf-8-sig'):
+    """
+    Построчно читает CSV-файл, по умолчанию в UTF-8. Разделителем считается тот из символов
+    DELIMITERS, который чаще встречается в первой строке.
+    """
+    with open(path, encoding=encoding, newline='') as file:
+        first_line = file.readline()
+        file.seek(0)
+        yield from csv.reader(file, delimiter=max(DELIMITERS, key=first_line.count))
+
+
+def read_xlsx(path):
+    """
+    Построчно читает первый лист XLSX-файла в режиме read_only, не загружая книгу в память.
+    """
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise ClientImportError('Для импорта XLSX установите openpyxl')
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        yield from workbook.worksheets[0].iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+def read_rows(path, encoding='utf-8-sig'):
+    """
+    Возвращает генератор строк файла клиентов по его расширению: .csv или .xlsx.
+    Кодировка encoding используется только для CSV.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        return read_csv(path, encoding)
+    if extension == '.xlsx':
+        return read_xlsx(path)
+    raise ClientImportError(f'Неизвестный формат файла {extension or path}, ожидается CSV или XLSX')
+
+
+def cell(row, index):
+    if index is None or index >= len(row) or row[index] is None:
+        return ''
+    return str(row[index]).strip()
+
+
+class ImportResult:
+    """
+    Счётчики импорта клиентов.
+
+    Атрибуты:
+    - total (int): Сколько строк с данными прочитано.
+    - created (int): Сколько клиентов добавлено.
+    - duplicates (int): Сколько адресов уже было у владельца или повторялось в файле.
+    - invalid (int): Сколько строк пропущено из-за некорректного адреса.
+    """
+
+    def __init__(self):
+        self.total = 0
+        self.created = 0
+        self.duplicates = 0
+        self.invalid = 0
+
+    def as_dict(self):
+        return {'total': self.total, 'created': self.created, 'duplicates': self.duplicates, 'invalid': self.invalid}
+
+    def __str__(self):
+        return (f'обработано {self.total}, добавлено {self.created}, '
+                f'дубликатов {self.duplicates}, с ошибками {self.invalid}')
+
+
+class ClientImporter:
+    """
+    Потоковый импорт клиентов владельца из строк файла.
+
+    Строки обрабатываются пачками по batch_size: адреса приводятся к нижнему регистру и проверяются,
+    уже существующие у владельца находятся одним запросом по уникальному индексу (владелец, lower(email)),
+    новые вставляются через bulk_create, пропуская адреса, добавленные одновременно с импортом
+    (уникальный индекс). Каждая пачка сохраняется в своей транзакции, поэтому
+    в памяти одновременно находится только одна пачка, а прерванный импорт можно просто повторить.
+
+    Атрибуты:
+    - owner (Users): Владелец импортируемых клиентов.
+    - batch_size (int): Сколько строк обрабатывается за раз.
+    - progress (callable): Вызывается с ImportResult после каждой пачки.
+    """
+
+    def __init__(self, owner, batch_size=None, progress=None):
+        self.owner = owner
+        self.batch_size = batch_size or settings.MAILING_IMPORT_BATCH_SIZE
+        self.progress = progress
+        self.result = ImportResult()
+
+    def run(self, rows):
+        """
+        Импортирует строки и возвращает ImportResult. Первая строка считается заголовком,
+        если в ней есть столбец адреса (см. COLUMNS), иначе столбцы идут в порядке DEFAULT_COLUMNS.
+        """
+        rows = iter(rows)
+        first = next(rows, None)
+        if first is None:
+            return self.result
+        names = [cell(first, index).lower() for index in range(len(first))]
+        columns = {field: next((index for index, name in enumerate(names) if name in aliases), None)
+                   for field, aliases in COLUMNS.items()}
+        batch = []
+        if columns['email'] is None:
+            columns = DEFAULT_COLUMNS
+            batch.append(first)
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                self.import_batch(batch, columns)
+                batch = []
+        if batch:
+            self.import_batch(batch, columns)
+        return self.result
+
+    def import_batch(self, rows, columns):
+        clients = {}
+        for row in rows:
+            if not any(value not in (None, '') for value in row):
+                continue  # пустые строки не считаются
+            self.result.total += 1
+            email = cell(row, columns['email']).lower()
+            try:
+                validate_email(email)
+            except ValidationError:
+                self.result.invalid += 1
+                continue
+            if email in clients:
+                self.result.duplicates += 1
+                continue
+            clients[email] = (
+                cell(row, columns['full_name'])[:100],
+                cell(row, columns['comment']) or None,
+                cell(row, columns['tag'])[:50],
+            )
+        with transaction.atomic():
+            existing = set(
+                Client.objects.filter(owner=self.owner)
+                .annotate(email_lower=Lower('email'))
+                .filter(email_lower__in=clients)
+                .values_list('email_lower', flat=True)
+            )
+            new = [
+                Client(email=email, full_name=full_name, comment=comment, tag=tag, owner=self.owner)
+                for email, (full_name, comment, tag) in clients.items() if email not in existing
+            ]
+            Client.objects.bulk_create(new, batch_size=self.batch_size, ignore_conflicts=True)
+            # Параллельный импорт или форма могли добавить тот же адрес между проверкой и вставкой: такие
+            # строки пропускаются. Вставленные здесь клиенты узнаются по записанному им времени создания
+            created_at = dict(
+                Client.objects.filter(owner=self.owner, email__in=[client.email for client in new])
+                .values_list('email', 'created_at')
+            )
+            new = [client for client in new if created_at.get(client.email) == client.created_at]
+            # bulk_create не отправляет сигналы, счётчики аудитории обновляются здесь
+            change_clients(added=[(self.owner.pk, client.email) for client in new])
+        self.result.duplicates += len(clients) - len(new)
+        self.result.created += len(new)
+        if self.progress is not None:
+            self.progress(self.result)
+
+
+def import_progress_key(import_id):
+    return f'mailing:import:{import_id}'
+
+
+def get_import_progress(import_id):
+    """
+    Возвращает состояние импорта, запущенного start_import, или None.
+
+    Фоновый поток импорта живёт в процессе веб-приложения и обрывается вместе с ним, например
+    при перезапуске сервера. Незавершённый импорт, состояние которого не обновлялось дольше
+    MAILING_IMPORT_STALE_SECONDS, считается прерванным. Уже сохранённые пачки остаются в базе,
+    поэтому файл можно загрузить повторно: существующие адреса будут пропущены.
+    """
+    key = import_progress_key(import_id)
+    state = cache.get(key)
+    if (state is not None and not state['finished']
+            and time.time() - state.get('updated_at', 0) > settings.MAILING_IMPORT_STALE_SECONDS):
+        state.update(
+            finished=True,
+            error='процесс импорта остановлен, загрузите файл повторно или импортируйте его командой import_clients',
+        )
+        cache.set(key, state, settings.MAILING_IMPORT_PROGRESS_TTL)
+    return state
+
+
+def start_import(path, owner):
+    """
+    Запускает импорт файла path в фоновом потоке и возвращает идентификатор импорта.
+
+    Состояние импорта (счётчики ImportResult, владелец, признак завершения, ошибка и время обновления)
+    после каждой пачки записывается в кэш, поэтому его видит любой процесс веб-приложения
+    (см. get_import_progress). По окончании импорта файл удаляется.
+
+    Поток не переживает остановку процесса, поэтому большие файлы надёжнее импортировать
+    командой import_clients.
+    """
+    import_id = uuid.uuid4().hex
+    key = import_progress_key(import_id)
+    state = {
+        'owner_id': owner.pk, 'finished': False, 'error': None, 'updated_at': time.time(),
+        **ImportResult().as_dict(),
+    }
+    cache.set(key, state, settings.MAILING_IMPORT_PROGRESS_TTL)
+
+    def progress(result):
+        state.update(result.as_dict(), updated_at=time.time())
+        cache.set(key, state, settings.MAILING_IMPORT_PROGRESS_TTL)
+
+    def run():
+        try:
+            ClientImporter(owner, progress=progress).run(read_rows(path))
+        except UnicodeDecodeError:
+            state['error'] = 'CSV-файл должен быть в кодировке UTF-8'
+        except Exception as error:
+            state['error'] = str(error)
+        finally:
+            state.update(finished=True, updated_at=time.time())
+            cache.set(key, state, settings.MAILING_IMPORT_PROGRESS_TTL)
+            os.remove(path)
+            close_old_connections()
+
+    threading.Thread(target=run, name=f'client-import-{import_id}', daemon=True).start()
+    return import_id
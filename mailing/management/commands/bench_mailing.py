@@ -0,0 +1,57 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from mailing.bench import measure_pipeline, measure_render
+from mailing.dispatch import ENGINES
+
+BACKENDS = ('locmem', 'smtp')
+
+
+class Command(BaseCommand):
+    help = 'Load-test send_mailing with generated data against locmem and a local SMTP sink'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--owners', type=int, default=1, help='Количество владельцев')
+        parser.add_argument('--clients', type=int, default=1000, help='Количество клиентов у каждого владельца')
+        parser.add_argument('--messages', type=int, default=1, help='Количество сообщений у каждого владельца')
+        parser.add_argument('--mailings', type=int, default=1,
+                            help='Количество рассылок у каждого владельца, каждая — на всех его клиентов')
+        parser.add_argument('--personalized', action='store_true', help='Сообщения с подстановками полей клиента')
+        parser.add_argument('--claim-limit', type=int, help='Сколько рассылок захватывает один тик')
+        parser.add_argument('--engines', nargs='+', choices=sorted(ENGINES), default=list(ENGINES),
+                            help='Движки отправки для сравнения')
+        parser.add_argument('--backends', nargs='+', choices=BACKENDS, default=list(BACKENDS),
+                            help='Почтовые бэкенды: locmem или локальный SMTP-приёмник')
+        parser.add_argument('--renders', type=int, default=0,
+                            help='Замерить скорость отрисовки персонализированного письма на стольких отрисовках')
+        parser.add_argument('--json', help='Записать результаты в JSON-файл')
+
+    def handle(self, *args, **kwargs):
+        params = {name: kwargs[name] for name in ('owners', 'clients', 'messages', 'mailings', 'personalized',
+                                                  'claim_limit')}
+        report = {'params': params, 'database': connection.vendor, 'results': []}
+        if kwargs['renders']:
+            report['renders_per_sec'] = round(measure_render(kwargs['renders']), 1)
+            self.stdout.write(f"render {report['renders_per_sec']:>10.1f} отрисовок/с")
+        for backend in kwargs['backends']:
+            for engine in kwargs['engines']:
+                if backend == 'locmem' and engine == 'async':
+                    continue  # асинхронный движок отправляет только через SMTP-сессии aiosmtplib
+                result = measure_pipeline(engine, backend, **params)
+                report['results'].append(result)
+                latency = result['tick_latency']
+                self.stdout.write(
+                    f"{engine:<8} {backend:<7} {result['msgs_per_sec'] or 0:>10.1f} писем/с  "
+                    f"тиков {result['ticks']}, p50 {latency['p50']} с, p99 {latency['p99']} с  "
+                    f"запросов {result['queries']}  RSS {(result['peak_rss_bytes'] or 0) // 2 ** 20} МБ "
+                    f"(+{(result['rss_growth_bytes'] or 0) // 2 ** 20} МБ)"
+                )
+                if result['delivered'] != result['recipients']:
+                    self.stdout.write(self.style.WARNING(
+                        f"Доставлено {result['delivered']} из {result['recipients']} получателей"
+                    ))
+        if kwargs['json']:
+            with open(kwargs['json'], 'w', encoding='utf-8') as file:
+                json.dump(report, file, ensure_ascii=False, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Результаты записаны в {kwargs['json']}"))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from mailing.importer import ClientImporter, ClientImportError, read_rows
+from users.models import Users
+
+
+class Command(BaseCommand):
+    help = 'Import clients from a CSV or XLSX file in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Файл CSV или XLSX со столбцами email, full_name, comment')
+        parser.add_argument('--owner', required=True, help='Email владельца импортируемых клиентов')
+        parser.add_argument('--batch-size', type=int, help='Сколько строк обрабатывается за раз')
+        parser.add_argument('--encoding', default='utf-8-sig', help='Кодировка CSV-файла, например cp1251')
+
+    def handle(self, *args, **kwargs):
+        try:
+            owner = Users.objects.get(email=kwargs['owner'])
+        except Users.DoesNotExist:
+            raise CommandError(f"Пользователь {kwargs['owner']} не найден")
+
+        def progress(result):
+            self.stdout.write(f'Импорт: {result}')
+
+        importer = ClientImporter(owner, batch_size=kwargs['batch_size'], progress=progress)
+        try:
+            result = importer.run(read_rows(kwargs['path'], kwargs['encoding']))
+        except UnicodeDecodeError:
+            raise CommandError(f"Файл не в кодировке {kwargs['encoding']}, укажите её через --encoding")
+        except (ClientImportError, OSError) as error:
+            raise CommandError(error)
+        self.stdout.write(self.style.SUCCESS(f'Готово: {result}'))
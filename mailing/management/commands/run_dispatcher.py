@@ -0,0 +1,59 @@
+import os
+import signal
+import socket
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from mailing.dispatch import ENGINES, draining
+from mailing.metrics import registry
+from mailing.models import DispatcherHeartbeat, Mailing
+from mailing.scheduler import start_scheduler
+from mailing.tasks import worker_id
+
+
+class Command(BaseCommand):
+    help = 'Run the mailing dispatcher until SIGTERM or SIGINT'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--engine', choices=sorted(ENGINES), help='Движок отправки (по умолчанию из настроек)')
+
+    def handle(self, *args, **kwargs):
+        stopping = threading.Event()
+
+        def shutdown(signum, frame):
+            # Новые порции не отправляются, уже начатые завершаются и попадают в журнал доставки
+            self.stdout.write('Остановка: дожидаемся отправки текущих писем')
+            draining.set()
+            scheduler.stop()
+            stopping.set()
+
+        scheduler = start_scheduler(engine=kwargs['engine'])
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+
+        now = timezone.now()
+        heartbeat, _ = DispatcherHeartbeat.objects.update_or_create(
+            worker_id=worker_id(),
+            defaults={
+                'host': socket.gethostname(),
+                'pid': os.getpid(),
+                'started_at': now,
+                'last_seen': now,
+                'in_flight': 0,
+            },
+        )
+        self.stdout.write(self.style.SUCCESS(f'Dispatcher {heartbeat.worker_id} started'))
+
+        while not stopping.wait(settings.MAILING_HEARTBEAT_SECONDS) and scheduler.is_alive():
+            now = timezone.now()
+            heartbeat.last_seen = now
+            heartbeat.in_flight = Mailing.objects.filter(leased_by=heartbeat.worker_id, lease_until__gt=now).count()
+            heartbeat.save(update_fields=['last_seen', 'in_flight'])
+            registry.flush()
+
+        scheduler.join()
+        registry.flush()
+        heartbeat.delete()
+        self.stdout.write(self.style.SUCCESS(f'Dispatcher {heartbeat.worker_id} stopped'))
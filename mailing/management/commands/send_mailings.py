@@ -1,11 +1,14 @@
-from django.core.mail import EmailMessage
 from django.core.management.base import BaseCommand
+from mailing.dispatch import ENGINES
 from mailing.tasks import send_mailing
 
 
 class Command(BaseCommand):
     help = 'Send scheduled mailings'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--engine', choices=sorted(ENGINES), help='Движок отправки (по умолчанию из настроек)')
+
     def handle(self, *args, **kwargs):
-        send_mailing()
+        send_mailing(engine=kwargs['engine'])
         self.stdout.write(self.style.SUCCESS('Successfully sent mailings'))
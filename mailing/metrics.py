@@ -0,0 +1,304 @@
+import bisect
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .ratelimit import redis_client
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм в секундах: от быстрых запросов к базе до долгих тиков
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+class Metric:
+    """
+    Метрика с метками. Значения хранятся в памяти процесса, изменение — одна операция со словарём
+    под блокировкой, поэтому метрики можно обновлять на горячем пути отправки.
+
+    Атрибуты:
+    - name (str): Имя метрики в формате Prometheus.
+    - documentation (str): Описание для строки # HELP.
+    - labelnames (tuple): Имена меток в порядке их вывода.
+    """
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels[label]) for label in self.labelnames)
+
+    def collect(self, reset=False):
+        """
+        Возвращает отсчёты метрики — тройки (суффикс имени, пары меток, значение).
+        С reset счётчики обнуляются: накопленное передано в общее хранилище.
+        """
+        with self._lock:
+            values = self._values
+            if reset:
+                self._values = {}
+            else:
+                values = dict(values)
+        return [
+            (suffix, tuple(zip(self.labelnames, key)) + extra, value)
+            for key, item in values.items()
+            for suffix, extra, value in self._samples(item)
+        ]
+
+    def _samples(self, item):
+        return [('', (), item)]
+
+
+class Counter(Metric):
+    """
+    Монотонно растущий счётчик. Значения разных процессов складываются.
+    """
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Текущее значение величины. В общем хранилище остаётся значение, записанное последним.
+    """
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def collect(self, reset=False):
+        return super().collect(reset=False)
+
+
+class Timer:
+    """
+    Контекстный менеджер, записывающий в гистограмму время выполнения блока.
+    """
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+class Histogram(Metric):
+    """
+    Распределение длительностей по корзинам. Корзины, сумма и количество разных процессов складываются.
+
+    Атрибуты:
+    - buckets (tuple): Верхние границы корзин по возрастанию, без +Inf.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            item = self._values.get(key)
+            if item is None:
+                item = self._values[key] = [[0] * (len(self.buckets) + 1), 0]
+            item[0][index] += 1
+            item[1] += value
+
+    def time(self, **labels):
+        """
+        Возвращает контекстный менеджер, который запишет время выполнения блока.
+        """
+        return Timer(self, labels)
+
+    def _samples(self, item):
+        counts, total = item
+        samples, cumulative = [], 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            samples.append(('_bucket', (('le', format_value(bound)),), cumulative))
+        samples.append(('_sum', (), total))
+        samples.append(('_count', (), cumulative))
+        return samples
+
+
+class RedisStore:
+    """
+    Общее хранилище метрик в Redis: по хешу на метрику, поле — отсчёт с метками.
+
+    Процессы периодически прибавляют накопленные приращения счётчиков и гистограмм
+    и записывают текущие значения показателей, поэтому /metrics любого процесса
+    показывает сумму по всем обработчикам и веб-процессам.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    @staticmethod
+    def key(metric):
+        return cache.make_key(f'mailing:metrics:{metric.name}')
+
+    def push(self, collected):
+        pipeline = self.client.pipeline(transaction=False)
+        for metric, samples in collected:
+            key = self.key(metric)
+            for suffix, labels, value in samples:
+                field = json.dumps([suffix, labels])
+                if metric.kind == 'gauge':
+                    pipeline.hset(key, field, value)
+                else:
+                    pipeline.hincrbyfloat(key, field, value)
+        pipeline.execute()
+
+    def read(self, metrics):
+        pipeline = self.client.pipeline(transaction=False)
+        for metric in metrics:
+            pipeline.hgetall(self.key(metric))
+        result = []
+        for values in pipeline.execute():
+            samples = []
+            for field, value in values.items():
+                suffix, labels = json.loads(field)
+                samples.append((suffix, tuple(tuple(pair) for pair in labels), float(value)))
+            result.append(samples)
+        return result
+
+
+SUFFIX_ORDER = {'': 0, '_bucket': 1, '_sum': 2, '_count': 3}
+
+
+def sample_order(sample):
+    suffix, labels, _ = sample
+    le = [float(value) for name, value in labels if name == 'le']
+    return [pair for pair in labels if pair[0] != 'le'], SUFFIX_ORDER[suffix], le
+
+
+class Registry:
+    """
+    Набор метрик процесса и их вывод в текстовом формате Prometheus.
+
+    Если кэш Django — Redis, накопленные значения не реже раза в MAILING_METRICS_FLUSH_SECONDS
+    отправляются в общее хранилище одним конвейером (см. RedisStore), и выводятся суммы по всем
+    процессам. Иначе выводятся значения текущего процесса.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self._store = None
+        self._store_lock = threading.Lock()
+        self._flushed_at = time.monotonic()
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    @property
+    def store(self):
+        with self._store_lock:
+            if self._store is None:
+                client = redis_client()
+                self._store = RedisStore(client) if client is not None else False
+            return self._store
+
+    def flush(self):
+        """
+        Отправляет накопленные значения в общее хранилище. Ошибка Redis не прерывает отправку рассылок:
+        накопленное за этот интервал теряется.
+        """
+        self._flushed_at = time.monotonic()
+        store = self.store
+        if not store:
+            return
+        collected = [(metric, metric.collect(reset=True)) for metric in self.metrics]
+        try:
+            store.push(collected)
+        except Exception:
+            logger.warning('Не удалось отправить метрики в Redis', exc_info=True)
+
+    def maybe_flush(self):
+        """
+        Вызывает flush, если с прошлой отправки прошло MAILING_METRICS_FLUSH_SECONDS.
+        """
+        if time.monotonic() - self._flushed_at >= settings.MAILING_METRICS_FLUSH_SECONDS:
+            self.flush()
+
+    def collect(self):
+        """
+        Возвращает пары (метрика, отсчёты), суммарные по всем процессам, если есть общее хранилище.
+        """
+        store = self.store
+        if not store:
+            return [(metric, metric.collect()) for metric in self.metrics]
+        self.flush()
+        return list(zip(self.metrics, store.read(self.metrics)))
+
+    def exposition(self):
+        """
+        Возвращает метрики в текстовом формате Prometheus.
+        """
+        lines = []
+        for metric, samples in self.collect():
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for suffix, labels, value in sorted(samples, key=sample_order):
+                text = ','.join(f'{name}="{escape(label)}"' for name, label in labels)
+                lines.append(f'{metric.name}{suffix}{{{text}}} {format_value(value)}' if text
+                             else f'{metric.name}{suffix} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+TICK_SECONDS = registry.histogram('mailing_tick_seconds', 'Длительность тика отправки рассылок')
+PHASE_SECONDS = registry.histogram(
+    'mailing_phase_seconds',
+    'Длительность этапов отправки: due — выборка и захват, render — сборка писем, connect — подключение '
+    'к SMTP, send — SMTP-транзакция одного письма, persist — запись журнала и попыток',
+    ['phase'],
+)
+TICK_ERRORS = registry.counter('mailing_tick_errors_total', 'Тики, завершившиеся ошибкой')
+CLAIMED = registry.counter('mailing_claimed_total', 'Рассылки, захваченные обработчиками')
+RECIPIENTS = registry.counter('mailing_recipients_total', 'Результаты отправки по получателям', ['status'])
+DUE_MAILINGS = registry.gauge('mailing_due_mailings', 'Подошедшие и не захваченные рассылки')
+HTTP_REQUESTS = registry.counter('http_requests_total', 'HTTP-запросы', ['view', 'method', 'status'])
+HTTP_SECONDS = registry.histogram('http_request_seconds', 'Длительность обработки HTTP-запросов', ['view'])
@@ -0,0 +1,25 @@
+import time
+
+from .metrics import HTTP_REQUESTS, HTTP_SECONDS, registry
+
+
+class MetricsMiddleware:
+    """
+    Считает HTTP-запросы и время их обработки по именам представлений (см. metrics.HTTP_REQUESTS).
+
+    Запросы, не сопоставленные ни с одним представлением, учитываются под именем "unmatched",
+    чтобы произвольные адреса не порождали новые метки.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        response = self.get_response(request)
+        match = request.resolver_match
+        view = match.view_name if match else 'unmatched'
+        HTTP_SECONDS.observe(time.perf_counter() - started, view=view)
+        HTTP_REQUESTS.inc(view=view, method=request.method, status=response.status_code)
+        registry.maybe_flush()
+        return response
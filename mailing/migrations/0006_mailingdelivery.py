@@ -0,0 +1,29 @@
+# Generated by Django 4.2.2 on 2026-10-17 21:53
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0005_alter_mailing_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailingDelivery',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('success', 'Success'), ('failed', 'Failed')], max_length=20)),
+                ('server_response', models.TextField(blank=True, null=True)),
+                ('attempt', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deliveries', to='mailing.mailingattempt')),
+                ('client', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deliveries', to='mailing.client')),
+                ('mailing', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deliveries', to='mailing.mailing')),
+            ],
+            options={
+                'verbose_name': 'Доставка',
+                'verbose_name_plural': 'Доставки',
+            },
+        ),
+    ]
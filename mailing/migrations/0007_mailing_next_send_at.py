@@ -0,0 +1,38 @@
+# Generated by Django 4.2.2 on 2026-10-17 21:58
+
+from datetime import timedelta
+
+from django.db import migrations, models
+
+PERIODS = {'D': timedelta(days=1), 'W': timedelta(weeks=1), 'M': timedelta(weeks=4)}
+
+
+def fill_next_send_at(apps, schema_editor):
+    Mailing = apps.get_model('mailing', 'Mailing')
+    mailings = Mailing.objects.annotate(last_attempt_at=models.Max('attempts__attempt_datetime'))
+    for mailing in mailings.iterator():
+        if mailing.last_attempt_at is None:
+            mailing.next_send_at = mailing.start_datetime
+        else:
+            mailing.next_send_at = mailing.last_attempt_at + PERIODS.get(mailing.periodicity, timedelta(0))
+        mailing.save(update_fields=['next_send_at'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0006_mailingdelivery'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mailing',
+            name='next_send_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Время следующей отправки'),
+        ),
+        migrations.AddIndex(
+            model_name='mailing',
+            index=models.Index(condition=models.Q(('status__in', ['CREATED', 'STARTED'])), fields=['next_send_at'], name='mailing_due_idx'),
+        ),
+        migrations.RunPython(fill_next_send_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,63 @@
+from django.db import migrations, models
+
+
+def fill_ledger(apps, schema_editor):
+    Mailing = apps.get_model('mailing', 'Mailing')
+    MailingDelivery = apps.get_model('mailing', 'MailingDelivery')
+    # Все прежние доставки относятся к первому прогону рассылки
+    Mailing.objects.filter(attempts__isnull=False).distinct().update(run=1)
+    MailingDelivery.objects.filter(status='failed').update(code=2)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0007_mailing_next_send_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mailing',
+            name='run',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Номер прогона'),
+        ),
+        migrations.AddField(
+            model_name='mailingdelivery',
+            name='run',
+            field=models.PositiveIntegerField(default=1, verbose_name='Прогон'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='mailingdelivery',
+            name='reply_code',
+            field=models.PositiveSmallIntegerField(blank=True, null=True, verbose_name='Код ответа сервера'),
+        ),
+        migrations.AddField(
+            model_name='mailingdelivery',
+            name='code',
+            field=models.PositiveSmallIntegerField(choices=[(1, 'Доставлено'), (2, 'Не доставлено')], default=1, verbose_name='Статус'),
+            preserve_default=False,
+        ),
+        migrations.RunPython(fill_ledger, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='mailingdelivery',
+            name='status',
+        ),
+        migrations.RenameField(
+            model_name='mailingdelivery',
+            old_name='code',
+            new_name='status',
+        ),
+        migrations.RemoveField(
+            model_name='mailingdelivery',
+            name='attempt',
+        ),
+        migrations.RemoveField(
+            model_name='mailingdelivery',
+            name='server_response',
+        ),
+        migrations.AddIndex(
+            model_name='mailingdelivery',
+            index=models.Index(fields=['mailing', 'run', 'status'], name='delivery_run_status_idx'),
+        ),
+    ]
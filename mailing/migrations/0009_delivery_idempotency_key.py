@@ -0,0 +1,17 @@
+# Generated by Django 4.2.2 on 2026-10-17 22:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0008_delivery_ledger'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='mailingdelivery',
+            constraint=models.UniqueConstraint(fields=('mailing', 'run', 'client'), name='delivery_idempotency_key'),
+        ),
+    ]
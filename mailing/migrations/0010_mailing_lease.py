@@ -0,0 +1,23 @@
+# Generated by Django 4.2.2 on 2026-10-17 22:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0009_delivery_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mailing',
+            name='lease_until',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Захвачена до'),
+        ),
+        migrations.AddField(
+            model_name='mailing',
+            name='leased_by',
+            field=models.CharField(blank=True, editable=False, max_length=100, verbose_name='Захвачена обработчиком'),
+        ),
+    ]
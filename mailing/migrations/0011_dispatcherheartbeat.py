@@ -0,0 +1,29 @@
+# Generated by Django 4.2.2 on 2026-10-17 22:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0010_mailing_lease'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DispatcherHeartbeat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('worker_id', models.CharField(max_length=100, unique=True, verbose_name='Обработчик')),
+                ('host', models.CharField(max_length=255, verbose_name='Хост')),
+                ('pid', models.PositiveIntegerField(verbose_name='PID')),
+                ('started_at', models.DateTimeField(verbose_name='Запущен')),
+                ('last_seen', models.DateTimeField(verbose_name='Последняя отметка')),
+                ('in_flight', models.PositiveIntegerField(default=0, verbose_name='Рассылок в работе')),
+            ],
+            options={
+                'verbose_name': 'Обработчик рассылок',
+                'verbose_name_plural': 'Обработчики рассылок',
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.2 on 2026-10-17 22:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0011_dispatcherheartbeat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mailing',
+            name='retry_count',
+            field=models.PositiveSmallIntegerField(default=0, editable=False, verbose_name='Повторов подряд'),
+        ),
+        migrations.AlterField(
+            model_name='mailingdelivery',
+            name='status',
+            field=models.PositiveSmallIntegerField(choices=[(1, 'Доставлено'), (2, 'Не доставлено'), (3, 'Отклонено')], verbose_name='Статус'),
+        ),
+    ]
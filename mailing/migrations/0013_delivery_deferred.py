@@ -0,0 +1,18 @@
+# Generated by Django 4.2.2 on 2026-10-17 22:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0012_mailing_retry_count'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='mailingdelivery',
+            name='status',
+            field=models.PositiveSmallIntegerField(choices=[(1, 'Доставлено'), (2, 'Не доставлено'), (3, 'Отклонено'), (4, 'Отложено')], verbose_name='Статус'),
+        ),
+    ]
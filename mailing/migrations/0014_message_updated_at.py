@@ -0,0 +1,20 @@
+# Generated by Django 4.2.2 on 2026-10-17 22:25
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0013_delivery_deferred'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now, verbose_name='Изменено'),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.2 on 2026-10-17 22:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0014_message_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='html_body',
+            field=models.TextField(blank=True, null=True, verbose_name='HTML-текст'),
+        ),
+    ]
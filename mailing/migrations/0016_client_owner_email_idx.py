@@ -0,0 +1,18 @@
+# Generated by Django 4.2.2 on 2026-10-17 22:31
+
+from django.db import migrations, models
+import django.db.models.functions.text
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0015_message_html_body'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='client',
+            index=models.Index(models.F('owner'), django.db.models.functions.text.Lower('email'), name='client_owner_email_idx'),
+        ),
+    ]
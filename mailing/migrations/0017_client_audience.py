@@ -0,0 +1,127 @@
+# Generated by Django 4.2.2 on 2026-10-17 22:38
+
+import logging
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+from django.db.models.functions import Lower
+import django.db.models.functions.text
+
+logger = logging.getLogger(__name__)
+
+# Статусы MailingDelivery.FINAL_STATUSES на момент миграции: SENT и REJECTED
+FINAL_STATUSES = (1, 3)
+
+
+def merge_duplicate_clients(apps, schema_editor):
+    """
+    Объединяет клиентов одного владельца с одинаковым адресом без учёта регистра перед созданием
+    уникального индекса: остаётся клиент с наименьшим id, рассылки удаляемых дубликатов переходят к нему.
+
+    Журнал доставки дубликатов тоже переходит к оставшемуся клиенту. Если в одном прогоне рассылки
+    записи есть у нескольких из них, остаётся одна — с окончательным статусом, если такая есть,
+    чтобы письмо не ушло повторно. Количество объединённых клиентов и записей журнала выводится в лог.
+    """
+    Client = apps.get_model('mailing', 'Client')
+    Through = apps.get_model('mailing', 'Mailing').clients.through
+    MailingDelivery = apps.get_model('mailing', 'MailingDelivery')
+    merged = moved = dropped = 0
+    clients = Client.objects.filter(owner__isnull=False).annotate(email_lower=Lower('email'))
+    groups = clients.values('owner_id', 'email_lower').annotate(count=Count('id'), keep=Min('id')).filter(count__gt=1)
+    for group in groups.iterator():
+        duplicates = list(
+            clients.filter(owner_id=group['owner_id'], email_lower=group['email_lower'])
+            .exclude(pk=group['keep']).values_list('pk', flat=True)
+        )
+        mailing_ids = Through.objects.filter(client_id__in=duplicates).values_list('mailing_id', flat=True).distinct()
+        Through.objects.bulk_create(
+            [Through(mailing_id=mailing_id, client_id=group['keep']) for mailing_id in mailing_ids],
+            ignore_conflicts=True,
+        )
+        deliveries = MailingDelivery.objects.filter(client_id__in=[group['keep'], *duplicates])
+        winners = {}
+        for pk, mailing_id, run, status in deliveries.order_by('pk').values_list('pk', 'mailing_id', 'run', 'status'):
+            current = winners.get((mailing_id, run))
+            if current is None or (status in FINAL_STATUSES and current[1] not in FINAL_STATUSES):
+                winners[(mailing_id, run)] = (pk, status)
+        kept = [pk for pk, _ in winners.values()]
+        dropped += deliveries.exclude(pk__in=kept).delete()[0]
+        moved += MailingDelivery.objects.filter(pk__in=kept).exclude(client_id=group['keep']).update(
+            client_id=group['keep'],
+        )
+        Client.objects.filter(pk__in=duplicates).delete()
+        merged += len(duplicates)
+    if merged:
+        logger.warning(
+            'Удалено дубликатов клиентов: %s; записей журнала доставки перенесено: %s, удалено повторных: %s',
+            merged, moved, dropped,
+        )
+
+
+def fill_audience_counters(apps, schema_editor):
+    """
+    Заполняет счётчики аудитории по существующим клиентам.
+    """
+    Client = apps.get_model('mailing', 'Client')
+    AudienceCounter = apps.get_model('mailing', 'AudienceCounter')
+    ClientEmail = apps.get_model('mailing', 'ClientEmail')
+    AudienceCounter.objects.bulk_create(
+        AudienceCounter(key=f"clients:{row['owner_id']}", value=row['count'])
+        for row in Client.objects.values('owner_id').annotate(count=Count('id')).order_by()
+    )
+    emails = Client.objects.annotate(email_lower=Lower('email')).values('email_lower').annotate(count=Count('id'))
+    batch = []
+    for row in emails.order_by().iterator():
+        batch.append(ClientEmail(email=row['email_lower'], clients=row['count']))
+        if len(batch) == 1000:
+            ClientEmail.objects.bulk_create(batch)
+            batch = []
+    ClientEmail.objects.bulk_create(batch)
+    AudienceCounter.objects.create(key='emails', value=ClientEmail.objects.count())
+
+
+class Migration(migrations.Migration):
+    # Данные меняются в отдельных транзакциях до и после изменения схемы: в PostgreSQL отложенные
+    # триггеры внешних ключей после удаления дубликатов не дают изменить таблицу в той же транзакции
+    atomic = False
+
+    dependencies = [
+        ('mailing', '0016_client_owner_email_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AudienceCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=50, unique=True, verbose_name='Ключ')),
+                ('value', models.BigIntegerField(default=0, verbose_name='Значение')),
+            ],
+            options={
+                'verbose_name': 'Счётчик аудитории',
+                'verbose_name_plural': 'Счётчики аудитории',
+            },
+        ),
+        migrations.CreateModel(
+            name='ClientEmail',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('email', models.CharField(max_length=254, unique=True, verbose_name='Email')),
+                ('clients', models.PositiveIntegerField(default=0, verbose_name='Клиентов')),
+            ],
+            options={
+                'verbose_name': 'Адрес клиентов',
+                'verbose_name_plural': 'Адреса клиентов',
+            },
+        ),
+        migrations.RunPython(merge_duplicate_clients, migrations.RunPython.noop, atomic=True),
+        migrations.RemoveIndex(
+            model_name='client',
+            name='client_owner_email_idx',
+        ),
+        migrations.AddConstraint(
+            model_name='client',
+            constraint=models.UniqueConstraint(models.F('owner'), django.db.models.functions.text.Lower('email'), name='client_owner_email_unique', violation_error_message='Клиент с таким email уже есть'),
+        ),
+        migrations.RunPython(fill_audience_counters, migrations.RunPython.noop, atomic=True),
+    ]
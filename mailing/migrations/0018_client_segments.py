@@ -0,0 +1,66 @@
+# Generated by Django 4.2.2 on 2026-10-17 22:44
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('mailing', '0017_client_audience'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Segment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, verbose_name='Название')),
+                ('tag', models.CharField(blank=True, max_length=50, verbose_name='Метка клиента')),
+                ('comment_contains', models.CharField(blank=True, max_length=255, verbose_name='Комментарий содержит')),
+                ('created_from', models.DateTimeField(blank=True, null=True, verbose_name='Добавлен не раньше')),
+                ('created_to', models.DateTimeField(blank=True, null=True, verbose_name='Добавлен не позже')),
+            ],
+            options={
+                'verbose_name': 'Сегмент',
+                'verbose_name_plural': 'Сегменты',
+            },
+        ),
+        migrations.AddField(
+            model_name='client',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now, verbose_name='Добавлен'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='client',
+            name='tag',
+            field=models.CharField(blank=True, max_length=50, verbose_name='Метка'),
+        ),
+        migrations.AlterField(
+            model_name='mailing',
+            name='clients',
+            field=models.ManyToManyField(blank=True, to='mailing.client'),
+        ),
+        migrations.AddIndex(
+            model_name='client',
+            index=models.Index(fields=['owner', 'tag'], name='client_owner_tag_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='client',
+            index=models.Index(fields=['owner', 'created_at'], name='client_owner_created_idx'),
+        ),
+        migrations.AddField(
+            model_name='segment',
+            name='owner',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='Собственник сегмента'),
+        ),
+        migrations.AddField(
+            model_name='mailing',
+            name='segment',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='mailing.segment', verbose_name='Сегмент'),
+        ),
+    ]
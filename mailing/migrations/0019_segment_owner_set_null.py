@@ -0,0 +1,21 @@
+# Generated by Django 4.2.2 on 2026-10-17 23:08
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('mailing', '0018_client_segments'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='segment',
+            name='owner',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL, verbose_name='Собственник сегмента'),
+        ),
+    ]
@@ -0,0 +1,89 @@
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives
+from django.core.mail.message import sanitize_address
+
+
+class PreparedMessage:
+    """
+    Неизменная часть письма рассылки: заголовки и закодированные текстовая и HTML-версии,
+    сериализованные в байты один раз. Для каждого получателя к ним дописываются только
+    заголовки To и Message-ID, без повторного кодирования MIME.
+
+    Атрибуты:
+    - payload (bytes): Письмо без заголовков To и Message-ID с переводами строк CRLF.
+    """
+
+    def __init__(self, subject, body, from_email, html=None):
+        message = EmailMultiAlternatives(subject=subject, body=body, from_email=from_email)
+        if html:
+            message.attach_alternative(html, 'text/html')
+        mime = message.message()
+        del mime['To']
+        del mime['Message-ID']
+        self.payload = mime.as_bytes(linesep='\r\n')
+
+    def render(self, to, message_id):
+        """
+        Возвращает письмо в байтах с заголовками To и Message-ID для отправки по SMTP.
+        """
+        return b'To: %s\r\nMessage-ID: %s\r\n%s' % (to.encode(), message_id.encode(), self.payload)
+
+
+class PreparedEmailMessage(EmailMultiAlternatives):
+    """
+    Письмо рассылки, текст которого уже сериализован в PreparedMessage.
+
+    SMTP-отправка берёт готовые байты через message_bytes, остальные почтовые бэкенды
+    (например, locmem) работают с ним как с обычным EmailMessage.
+    """
+
+    def __init__(self, prepared, **kwargs):
+        super().__init__(**kwargs)
+        self.prepared = prepared
+
+    def as_bytes(self):
+        encoding = self.encoding or settings.DEFAULT_CHARSET
+        to = self.extra_headers.get('To') or ', '.join(sanitize_address(address, encoding) for address in self.to)
+        return self.prepared.render(to, self.extra_headers['Message-ID'])
+
+
+def message_bytes(message):
+    """
+    Возвращает письмо в байтах для передачи SMTP-сессии: готовые байты подготовленного письма
+    или результат обычной сериализации MIME.
+    """
+    if isinstance(message, PreparedEmailMessage):
+        return message.as_bytes()
+    return message.message().as_bytes(linesep='\r\n')
+
+
+# Сколько подготовленных писем хранится в памяти процесса
+CACHE_SIZE = 256
+
+_prepared = OrderedDict()
+_prepared_lock = threading.Lock()
+
+
+def prepare_message(mailing, compiled):
+    """
+    Возвращает подготовленное письмо рассылки без подстановок (см. personalize.CompiledMessage).
+
+    Письмо сериализуется один раз на прогон рассылки: в ключ кэша входят рассылка, номер прогона
+    и версия сообщения (id, updated_at), поэтому заголовок Date обновляется с каждым прогоном.
+    """
+    key = (mailing.pk, mailing.run, mailing.message.pk, mailing.message.updated_at)
+    with _prepared_lock:
+        prepared = _prepared.get(key)
+        if prepared is not None:
+            _prepared.move_to_end(key)
+            return prepared
+    html = compiled.html.source if compiled.html else None
+    prepared = PreparedMessage(compiled.subject.source, compiled.body.source, settings.EMAIL_HOST_USER, html)
+    with _prepared_lock:
+        _prepared[key] = prepared
+        if len(_prepared) > CACHE_SIZE:
+            _prepared.popitem(last=False)
+    return prepared
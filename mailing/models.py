@@ -1,4 +1,9 @@
+import random
+from datetime import timedelta
+
+from django.conf import settings
 from django.db import models
+from django.db.models.functions import Lower
 from users.models import Users
 
 NULLABLE = {'blank': True, 'null': True}
@@ -13,12 +18,22 @@ class Client(models.Model):
     - full_name (CharField): Полное имя клиента (ФИО).
     - comment (TextField): Комментарий о клиенте. Может быть пустым.
     - owner (ForeignKey): Владелец клиента, связанный с моделью пользователя (Users). Может быть пустым.
+    - created_at (DateTimeField): Время добавления клиента.
+    - tag (CharField): Метка для отбора клиентов в сегменты (см. Segment). Может быть пустой.
+
+    Адрес уникален среди клиентов одного владельца без учёта регистра: уникальный индекс
+    (владелец, lower(email)) также ищет уже существующих клиентов при импорте (см. importer.ClientImporter).
+    Счётчики аудитории обновляются сигналами при сохранении и удалении клиента (см. audience.change_clients).
+    QuerySet.update() и bulk_update сигналов не отправляют, поэтому код, меняющий так владельца или адрес
+    клиентов, должен сам вызвать audience.change_clients.
     """
     objects = None
     email = models.EmailField()
     full_name = models.CharField(max_length=100, verbose_name='ФИО', help_text='Введите ФИО')
     comment = models.TextField(**NULLABLE)
     owner = models.ForeignKey(Users, verbose_name='Собственник клиента', **NULLABLE, on_delete=models.SET_NULL)
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Добавлен')
+    tag = models.CharField(max_length=50, blank=True, verbose_name='Метка')
 
     class Meta:
         verbose_name = 'Клиент'
@@ -26,6 +41,63 @@ class Client(models.Model):
         permissions = [
             ("watch-list-client", "Может просматривать список пользователей сервиса."),
         ]
+        constraints = [
+            models.UniqueConstraint(
+                'owner', Lower('email'),
+                name='client_owner_email_unique',
+                violation_error_message='Клиент с таким email уже есть',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['owner', 'tag'], name='client_owner_tag_idx'),
+            models.Index(fields=['owner', 'created_at'], name='client_owner_created_idx'),
+        ]
+
+    def __str__(self):
+        return self.email
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Запоминаем владельца и адрес, чтобы при сохранении обновить счётчики аудитории
+        instance._loaded_audience = (instance.__dict__.get('owner_id'), instance.__dict__.get('email'))
+        return instance
+
+
+class AudienceCounter(models.Model):
+    """
+    Поддерживаемый счётчик аудитории для главной страницы: чтение — один запрос по ключу вместо подсчёта по таблице.
+
+    Атрибуты:
+    - key (CharField): Ключ счётчика: 'emails' — уникальные адреса, 'clients:<id владельца>' — клиенты владельца.
+    - value (BigIntegerField): Значение счётчика.
+    """
+    key = models.CharField(max_length=50, unique=True, verbose_name='Ключ')
+    value = models.BigIntegerField(default=0, verbose_name='Значение')
+
+    class Meta:
+        verbose_name = 'Счётчик аудитории'
+        verbose_name_plural = 'Счётчики аудитории'
+
+    def __str__(self):
+        return f"{self.key}: {self.value}"
+
+
+class ClientEmail(models.Model):
+    """
+    Количество клиентов с адресом email (в нижнем регистре) у всех владельцев.
+    Адрес считается в счётчике уникальных адресов, пока у него есть хотя бы один клиент.
+
+    Атрибуты:
+    - email (CharField): Адрес в нижнем регистре.
+    - clients (PositiveIntegerField): Сколько клиентов с этим адресом.
+    """
+    email = models.CharField(max_length=254, unique=True, verbose_name='Email')
+    clients = models.PositiveIntegerField(default=0, verbose_name='Клиентов')
+
+    class Meta:
+        verbose_name = 'Адрес клиентов'
+        verbose_name_plural = 'Адреса клиентов'
 
     def __str__(self):
         return self.email
@@ -38,12 +110,20 @@ class Message(models.Model):
     Атрибуты:
     - subject (CharField): Тема сообщения.
     - body (TextField): Тело сообщения.
+    - html_body (TextField): HTML-версия тела сообщения. Если задана, письмо отправляется
+      в двух вариантах: текстовом и HTML. Может быть пустой.
     - owner (ForeignKey): Владелец сообщения, связанный с моделью пользователя (Users). Может быть пустым.
+    - updated_at (DateTimeField): Время последнего изменения. Вместе с id служит ключом кэша
+      скомпилированных шаблонов (см. personalize.compile_message) и подготовленных писем (см. mime.prepare_message).
+
+    Тема, тело и HTML-версия могут содержать подстановки {{ full_name }} и {{ email }} — поля клиента-получателя.
     """
     objects = None
     subject = models.CharField(max_length=255)
     body = models.TextField()
+    html_body = models.TextField(verbose_name='HTML-текст', **NULLABLE)
     owner = models.ForeignKey(Users, verbose_name='Собственник сообщения', **NULLABLE, on_delete=models.SET_NULL)
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Изменено')
 
     class Meta:
         verbose_name = 'Сообщение'
@@ -53,6 +133,54 @@ class Message(models.Model):
         return self.subject
 
 
+class Segment(models.Model):
+    """
+    Сохранённый фильтр клиентов владельца, на который можно направить рассылку вместо выбора клиентов вручную.
+
+    Клиенты сегмента отбираются запросом при каждой отправке, поэтому рассылка на сегмент — одна строка
+    в базе независимо от числа получателей, и новые клиенты, подходящие под фильтр, попадают в следующие отправки.
+
+    Атрибуты:
+    - name (CharField): Название сегмента.
+    - owner (ForeignKey): Владелец сегмента; в сегмент попадают только его клиенты. Сегмент без владельца пуст.
+    - tag (CharField): Метка клиента. Пустая — без отбора по метке.
+    - comment_contains (CharField): Подстрока комментария клиента без учёта регистра. Пустая — без отбора.
+    - created_from (DateTimeField): Клиенты, добавленные не раньше этого времени. Может быть пустым.
+    - created_to (DateTimeField): Клиенты, добавленные не позже этого времени. Может быть пустым.
+    """
+    name = models.CharField(max_length=100, verbose_name='Название')
+    owner = models.ForeignKey(Users, verbose_name='Собственник сегмента', **NULLABLE, on_delete=models.SET_NULL)
+    tag = models.CharField(max_length=50, blank=True, verbose_name='Метка клиента')
+    comment_contains = models.CharField(max_length=255, blank=True, verbose_name='Комментарий содержит')
+    created_from = models.DateTimeField(**NULLABLE, verbose_name='Добавлен не раньше')
+    created_to = models.DateTimeField(**NULLABLE, verbose_name='Добавлен не позже')
+
+    class Meta:
+        verbose_name = 'Сегмент'
+        verbose_name_plural = 'Сегменты'
+
+    def __str__(self):
+        return self.name
+
+    def get_clients(self):
+        """
+        Возвращает queryset клиентов, подходящих под фильтр сегмента.
+        """
+        if self.owner_id is None:
+            # Владелец удалён: клиенты без владельца не должны попадать в чужую рассылку
+            return Client.objects.none()
+        clients = Client.objects.filter(owner_id=self.owner_id)
+        if self.tag:
+            clients = clients.filter(tag=self.tag)
+        if self.comment_contains:
+            clients = clients.filter(comment__icontains=self.comment_contains)
+        if self.created_from:
+            clients = clients.filter(created_at__gte=self.created_from)
+        if self.created_to:
+            clients = clients.filter(created_at__lte=self.created_to)
+        return clients
+
+
 class Mailing(models.Model):
     """
     Модель, представляющая рассылку.
@@ -63,8 +191,17 @@ class Mailing(models.Model):
     - periodicity (CharField): Периодичность рассылки (ежедневная, еженедельная, ежемесячная).
     - status (CharField): Статус рассылки (создана, начата, завершена).
     - message (ForeignKey): Сообщение, связанное с рассылкой.
-    - clients (ManyToManyField): Клиенты, которым будет отправлена рассылка.
+    - clients (ManyToManyField): Клиенты, которым будет отправлена рассылка, если не задан сегмент.
+    - segment (ForeignKey): Сегмент, клиентам которого отправляется рассылка вместо clients. Может быть пустым.
     - owner (ForeignKey): Владелец рассылки, связанный с моделью пользователя (Users). Может быть пустым.
+    - next_send_at (DateTimeField): Время следующей отправки. Пересчитывается при создании рассылки,
+      после каждой попытки отправки и при изменении расписания.
+    - run (PositiveIntegerField): Номер текущего прогона. Увеличивается, когда созданная рассылка
+      начинает отправку; повторы неудачной попытки относятся к тому же прогону.
+    - lease_until (DateTimeField): До какого времени рассылка захвачена обработчиком. Может быть пустым.
+    - leased_by (CharField): Идентификатор обработчика, захватившего рассылку.
+    - retry_count (PositiveSmallIntegerField): Сколько раз подряд попытка отправки завершилась
+      временными ошибками. Определяет задержку следующего повтора.
     """
     DAILY = 'D'
     WEEKLY = 'W'
@@ -74,6 +211,11 @@ class Mailing(models.Model):
         (WEEKLY, 'Еженедельно'),
         (MONTHLY, 'Ежемесячно'),
     ]
+    PERIODS = {
+        DAILY: timedelta(days=1),
+        WEEKLY: timedelta(weeks=1),
+        MONTHLY: timedelta(weeks=4),
+    }
 
     CREATED = 'CREATED'
     STARTED = 'STARTED'
@@ -91,8 +233,14 @@ class Mailing(models.Model):
     periodicity = models.CharField(max_length=1, choices=PERIODICITY_CHOICES)
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=CREATED)
     message = models.ForeignKey(Message, on_delete=models.CASCADE)
-    clients = models.ManyToManyField(Client)
+    clients = models.ManyToManyField(Client, blank=True)
+    segment = models.ForeignKey(Segment, verbose_name='Сегмент', **NULLABLE, on_delete=models.PROTECT)
     owner = models.ForeignKey(Users, verbose_name='Собственник рассылки', null=True, blank=True, on_delete=models.SET_NULL)
+    next_send_at = models.DateTimeField(null=True, blank=True, editable=False, verbose_name="Время следующей отправки")
+    run = models.PositiveIntegerField(default=0, editable=False, verbose_name="Номер прогона")
+    lease_until = models.DateTimeField(null=True, blank=True, editable=False, verbose_name="Захвачена до")
+    leased_by = models.CharField(max_length=100, blank=True, editable=False, verbose_name="Захвачена обработчиком")
+    retry_count = models.PositiveSmallIntegerField(default=0, editable=False, verbose_name="Повторов подряд")
 
     class Meta:
         verbose_name = 'Рассылка'
@@ -101,10 +249,64 @@ class Mailing(models.Model):
             ("watch_mailings", "Может просматривать любые рассылки"),
             ("deactivate_mailings", "Может отключать рассылки"),
         ]
+        indexes = [
+            # Планировщик выбирает только активные рассылки, поэтому индекс частичный
+            models.Index(
+                fields=['next_send_at'],
+                name='mailing_due_idx',
+                condition=models.Q(status__in=['CREATED', 'STARTED']),
+            ),
+        ]
 
     def __str__(self):
         return f"{self.message.subject} - {self.start_datetime}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Запоминаем расписание, чтобы при сохранении заметить его изменение
+        instance._loaded_schedule = (instance.__dict__.get('start_datetime'), instance.__dict__.get('periodicity'))
+        return instance
+
+    def get_clients(self):
+        """
+        Возвращает queryset клиентов рассылки: клиентов сегмента, если он задан, иначе выбранных вручную.
+        """
+        if self.segment_id is not None:
+            return self.segment.get_clients()
+        return self.clients.all()
+
+    def get_next_send_at(self, last_sent_at=None):
+        """
+        Возвращает время следующей отправки после попытки в last_sent_at
+        или время начала рассылки, если попыток ещё не было.
+        """
+        if last_sent_at is None:
+            return self.start_datetime
+        return last_sent_at + self.PERIODS.get(self.periodicity, timedelta(0))
+
+    def get_retry_at(self, failed_at):
+        """
+        Возвращает время повтора после retry_count неудачных попыток подряд: задержка растёт
+        экспоненциально от MAILING_RETRY_BASE_SECONDS до MAILING_RETRY_MAX_SECONDS, а случайная
+        добавка разносит повторы рассылок, упавших одновременно.
+        """
+        delay = min(settings.MAILING_RETRY_BASE_SECONDS * 2 ** max(self.retry_count - 1, 0),
+                    settings.MAILING_RETRY_MAX_SECONDS)
+        return failed_at + timedelta(seconds=delay / 2 + random.uniform(0, delay / 2))
+
+    def save(self, *args, **kwargs):
+        """
+        При создании рассылки и при изменении её расписания пересчитывает next_send_at.
+        """
+        if self._state.adding:
+            self.next_send_at = self.get_next_send_at()
+        elif getattr(self, '_loaded_schedule', None) != (self.start_datetime, self.periodicity):
+            last_attempt = self.attempts.order_by('-attempt_datetime').first()
+            self.next_send_at = self.get_next_send_at(last_attempt.attempt_datetime if last_attempt else None)
+        self._loaded_schedule = (self.start_datetime, self.periodicity)
+        super().save(*args, **kwargs)
+
 
 class MailingAttempt(models.Model):
     """
@@ -130,3 +332,78 @@ class MailingAttempt(models.Model):
 
     def __str__(self):
         return f"{self.mailing} - {self.attempt_datetime}"
+
+
+class MailingDelivery(models.Model):
+    """
+    Модель, представляющая журнал доставки письма рассылки одному клиенту в рамках прогона.
+
+    Атрибуты:
+    - mailing (ForeignKey): Рассылка, письмо которой отправлялось.
+    - client (ForeignKey): Клиент-получатель письма.
+    - run (PositiveIntegerField): Номер прогона рассылки (см. Mailing.run).
+    - status (PositiveSmallIntegerField): Код статуса доставки. Письма со статусом FAILED (временная
+      ошибка, код 4xx или обрыв соединения) отправляются повторно, REJECTED (код 5xx) — нет.
+      DEFERRED — письмо не отправлялось, потому что SMTP-релей недоступен.
+    - reply_code (PositiveSmallIntegerField): Код ответа SMTP-сервера. Может быть пустым.
+    """
+    SENT = 1
+    FAILED = 2
+    REJECTED = 3
+    DEFERRED = 4
+    STATUS_CHOICES = [
+        (SENT, 'Доставлено'),
+        (FAILED, 'Не доставлено'),
+        (REJECTED, 'Отклонено'),
+        (DEFERRED, 'Отложено'),
+    ]
+    # Статусы, после которых письмо клиенту в этом прогоне больше не отправляется
+    FINAL_STATUSES = [SENT, REJECTED]
+
+    mailing = models.ForeignKey(Mailing, on_delete=models.CASCADE, related_name='deliveries')
+    client = models.ForeignKey(Client, on_delete=models.CASCADE, related_name='deliveries')
+    run = models.PositiveIntegerField(verbose_name='Прогон')
+    status = models.PositiveSmallIntegerField(choices=STATUS_CHOICES, verbose_name='Статус')
+    reply_code = models.PositiveSmallIntegerField(**NULLABLE, verbose_name='Код ответа сервера')
+
+    class Meta:
+        verbose_name = 'Доставка'
+        verbose_name_plural = 'Доставки'
+        indexes = [
+            # Получатели прогона с заданным статусом, например неудачные для повтора
+            models.Index(fields=['mailing', 'run', 'status'], name='delivery_run_status_idx'),
+        ]
+        constraints = [
+            # Ключ идемпотентности: одному клиенту в прогоне соответствует одна запись
+            models.UniqueConstraint(fields=['mailing', 'run', 'client'], name='delivery_idempotency_key'),
+        ]
+
+    def __str__(self):
+        return f"{self.mailing} - {self.client}"
+
+
+class DispatcherHeartbeat(models.Model):
+    """
+    Модель, представляющая отметку работоспособности обработчика рассылок (команда run_dispatcher).
+
+    Атрибуты:
+    - worker_id (CharField): Идентификатор обработчика (имя хоста и PID).
+    - host (CharField): Имя хоста обработчика.
+    - pid (PositiveIntegerField): PID процесса обработчика.
+    - started_at (DateTimeField): Время запуска обработчика.
+    - last_seen (DateTimeField): Время последней отметки. Устаревшая отметка означает, что обработчик не работает.
+    - in_flight (PositiveIntegerField): Сколько рассылок обработчик отправляет в данный момент.
+    """
+    worker_id = models.CharField(max_length=100, unique=True, verbose_name='Обработчик')
+    host = models.CharField(max_length=255, verbose_name='Хост')
+    pid = models.PositiveIntegerField(verbose_name='PID')
+    started_at = models.DateTimeField(verbose_name='Запущен')
+    last_seen = models.DateTimeField(verbose_name='Последняя отметка')
+    in_flight = models.PositiveIntegerField(default=0, verbose_name='Рассылок в работе')
+
+    class Meta:
+        verbose_name = 'Обработчик рассылок'
+        verbose_name_plural = 'Обработчики рассылок'
+
+    def __str__(self):
+        return self.worker_id
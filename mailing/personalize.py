@@ -0,0 +1,104 @@
+import re
+import threading
+from collections import OrderedDict
+from operator import attrgetter
+
+from django.utils.html import escape
+
+# Подстановки вида {{ full_name }}; в письме заменяются полями клиента из FIELDS
+PLACEHOLDER = re.compile(r'{{\s*(\w+)\s*}}')
+FIELDS = ('full_name', 'email')
+
+
+class CompiledTemplate:
+    """
+    Шаблон темы или текста сообщения, скомпилированный в строку формата с позициями для полей клиента.
+
+    Отрисовка для получателя — одна подстановка значений в строку формата, без разбора шаблона.
+    Неизвестные подстановки остаются в тексте как есть.
+
+    Атрибуты:
+    - source (str): Исходный текст шаблона.
+    - fields (tuple): Поля клиента в порядке их подстановки.
+    - escape (callable): Экранирование подставляемых значений, например django.utils.html.escape
+      для HTML-версии, или None.
+    """
+
+    def __init__(self, source, escape=None):
+        self.source = source
+        self.escape = escape
+        pieces, fields, position = [], [], 0
+        for match in PLACEHOLDER.finditer(source):
+            if match.group(1) not in FIELDS:
+                continue
+            pieces.append(source[position:match.start()].replace('%', '%%'))
+            pieces.append('%s')
+            fields.append(match.group(1))
+            position = match.end()
+        pieces.append(source[position:].replace('%', '%%'))
+        self.fields = tuple(fields)
+        self._format = ''.join(pieces)
+        if len(fields) == 1:
+            getter = attrgetter(fields[0])
+            self._values = lambda client: (getter(client),)
+        elif fields:
+            self._values = attrgetter(*fields)
+        if fields and escape is not None:
+            values = self._values
+            self._values = lambda client: tuple(escape(value) for value in values(client))
+
+    def render(self, client):
+        """
+        Возвращает текст шаблона с подставленными полями клиента.
+        """
+        if not self.fields:
+            return self.source
+        return self._format % self._values(client)
+
+
+class CompiledMessage:
+    """
+    Скомпилированные тема, текст и HTML-версия сообщения.
+
+    Атрибуты:
+    - subject (CompiledTemplate): Шаблон темы.
+    - body (CompiledTemplate): Шаблон текста.
+    - html (CompiledTemplate): Шаблон HTML-версии или None, если её нет. Поля клиента (например, имена
+      из импортированных списков) подставляются в неё экранированными, чтобы не внедрить разметку в письмо.
+    - personalized (bool): Есть ли в сообщении подстановки. Письмо без подстановок
+      одинаково для всех получателей и может отправляться пачкой сразу нескольким.
+    """
+
+    def __init__(self, message):
+        self.subject = CompiledTemplate(message.subject)
+        self.body = CompiledTemplate(message.body)
+        self.html = CompiledTemplate(message.html_body, escape=escape) if message.html_body else None
+        self.personalized = bool(self.subject.fields or self.body.fields or (self.html and self.html.fields))
+
+
+# Сколько скомпилированных сообщений хранится в памяти процесса
+CACHE_SIZE = 1024
+
+_compiled = OrderedDict()
+_compiled_lock = threading.Lock()
+
+
+def compile_message(message):
+    """
+    Возвращает скомпилированное сообщение. Сообщение компилируется один раз и хранится в кэше
+    по ключу (id, updated_at), поэтому изменённое сообщение компилируется заново.
+    """
+    if message.pk is None:
+        return CompiledMessage(message)
+    key = (message.pk, message.updated_at)
+    with _compiled_lock:
+        compiled = _compiled.get(key)
+        if compiled is not None:
+            _compiled.move_to_end(key)
+            return compiled
+    compiled = CompiledMessage(message)
+    with _compiled_lock:
+        _compiled[key] = compiled
+        if len(_compiled) > CACHE_SIZE:
+            _compiled.popitem(last=False)
+    return compiled
@@ -0,0 +1,217 @@
+import smtplib
+import threading
+import time
+from queue import LifoQueue, Empty
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.core.mail.message import sanitize_address
+
+from .breaker import get_breaker
+from .metrics import PHASE_SECONDS
+from .mime import message_bytes
+
+# Ошибки, после которых соединение считается потерянным и открывается заново. OSError целиком сюда
+# не входит: smtplib.SMTPException — его подкласс, а ответ сервера с отказом не означает обрыва
+RECONNECT_ERRORS = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, TimeoutError, ConnectionError)
+
+
+class SMTPConnectionPool:
+    """
+    Ограниченный пул открытых и авторизованных SMTP-соединений.
+
+    Соединения переживают как отдельные рассылки, так и тики планировщика, поэтому
+    TLS-рукопожатие и авторизация выполняются один раз на соединение, а не на каждое письмо.
+    Перед выдачей простаивавшее соединение проверяется командой NOOP, устаревшие и
+    оборванные соединения закрываются и открываются заново. Ошибки соединения учитываются
+    автоматическим выключателем: пока релей недоступен, письма сразу получают CircuitOpenError.
+
+    Атрибуты:
+    - size (int): Максимальное количество одновременно открытых соединений.
+    - max_idle (int): Сколько секунд соединение может простаивать в пуле.
+    - batch_size (int): Сколько писем отправляется через одно соединение за раз.
+    - breaker (CircuitBreaker): Выключатель релея, по умолчанию общий для процесса.
+    """
+
+    def __init__(self, size=None, max_idle=None, batch_size=None, backend=None, breaker=None, **backend_kwargs):
+        self.breaker = breaker or get_breaker()
+        self.size = size or settings.MAILING_SMTP_POOL_SIZE
+        self.max_idle = max_idle or settings.MAILING_SMTP_POOL_MAX_IDLE
+        self.batch_size = batch_size or settings.MAILING_SMTP_BATCH_SIZE
+        self._backend = backend
+        self._backend_kwargs = backend_kwargs
+        self._idle = LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.size)
+
+    def _connect(self):
+        with PHASE_SECONDS.time(phase='connect'):
+            connection = get_connection(self._backend, fail_silently=False, **self._backend_kwargs)
+            connection.open()
+        return connection
+
+    @staticmethod
+    def _close(connection):
+        if connection is None:
+            return
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    @staticmethod
+    def _is_alive(connection):
+        """
+        Проверяет соединение командой NOOP. Бэкенды без сокета (locmem, console) всегда живы.
+        """
+        if not hasattr(connection, 'connection'):
+            return True
+        if connection.connection is None:
+            return False
+        try:
+            return connection.connection.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def _checkout(self):
+        while True:
+            try:
+                connection, released_at = self._idle.get_nowait()
+            except Empty:
+                # Новое соединение откроется лениво при первой отправке
+                return None
+            if time.monotonic() - released_at < self.max_idle and self._is_alive(connection):
+                return connection
+            self._close(connection)
+
+    def _checkin(self, connection):
+        if connection is not None:
+            self._idle.put((connection, time.monotonic()))
+
+    @staticmethod
+    def _deliver(connection, message):
+        """
+        Отправляет письмо всем его получателям одной SMTP-транзакцией: RCPT TO на каждого
+        получателя и один DATA. Возвращает словарь отказов {получатель: (код, ответ)}.
+
+        У SMTP-бэкенда письмо отправляется напрямую через smtplib, чтобы получить отказы
+        по отдельным получателям. Остальные бэкенды отправляют письмо целиком.
+        """
+        smtp = getattr(connection, 'connection', None)
+        if smtp is None:
+            connection.send_messages([message])
+            return {}
+        encoding = message.encoding or settings.DEFAULT_CHARSET
+        recipients = [sanitize_address(address, encoding) for address in message.recipients()]
+        try:
+            refused = smtp.sendmail(
+                sanitize_address(message.from_email, encoding),
+                recipients,
+                message_bytes(message),
+            )
+        except smtplib.SMTPRecipientsRefused as error:
+            refused = error.recipients  # отказано всем получателям
+        return {original: refused[address] for original, address in zip(message.recipients(), recipients)
+                if address in refused}
+
+    def _send(self, connection, message):
+        """
+        Отправляет одно письмо, один раз переподключаясь при обрыве соединения.
+        Возвращает пару (соединение, список ошибок или None по получателям письма).
+
+        Отказ сервера (код 4xx или 5xx) не повторяется и не считается ошибкой релея: соединение
+        исправно, а повтор на новом соединении мог бы доставить письмо дважды.
+        """
+        recipients = message.recipients()
+        for can_retry in (True, False):
+            if not self.breaker.allow():
+                return connection, [self.breaker.error()] * len(recipients)
+            try:
+                if connection is None:
+                    connection = self._connect()
+                with PHASE_SECONDS.time(phase='send'):
+                    refused = self._deliver(connection, message)
+                self.breaker.success()
+                return connection, [
+                    smtplib.SMTPRecipientsRefused({recipient: refused[recipient]}) if recipient in refused else None
+                    for recipient in recipients
+                ]
+            except RECONNECT_ERRORS as error:
+                # Проверяется до SMTPResponseException: SMTPConnectError — его подкласс
+                self.breaker.failure()
+                self._close(connection)
+                connection = None
+                if not can_retry:
+                    return connection, [error] * len(recipients)
+            except smtplib.SMTPResponseException as error:
+                self.breaker.success()  # сервер ответил отказом, значит релей доступен
+                return connection, [error] * len(recipients)
+            except OSError as error:
+                # Релей недоступен по сети, например не резолвится его имя
+                self.breaker.failure()
+                self._close(connection)
+                return None, [error] * len(recipients)
+            except Exception as error:
+                self.breaker.success()  # сервер ответил отказом, значит релей доступен
+                return connection, [error] * len(recipients)
+
+    def send_messages(self, messages, before_send=None):
+        """
+        Отправляет письма пачками по batch_size через соединения из пула.
+
+        Если задан before_send, он вызывается перед отправкой каждого письма, например
+        чтобы дождаться разрешения ограничителя скорости.
+
+        Возвращает по одному элементу на каждого получателя каждого письма по порядку:
+        None для доставленного письма или исключение, из-за которого письмо не ушло.
+        """
+        messages = list(messages)
+        errors = []
+        for start in range(0, len(messages), self.batch_size):
+            with self._slots:
+                connection = self._checkout()
+                try:
+                    for message in messages[start:start + self.batch_size]:
+                        if before_send is not None:
+                            before_send(message)
+                        connection, message_errors = self._send(connection, message)
+                        errors.extend(message_errors)
+                finally:
+                    self._checkin(connection)
+        return errors
+
+    def close(self):
+        """
+        Закрывает все простаивающие соединения.
+        """
+        while True:
+            try:
+                connection, _ = self._idle.get_nowait()
+            except Empty:
+                return
+            self._close(connection)
+
+
+_pools = {}
+_pool_lock = threading.Lock()
+
+
+def get_pool(relay=None):
+    """
+    Возвращает общий для процесса пул соединений, создавая его при первом обращении.
+
+    Без relay пул использует почтовый бэкенд и релей из настроек EMAIL_*, иначе — SMTP-соединения
+    с релеем "хост:порт", который вернул резолвер доменов (см. domains.resolve_relay).
+    """
+    with _pool_lock:
+        if relay not in _pools:
+            if relay is None:
+                _pools[relay] = SMTPConnectionPool()
+            else:
+                host, _, port = relay.rpartition(':')
+                _pools[relay] = SMTPConnectionPool(
+                    backend='django.core.mail.backends.smtp.EmailBackend',
+                    breaker=get_breaker(relay),
+                    host=host,
+                    port=int(port),
+                )
+        return _pools[relay]
@@ -0,0 +1,164 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.redis import RedisCache
+
+from .domains import recipient_domain
+
+# Резервирует по ARGV[1] жетонов в каждом ведре KEYS и возвращает, сколько секунд ждать до отправки.
+# Далее в ARGV: скорость и ёмкость для каждого ключа по порядку. Время берётся из Redis,
+# поэтому часы разных серверов не влияют на результат.
+RESERVE_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local count = tonumber(ARGV[1])
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local burst = tonumber(ARGV[i * 2 + 1])
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or burst
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - ts) * rate) - count
+    if tokens < 0 then
+        wait = math.max(wait, -tokens / rate)
+    end
+    redis.call('HSET', key, 'tokens', tostring(tokens), 'ts', tostring(now))
+    redis.call('EXPIRE', key, math.ceil((burst - tokens) / rate) + 1)
+end
+return tostring(wait)
+"""
+
+
+class LocalBuckets:
+    """
+    Ведра жетонов в памяти процесса. Используются, если кэш не Redis (например, locmem),
+    и ограничивают скорость только внутри одного процесса.
+    """
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, buckets, count=1):
+        now = time.monotonic()
+        wait = 0
+        with self._lock:
+            for key, rate, burst in buckets:
+                tokens, ts = self._buckets.get(key, (burst, now))
+                tokens = min(burst, tokens + (now - ts) * rate) - count
+                if tokens < 0:
+                    wait = max(wait, -tokens / rate)
+                self._buckets[key] = (tokens, now)
+        return wait
+
+
+class RedisBuckets:
+    """
+    Ведра жетонов в Redis, общие для всех процессов-обработчиков. Все ведра письма
+    проверяются одним атомарным Lua-скриптом за одно обращение к Redis.
+    """
+
+    def __init__(self, client):
+        self._reserve = client.register_script(RESERVE_SCRIPT)
+
+    def reserve(self, buckets, count=1):
+        keys, args = [], [count]
+        for key, rate, burst in buckets:
+            keys.append(cache.make_key(key))
+            args.extend((rate, burst))
+        return float(self._reserve(keys=keys, args=args))
+
+
+def redis_client():
+    """
+    Возвращает клиент Redis из кэша Django (встроенный RedisCache или django-redis) либо None.
+
+    django.core.cache.cache — прокси, поэтому тип проверяется у самого бэкенда из caches.
+    """
+    backend = caches['default']
+    if isinstance(backend, RedisCache):
+        return backend._cache.get_client(write=True)
+    client = getattr(backend, 'client', None)
+    if hasattr(client, 'get_client'):
+        return client.get_client(write=True)
+    return None
+
+
+class RateLimiter:
+    """
+    Ограничивает скорость отправки ведрами жетонов на SMTP-релей, домен получателя и владельца рассылки.
+
+    Перед каждым письмом резервируется по жетону на получателя в каждом ведре и возвращается время ожидания,
+    поэтому отправка идёт с максимальной разрешённой скоростью без превышения лимитов.
+    Скорость задаётся в письмах в секунду, 0 — без ограничения. Ёмкость ведра равна
+    скорости, умноженной на burst_seconds.
+
+    Атрибуты:
+    - relay_rate (float): Скорость отправки через один SMTP-релей.
+    - domain_rate (float): Скорость отправки на один домен получателей.
+    - domain_rates (dict): Скорость для отдельных доменов, например {'gmail.com': 20}.
+    - owner_rate (float): Скорость отправки рассылок одного владельца.
+    - burst_seconds (float): За сколько секунд скорости накапливается запас жетонов.
+    """
+
+    def __init__(self, relay_rate=None, domain_rate=None, domain_rates=None, owner_rate=None,
+                 burst_seconds=None, store=None):
+        self.relay_rate = settings.MAILING_RELAY_RATE if relay_rate is None else relay_rate
+        self.domain_rate = settings.MAILING_DOMAIN_RATE if domain_rate is None else domain_rate
+        self.domain_rates = settings.MAILING_DOMAIN_RATES if domain_rates is None else domain_rates
+        self.owner_rate = settings.MAILING_OWNER_RATE if owner_rate is None else owner_rate
+        self.burst_seconds = burst_seconds or settings.MAILING_RATE_BURST_SECONDS
+        if store is None:
+            client = redis_client()
+            store = RedisBuckets(client) if client is not None else LocalBuckets()
+        self.store = store
+
+    def buckets(self, mailing, recipient, relay=None):
+        """
+        Возвращает ведра (ключ, скорость, ёмкость), через которые проходит письмо получателю recipient.
+        """
+        relay = relay or f"{settings.EMAIL_HOST}:{settings.EMAIL_PORT}"
+        domain = recipient_domain(recipient)
+        limits = [
+            (f'mailing:rate:relay:{relay}', self.relay_rate),
+            (f'mailing:rate:domain:{domain}', self.domain_rates.get(domain, self.domain_rate)),
+        ]
+        if mailing.owner_id is not None:
+            limits.append((f'mailing:rate:owner:{mailing.owner_id}', self.owner_rate))
+        return [(key, rate, max(rate * self.burst_seconds, 1)) for key, rate in limits if rate]
+
+    def reserve(self, mailing, recipient, relay=None, count=1):
+        """
+        Резервирует жетоны для письма count получателям домена адреса recipient
+        и возвращает, сколько секунд нужно подождать перед отправкой.
+        """
+        buckets = self.buckets(mailing, recipient, relay)
+        return self.store.reserve(buckets, count) if buckets else 0
+
+    def wait(self, mailing, message, relay=None):
+        """
+        Ждёт, пока письмо message рассылки mailing можно будет отправить. Все получатели
+        письма должны быть из одного домена.
+        """
+        recipients = message.recipients()
+        delay = self.reserve(mailing, recipients[0], relay, count=len(recipients))
+        if delay > 0:
+            time.sleep(delay)
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """
+    Возвращает общий для процесса ограничитель скорости, создавая его при первом обращении.
+    """
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = RateLimiter()
+        return _limiter
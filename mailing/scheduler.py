@@ -0,0 +1,186 @@
+import heapq
+import logging
+import select
+import threading
+import time
+from datetime import timedelta
+from functools import partial
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, connection
+from django.utils import timezone
+
+from .metrics import TICK_ERRORS
+from .models import Mailing
+from .tasks import get_due_mailings, send_mailing
+
+logger = logging.getLogger(__name__)
+
+# Канал Postgres LISTEN/NOTIFY, через который процессы сообщают о сохранённых рассылках
+NOTIFY_CHANNEL = 'mailing_due'
+
+
+class DispatchScheduler(threading.Thread):
+    """
+    Планировщик, который спит до ближайшего времени отправки вместо опроса базы каждую минуту.
+
+    Держит min-кучу ближайших значений next_send_at и просыпается, когда подходит первое
+    из них, когда сохраняется рассылка (сигнал post_save или Postgres NOTIFY) или, для
+    подстраховки, не реже чем раз в max_sleep секунд.
+
+    Атрибуты:
+    - tick (callable): Функция тика, возвращающая количество обработанных рассылок.
+    - max_sleep (int): Максимальное время сна в секундах.
+    - capacity (int): Сколько ближайших отправок загружается из базы в кучу.
+    """
+
+    # Через сколько секунд повторяется тик, завершившийся ошибкой
+    error_delay = 60
+
+    def __init__(self, tick=send_mailing, max_sleep=None, capacity=None):
+        super().__init__(name='mailing-scheduler', daemon=True)
+        self.tick = tick
+        self.max_sleep = max_sleep or settings.MAILING_SCHEDULER_MAX_SLEEP
+        self.capacity = capacity or settings.MAILING_SCHEDULER_HEAP_SIZE
+        self._heap = []
+        self._refill = True
+        self._stopping = False
+        self._condition = threading.Condition()
+
+    def schedule(self, when, pk=0):
+        """
+        Добавляет время отправки в кучу и будит планировщик, чтобы он пересчитал время сна.
+        """
+        with self._condition:
+            heapq.heappush(self._heap, (when, pk))
+            self._condition.notify()
+
+    def wake(self):
+        """
+        Будит планировщик и заставляет его перечитать ближайшие отправки из базы.
+        """
+        with self._condition:
+            self._refill = True
+            self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+
+    def run(self):
+        while not self._stopping:
+            if self._refill:
+                self._load()
+            if self._wait():
+                self._run_tick()
+        close_old_connections()
+
+    def _load(self):
+        """
+        Загружает подошедшую рассылку, ближайшие отправки по индексу next_send_at и ближайшее окончание аренды.
+        """
+        self._refill = False
+        now = timezone.now()
+        try:
+            active = Mailing.objects.filter(status__in=[Mailing.CREATED, Mailing.STARTED])
+            # Подошедшие, но не захваченные рассылки (например, созданные без уведомления) отправляются сразу
+            upcoming = list(get_due_mailings(now).order_by('next_send_at').values_list('next_send_at', 'pk')[:1])
+            upcoming += active.filter(next_send_at__gt=now).order_by('next_send_at').values_list('next_send_at', 'pk')[:self.capacity]
+            # Рассылка, захваченная другим обработчиком, снова станет доступна после окончания аренды
+            upcoming += active.filter(lease_until__gt=now).order_by('lease_until').values_list('lease_until', 'pk')[:1]
+        except DatabaseError:
+            logger.exception('Не удалось загрузить расписание рассылок')
+            close_old_connections()
+            upcoming = [(now + timedelta(seconds=self.max_sleep), 0)]
+        with self._condition:
+            entries = set(upcoming) | {entry for entry in self._heap if entry[0] > now}
+            self._heap = heapq.nsmallest(self.capacity, entries)
+
+    def _wait(self):
+        """
+        Спит до ближайшей отправки. Возвращает True, если пора выполнить тик.
+        """
+        with self._condition:
+            while not self._stopping and not self._refill:
+                now = timezone.now()
+                if self._heap and self._heap[0][0] <= now:
+                    while self._heap and self._heap[0][0] <= now:
+                        heapq.heappop(self._heap)
+                    return True
+                timeout = self.max_sleep
+                if self._heap:
+                    timeout = min(timeout, (self._heap[0][0] - now).total_seconds())
+                if not self._condition.wait(timeout) and not (self._heap and self._heap[0][0] <= timezone.now()):
+                    # Истёк max_sleep: перечитываем расписание на случай изменений без уведомления
+                    self._refill = True
+            return False
+
+    def _run_tick(self):
+        try:
+            self.tick()
+        except Exception:
+            logger.exception('Ошибка при отправке рассылок')
+            TICK_ERRORS.inc()
+            # Не повторяем тик сразу, чтобы постоянная ошибка не зациклила планировщик
+            with self._condition:
+                self._condition.wait(self.error_delay)
+        finally:
+            close_old_connections()
+            self._refill = True
+
+
+class NotifyListener(threading.Thread):
+    """
+    Слушает канал Postgres NOTIFY и будит планировщик, когда рассылку сохраняет другой процесс.
+    """
+
+    def __init__(self, scheduler, reconnect_delay=5):
+        super().__init__(name='mailing-notify-listener', daemon=True)
+        self.scheduler = scheduler
+        self.reconnect_delay = reconnect_delay
+
+    def run(self):
+        while not self.scheduler._stopping:
+            try:
+                connection.ensure_connection()
+                with connection.cursor() as cursor:
+                    cursor.execute(f'LISTEN {NOTIFY_CHANNEL}')
+                raw = connection.connection
+                while not self.scheduler._stopping:
+                    if select.select([raw], [], [], self.scheduler.max_sleep)[0]:
+                        raw.poll()
+                        if raw.notifies:
+                            raw.notifies.clear()
+                            self.scheduler.wake()
+            except (DatabaseError, OSError):
+                logger.exception('Потеряно соединение для LISTEN, переподключение')
+                connection.close()
+                time.sleep(self.reconnect_delay)
+        connection.close()
+
+
+_scheduler = None
+
+
+def notify(when, pk):
+    """
+    Сообщает планировщику этого процесса о новом времени отправки рассылки, если он запущен.
+    """
+    if _scheduler is not None:
+        _scheduler.schedule(when, pk)
+
+
+def start_scheduler(engine=None):
+    """
+    Эта функция запускает планировщик, который вызывает send_mailing к ближайшему времени отправки,
+    а на Postgres — ещё и слушателя уведомлений о сохранённых рассылках.
+
+    Параметр engine передаётся в send_mailing.
+    """
+    global _scheduler
+    _scheduler = DispatchScheduler(tick=partial(send_mailing, engine=engine))
+    _scheduler.start()
+    if connection.vendor == 'postgresql':
+        NotifyListener(_scheduler).start()
+    return _scheduler
@@ -0,0 +1,55 @@
+from django.db import connection, transaction
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from users.models import Users
+from .audience import change_clients, release_owner_clients
+from .models import Client, Mailing
+from .scheduler import NOTIFY_CHANNEL, notify
+
+
+@receiver(post_save, sender=Mailing)
+def wake_scheduler(sender, instance, **kwargs):
+    """
+    После сохранения активной рассылки будит планировщик, чтобы он учёл её время отправки.
+
+    Планировщик этого процесса получает время отправки напрямую, планировщики других
+    процессов — через Postgres NOTIFY. Оба уведомления срабатывают после фиксации транзакции.
+    """
+    if instance.status not in (Mailing.CREATED, Mailing.STARTED) or instance.next_send_at is None:
+        return
+    when, pk = instance.next_send_at, instance.pk
+    transaction.on_commit(lambda: notify(when, pk))
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_notify(%s, %s)', [NOTIFY_CHANNEL, str(pk)])
+
+
+@receiver(post_save, sender=Client)
+def count_saved_client(sender, instance, created, **kwargs):
+    """
+    Учитывает нового клиента в счётчиках аудитории, а у изменённого — смену владельца или адреса.
+    """
+    current = (instance.owner_id, instance.email.lower())
+    loaded = getattr(instance, '_loaded_audience', None)
+    if created:
+        change_clients(added=[current])
+    elif loaded is not None and (loaded[0], loaded[1].lower()) != current:
+        change_clients(added=[current], removed=[loaded])
+    instance._loaded_audience = current
+
+
+@receiver(post_delete, sender=Client)
+def count_deleted_client(sender, instance, **kwargs):
+    """
+    Исключает удалённого клиента из счётчиков аудитории.
+    """
+    change_clients(removed=[getattr(instance, '_loaded_audience', (instance.owner_id, instance.email))])
+
+
+@receiver(pre_delete, sender=Users)
+def release_deleted_owner_clients(sender, instance, **kwargs):
+    """
+    Переносит клиентов удаляемого пользователя в счётчик клиентов без владельца.
+    """
+    release_owner_clients(instance.pk)
@@ -1,79 +1,109 @@
+import os
+import socket
+import time
 import pytz
 from datetime import datetime, timedelta
 from django.conf import settings
-from django.core.mail import send_mail
-from django.db.models import Q
-from .models import Mailing, MailingAttempt
+from django.db import transaction
+from django.db.models import F, Prefetch, Q
+from .dispatch import get_engine
+from .metrics import CLAIMED, PHASE_SECONDS, TICK_SECONDS, registry
+from .models import Client, Mailing, MailingDelivery
+from .pool import get_pool
+from .writer import TickWriter
 
-from apscheduler.schedulers.background import BackgroundScheduler
 
-
-def send_mailing():
+def send_mailing(engine=None):
     """
     Эта функция проверяет рассылки, подлежащие отправке, на основе их расписания (ЕЖЕДНЕВНО, ЕЖЕНЕДЕЛЬНО, ЕЖЕМЕСЯЧНО).
     или если они не были отправлены ранее и их необходимо повторить.
+
+    Параметр engine выбирает движок отправки ('sync', 'threads' или 'async'),
+    по умолчанию используется настройка MAILING_DISPATCH_ENGINE.
+
+    Возвращает количество рассылок, захваченных в этом тике.
     """
+    started = time.perf_counter()
     zone = pytz.timezone(settings.TIME_ZONE)
     current_datetime = datetime.now(zone)
 
     # Обновляем статус рассылок на 'STOPPED', если время окончания прошло
-    mailings_to_stop = Mailing.objects.filter(
+    Mailing.objects.filter(
         end_datetime__lt=current_datetime,
-        status__ne=Mailing.STOPPED
-    )
-    for mailing in mailings_to_stop:
-        mailing.status = Mailing.STOPPED
-        mailing.save()
+    ).exclude(status=Mailing.STOPPED).update(status=Mailing.STOPPED)
+
+    # Каждому клиенту уходит отдельное письмо через общий пул соединений.
+    # Журнал доставки записывается контрольными точками, остальное — пакетно в конце тика
+    writer = TickWriter(current_datetime, worker_id())
+    with PHASE_SECONDS.time(phase='due'):
+        due_mailings = writer.begin(load_mailings(claim_due_mailings(current_datetime)))
+    CLAIMED.inc(len(due_mailings))
+    get_engine(engine).run(due_mailings, get_pool(), writer)
+    writer.flush()
+    TICK_SECONDS.observe(time.perf_counter() - started)
+    registry.maybe_flush()
+    return len(due_mailings)
+
+
+def worker_id():
+    """
+    Возвращает идентификатор текущего процесса-обработчика: имя хоста и PID.
+    """
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def get_due_mailings(current_datetime):
+    """
+    Возвращает рассылки, время отправки которых подошло и которые не захвачены другим обработчиком.
 
-    # Получение писем, которые необходимо обработать
-    mailings = Mailing.objects.filter(
+    Выборка идёт по частичному индексу next_send_at.
+    """
+    return Mailing.objects.filter(
+        Q(next_send_at__lte=current_datetime) &
         Q(start_datetime__lte=current_datetime) &
-        Q(end_datetime__gte=current_datetime) &  # добавили фильтр по end_datetime
-        Q(status__in=['CREATED', 'STARTED'])
+        Q(end_datetime__gte=current_datetime) &
+        Q(status__in=['CREATED', 'STARTED']) &
+        (Q(lease_until__isnull=True) | Q(lease_until__lt=current_datetime))
     )
 
-    for mailing in mailings:
-        last_attempt = MailingAttempt.objects.filter(mailing=mailing).order_by('-attempt_datetime').first()
-
-        if last_attempt:
-
-            # Рассчитайте время следующей отправки на основе периодичности.
-            if mailing.periodicity == 'D':
-                next_send_time = last_attempt.attempt_datetime + timedelta(days=1)
-            elif mailing.periodicity == 'W':
-                next_send_time = last_attempt.attempt_datetime + timedelta(weeks=1)
-            elif mailing.periodicity == 'M':
-                next_send_time = last_attempt.attempt_datetime + timedelta(weeks=4)
-            else:
-                next_send_time = mailing.start_datetime  # запасной вариант, обычно он не используется
-        else:
-            next_send_time = mailing.start_datetime
-
-        # Проверьте, пора ли отправлять рассылку
-        if current_datetime >= next_send_time and current_datetime <= mailing.end_datetime:  # добавили проверку end_datetime
-            try:
-                send_mail(
-                    subject=mailing.message.subject,
-                    message=mailing.message.body,
-                    from_email=settings.EMAIL_HOST_USER,
-                    recipient_list=[client.email for client in mailing.clients.all()]
-                )
-                # Зарегистрируйте успешную попытку
-                MailingAttempt.objects.create(mailing=mailing, status='success')
-                mailing.status = 'COMPLETED'  # Или обновить при необходимости
-                mailing.end_datetime = current_datetime  # Обновите поле end_datetime
-            except Exception as e:
-                # Зарегистрируйте неудачную попытку с ответом или ошибкой сервера.
-                MailingAttempt.objects.create(mailing=mailing, status='failed', server_response=str(e))
-                mailing.status = 'STARTED'  # Оставьте статус «НАЧАТО», чтобы повторить попытку позже.
-
-            mailing.save()
-
-
-def start_scheduler():
+
+def claim_due_mailings(current_datetime, limit=None):
     """
-    Эта функция инициализирует и запускает планировщик, который будет вызывать функцию send_mailing каждые 1 минуту:
+    Захватывает до limit подошедших рассылок на время MAILING_LEASE_SECONDS и возвращает их id.
+
+    Строки блокируются через SELECT ... FOR UPDATE SKIP LOCKED, поэтому обработчики на любом
+    количестве процессов и серверов делят подошедшие рассылки без пересечений. Если обработчик
+    упадёт, не освободив рассылку, её заберёт другой после истечения аренды.
     """
-    scheduler = BackgroundScheduler()
-    scheduler.add_job(send_mailing, 'interval', minutes=1)
-    scheduler.start()
+    lease_until = current_datetime + timedelta(seconds=settings.MAILING_LEASE_SECONDS)
+    with transaction.atomic():
+        ids = list(
+            get_due_mailings(current_datetime)
+            .order_by('next_send_at')
+            .select_for_update(skip_locked=True)
+            .values_list('pk', flat=True)[:limit or settings.MAILING_CLAIM_LIMIT]
+        )
+        if ids:
+            Mailing.objects.filter(pk__in=ids).update(lease_until=lease_until, leased_by=worker_id())
+    return ids
+
+
+def load_mailings(ids):
+    """
+    Загружает рассылки для отправки.
+
+    Сообщение и сегмент загружаются вместе с рассылкой, а поля клиентов для подстановок и завершённые
+    доставки — двумя общими запросами, поэтому число запросов не зависит от количества рассылок.
+    Клиенты сегментов здесь не загружаются: они выбираются при отправке (см. dispatch.pending_clients).
+    """
+    return Mailing.objects.filter(pk__in=ids).select_related('message', 'segment').prefetch_related(
+        Prefetch('clients', queryset=Client.objects.only('id', 'email', 'full_name')),
+        Prefetch(
+            'deliveries',
+            queryset=MailingDelivery.objects.filter(
+                status__in=MailingDelivery.FINAL_STATUSES, run=F('mailing__run'),
+            ).only('id', 'mailing_id', 'client_id'),
+            to_attr='delivered',
+        ),
+    )
+
@@ -1,3 +1,924 @@
-from django.test import TestCase
+import csv
+import io
+import os
+import signal
+import smtplib
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from email import message_from_bytes
+from unittest import mock
 
-# Create your tests here.
+import fakeredis
+from django.conf import settings
+from django.core import mail
+from django.core.mail import EmailMessage
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError, connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from mailing.audience import change_clients, counter_value, distinct_emails_count, owner_clients_count, owner_key
+from mailing.bench import SinkHandler, create_mailing, local_smtp_sink
+from mailing.breaker import CircuitBreaker
+from mailing.dispatch import (
+    SyncEngine, ThreadEngine, build_batch_message, build_message, draining, get_engine, pending_clients,
+)
+from mailing.forms import MailingForm
+from mailing.importer import ClientImporter, get_import_progress, import_progress_key
+from mailing.metrics import Registry, RedisStore
+from mailing.mime import message_bytes
+from mailing import scheduler as scheduler_module
+from mailing.models import Client, DispatcherHeartbeat, Mailing, MailingAttempt, MailingDelivery, Message, Segment
+from mailing.personalize import CompiledTemplate
+from mailing.pool import SMTPConnectionPool
+from mailing.ratelimit import RateLimiter, RedisBuckets, redis_client
+from mailing.scheduler import DispatchScheduler
+from mailing.tasks import claim_due_mailings, get_due_mailings, load_mailings, send_mailing, worker_id
+from mailing.writer import TickWriter
+from users.models import Users
+
+
+# Кэш Redis на fakeredis: все подключения с этим адресом видят одни и те же данные
+FAKE_REDIS_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://fake-redis:6379/0',
+        'OPTIONS': {'connection_class': fakeredis.FakeConnection},
+    },
+}
+
+
+class RecordingWriter:
+    """
+    Заменяет TickWriter в тестах движков: запоминает итог каждой рассылки, ничего не записывая в базу.
+    """
+
+    def __init__(self):
+        self.recorded = {}
+
+    def checkpoint(self, mailing, results):
+        return True
+
+    def record(self, mailing, results):
+        assert mailing.pk not in self.recorded, 'рассылка записана дважды'
+        self.recorded[mailing.pk] = results
+
+
+def sink_resolver(domain):
+    """
+    Тестовый резолвер доменов: example.org отправляется на локальный SMTP-приёмник, остальные — через EMAIL_*.
+    """
+    return DomainBatchTest.sink_relay if domain == 'example.org' else None
+
+
+class AsyncEngineTest(TestCase):
+    """
+    Проверяет асинхронный движок отправки на локальном SMTP-приёмнике aiosmtpd.
+    """
+
+    def test_every_recipient_reaches_sink(self):
+        mailing = create_mailing(25)
+        writer = RecordingWriter()
+
+        with local_smtp_sink() as sink:
+            get_engine('async').run([mailing], None, writer)
+
+        self.assertEqual(sink.received, 25)
+        self.assertEqual(len(writer.recorded[mailing.pk]), 25)
+        self.assertTrue(all(error is None for _, error in writer.recorded[mailing.pk]))
+
+
+class ThreadEngineTest(TestCase):
+    """
+    Проверяет параллельный движок: порции разных рассылок перемешиваются в пуле потоков,
+    но каждая рассылка записывается один раз и со всеми получателями.
+    """
+
+    def test_each_mailing_is_recorded_once(self):
+        mailings = [create_mailing(7) for _ in range(3)]
+        writer = RecordingWriter()
+
+        ids = [mailing.pk for mailing in mailings]
+        ThreadEngine(workers=2, chunk_size=2).run(load_mailings(ids), SMTPConnectionPool(), writer)
+
+        self.assertEqual(set(writer.recorded), {mailing.pk for mailing in mailings})
+        for mailing in mailings:
+            recorded = writer.recorded[mailing.pk]
+            self.assertEqual({client.pk for client, _ in recorded}, set(mailing.clients.values_list('pk', flat=True)))
+            self.assertEqual(len(recorded), 7)
+            self.assertTrue(all(error is None for _, error in recorded))
+        self.assertEqual(sum(len(message.recipients()) for message in mail.outbox), 21)
+
+    def test_draining_worker_does_not_record(self):
+        mailing = create_mailing(3)
+        writer = RecordingWriter()
+        draining.set()
+        try:
+            ThreadEngine(workers=2, chunk_size=1).run(load_mailings([mailing.pk]), SMTPConnectionPool(), writer)
+        finally:
+            draining.clear()
+
+        self.assertEqual((writer.recorded, mail.outbox), ({}, []))
+
+
+class DomainBatchTest(TestCase):
+    """
+    Проверяет группировку получателей по доменам и отправку пачками RCPT TO через релей из резолвера.
+    """
+    sink_relay = None
+
+    def test_recipients_are_batched_per_domain(self):
+        mailing = create_mailing(5)
+        mailing.clients.add(*Client.objects.bulk_create(
+            Client(email=f'user{number}@example.org', full_name=f'Клиент {number}') for number in range(7)
+        ))
+        writer = RecordingWriter()
+
+        with local_smtp_sink() as sink:
+            DomainBatchTest.sink_relay = f"{settings.EMAIL_HOST}:{settings.EMAIL_PORT}"
+            with override_settings(
+                EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+                MAILING_RCPT_BATCH_SIZE=3,
+                MAILING_DOMAIN_RESOLVER='mailing.tests.sink_resolver',
+            ):
+                SyncEngine().run([mailing], SMTPConnectionPool(), writer)
+
+        self.assertEqual((sink.received, sink.messages), (7, 3))
+        self.assertEqual([len(message.recipients()) for message in mail.outbox], [3, 2])
+        self.assertTrue(all(error is None for _, error in writer.recorded[mailing.pk]))
+
+
+class SegmentTest(TestCase):
+    """
+    Проверяет отправку рассылки на сегмент: получатели отбираются запросом при отправке.
+    """
+
+    def test_segment_clients_are_resolved_at_send_time(self):
+        owner = Users.objects.create(email='owner@example.com')
+        other = Users.objects.create(email='other@example.com')
+        Client.objects.bulk_create([
+            Client(email='b@example.org', full_name='Б', tag='vip', owner=owner),
+            Client(email='a@example.com', full_name='А', tag='vip', owner=owner),
+            Client(email='c@example.com', full_name='В', owner=owner),
+            Client(email='d@example.com', full_name='Г', tag='vip', owner=other),
+        ])
+        now = timezone.now()
+        mailing = Mailing.objects.create(
+            start_datetime=now, end_datetime=now + timedelta(days=1), periodicity=Mailing.DAILY,
+            message=Message.objects.create(subject='Тема', body='Текст'),
+            segment=Segment.objects.create(name='VIP', tag='vip', owner=owner),
+            owner=owner,
+        )
+        # Клиент, добавленный после создания рассылки, тоже попадает в сегмент
+        late = Client.objects.create(email='e@example.com', full_name='Д', tag='vip', owner=owner)
+        MailingDelivery.objects.create(
+            mailing=mailing, client=late, run=mailing.run, status=MailingDelivery.FINAL_STATUSES[0],
+        )
+        Mailing.objects.filter(pk=mailing.pk).update(status=Mailing.STARTED)
+
+        SyncEngine().run(load_mailings([mailing.pk]), SMTPConnectionPool(), RecordingWriter())
+
+        self.assertEqual([message.to for message in mail.outbox], [['a@example.com'], ['b@example.org']])
+
+    def test_owner_with_targeted_segment_can_be_deleted(self):
+        owner = Users.objects.create(email='owner@example.com')
+        Client.objects.create(email='a@example.com', full_name='А', owner=owner)
+        now = timezone.now()
+        mailing = Mailing.objects.create(
+            start_datetime=now, end_datetime=now + timedelta(days=1), periodicity=Mailing.DAILY,
+            message=Message.objects.create(subject='Тема', body='Текст'),
+            segment=Segment.objects.create(name='Все', owner=owner),
+            owner=owner,
+        )
+
+        owner.delete()
+
+        mailing.refresh_from_db()
+        self.assertIsNone(mailing.segment.owner_id)
+        self.assertFalse(mailing.get_clients().exists())  # клиенты без владельца в сегмент не попадают
+
+
+@override_settings(CACHES=FAKE_REDIS_CACHES)
+class RateLimitTest(TestCase):
+    """
+    Проверяет, что при кэше Redis ведра жетонов общие для всех ограничителей.
+    """
+
+    def setUp(self):
+        redis_client().flushall()
+
+    def test_limiters_share_redis_bucket(self):
+        mailing = Mailing(owner_id=None)
+        first, second = RateLimiter(relay_rate=1), RateLimiter(relay_rate=1)
+
+        self.assertIsInstance(first.store, RedisBuckets)
+        self.assertEqual(first.reserve(mailing, 'a@example.com'), 0)
+        self.assertAlmostEqual(second.reserve(mailing, 'b@example.org'), 1, delta=0.1)
+
+
+class PersonalizationTest(TestCase):
+    """
+    Проверяет подстановку полей клиента в тему и текст сообщения.
+    """
+
+    def test_template_renders_client_fields(self):
+        template = CompiledTemplate('{{ full_name }} <{{email}}>: скидка 10% {{ unknown }}')
+        client = Client(email='ivan@example.com', full_name='Иван')
+        self.assertEqual(template.render(client), 'Иван <ivan@example.com>: скидка 10% {{ unknown }}')
+
+    def test_personalized_message_is_sent_to_each_client(self):
+        mailing = create_mailing(3)
+        Message.objects.filter(pk=mailing.message_id).update(body='Здравствуйте, {{ full_name }}!')
+        mailing.message.refresh_from_db()
+
+        SyncEngine().run([mailing], SMTPConnectionPool(), RecordingWriter())
+
+        self.assertEqual(sorted(message.body for message in mail.outbox),
+                         ['Здравствуйте, Клиент 0!', 'Здравствуйте, Клиент 1!', 'Здравствуйте, Клиент 2!'])
+
+    def test_html_substitutions_are_escaped(self):
+        mailing = create_mailing(0)
+        mailing.clients.add(Client.objects.create(email='x@example.com', full_name='<b>x</b>'))
+        Message.objects.filter(pk=mailing.message_id).update(body='{{ full_name }}', html_body='<p>{{ full_name }}</p>')
+        mailing.message.refresh_from_db()
+
+        SyncEngine().run([mailing], SMTPConnectionPool(), RecordingWriter())
+
+        message = mail.outbox[0]
+        self.assertEqual(message.body, '<b>x</b>')
+        self.assertEqual(message.alternatives[0][0], '<p>&lt;b&gt;x&lt;/b&gt;</p>')
+
+
+class PreparedMessageTest(TestCase):
+    """
+    Проверяет, что подготовленное письмо совпадает с обычной сериализацией MIME.
+    """
+
+    def test_only_recipient_headers_differ(self):
+        mailing = create_mailing(3)
+        Message.objects.filter(pk=mailing.message_id).update(html_body='<p>Тестовое письмо</p>')
+        mailing.message.refresh_from_db()
+        clients = list(mailing.clients.order_by('pk'))
+
+        for message in (build_message(mailing, clients[0]), build_batch_message(mailing, clients)):
+            prepared = message_from_bytes(message_bytes(message))
+            expected = message.message()
+            for header in ('To', 'Message-ID', 'Subject', 'Content-Type'):
+                self.assertEqual(prepared[header].split(';')[0], expected[header].split(';')[0])
+            self.assertEqual([part.get_payload(decode=True) for part in prepared.get_payload()],
+                             [part.get_payload(decode=True) for part in expected.get_payload()])
+        self.assertIs(build_message(mailing, clients[1]).prepared, build_message(mailing, clients[2]).prepared)
+
+
+class MetricsTest(TestCase):
+    """
+    Проверяет вывод метрик отправки в формате Prometheus.
+    """
+
+    def test_metrics_endpoint_reports_dispatch(self):
+        create_mailing(3)
+        send_mailing()
+        self.client.force_login(Users.objects.create(email='staff@example.com', is_staff=True))
+
+        response = self.client.get(reverse('mailing:metrics'))
+
+        self.assertEqual(response.status_code, 200)
+        text = response.content.decode()
+        self.assertRegex(text, r'mailing_recipients_total\{status="sent"\} \d+')
+        self.assertIn('mailing_phase_seconds_bucket{phase="send",le="+Inf"}', text)
+        self.assertIn('mailing_due_mailings 0', text)
+
+    def test_metrics_require_staff_or_token(self):
+        url = reverse('mailing:metrics')
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.client.force_login(Users.objects.create(email='user@example.com'))
+        self.assertEqual(self.client.get(url).status_code, 403)
+        with override_settings(MAILING_METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+
+    @override_settings(CACHES=FAKE_REDIS_CACHES)
+    def test_processes_are_summed_in_redis(self):
+        redis_client().flushall()
+        first, second = Registry(), Registry()  # реестры двух процессов
+        for registry, amount in ((first, 2), (second, 3)):
+            registry.counter('test_sent_total', 'Отправленные письма', ['status']).inc(amount, status='sent')
+            registry.flush()
+
+        self.assertIsInstance(first.store, RedisStore)
+        self.assertIn('test_sent_total{status="sent"} 5\n', first.exposition())
+
+
+class ClientImportTest(TestCase):
+    """
+    Проверяет импорт клиентов из CSV-файла командой import_clients.
+    """
+
+    def test_import_skips_invalid_and_existing_addresses(self):
+        owner = Users.objects.create(email='owner@example.com')
+        Client.objects.create(email='Old@Example.com', full_name='Старый', owner=owner)
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', encoding='utf-8', delete=False) as file:
+            file.write('ФИО;Email\nИван;ivan@example.com\nПовтор;IVAN@example.com\nСтарый;old@example.com\n'
+                       'Ошибка;not-an-email\n;;\nМария;maria@example.org\n')
+        self.addCleanup(os.remove, file.name)
+
+        call_command('import_clients', file.name, owner=owner.email, batch_size=2, stdout=io.StringIO())
+
+        self.assertEqual(sorted(Client.objects.filter(owner=owner).values_list('email', 'full_name')),
+                         [('Old@Example.com', 'Старый'), ('ivan@example.com', 'Иван'), ('maria@example.org', 'Мария')])
+
+    def test_stale_web_import_is_marked_failed(self):
+        # Процесс веб-приложения остановился посреди импорта и больше не обновляет его состояние
+        stale = time.time() - settings.MAILING_IMPORT_STALE_SECONDS - 1
+        cache.set(import_progress_key('stale'), {'owner_id': 1, 'finished': False, 'error': None, 'updated_at': stale})
+
+        progress = get_import_progress('stale')
+
+        self.assertTrue(progress['finished'])
+        self.assertIn('import_clients', progress['error'])
+        self.assertEqual(cache.get(import_progress_key('stale'))['error'], progress['error'])
+
+
+class AudienceCounterTest(TestCase):
+    """
+    Проверяет, что счётчики аудитории совпадают с подсчётом по таблице клиентов.
+    """
+
+    def test_counters_follow_client_changes(self):
+        first = Users.objects.create(email='first@example.com')
+        second = Users.objects.create(email='second@example.com')
+        shared = Client.objects.create(email='shared@example.com', full_name='Общий', owner=first)
+        Client.objects.create(email='SHARED@example.com', full_name='Общий', owner=second)
+        moved = Client.objects.create(email='moved@example.com', full_name='Переезд', owner=first)
+        ClientImporter(second).run([['email'], ['imported@example.com'], ['moved@example.com']])
+
+        moved.email = 'renamed@example.com'
+        moved.save()
+        shared.delete()
+
+        self.assertEqual(distinct_emails_count(), 4)  # shared, renamed, imported, moved
+        self.assertEqual(owner_clients_count(first), 1)
+        self.assertEqual(owner_clients_count(second), 3)
+        with self.assertRaises(IntegrityError):
+            Client.objects.create(email='Imported@Example.com', full_name='Дубликат', owner=second)
+
+    def test_deleted_owner_clients_are_counted_without_owner(self):
+        owner = Users.objects.create(email='owner@example.com')
+        Client.objects.bulk_create([Client(email='orphan@example.com', full_name='Клиент', owner=None)])
+        change_clients(added=[(None, 'orphan@example.com')])
+        ClientImporter(owner).run([['email'], ['a@example.com'], ['b@example.com']])
+
+        owner_id = owner.pk
+        owner.delete()
+
+        self.assertEqual(Client.objects.filter(owner=None).count(), 3)
+        self.assertEqual(counter_value(owner_key(None)), 3)
+        self.assertEqual(counter_value(owner_key(owner_id)), 0)
+        self.assertEqual(distinct_emails_count(), 3)
+
+    def test_import_skips_address_added_concurrently(self):
+        owner = Users.objects.create(email='owner@example.com')
+        bulk_create = Client.objects.bulk_create
+
+        def racing_bulk_create(clients, **kwargs):
+            # Между проверкой существующих адресов и вставкой клиента с тем же адресом сохраняет форма
+            Client.objects.create(email='Ivan@Example.com', full_name='Из формы', owner=owner)
+            return bulk_create(clients, **kwargs)
+
+        with mock.patch.object(Client.objects, 'bulk_create', racing_bulk_create):
+            result = ClientImporter(owner).run([['email'], ['ivan@example.com'], ['maria@example.com']])
+
+        self.assertEqual((result.created, result.duplicates), (1, 1))
+        self.assertEqual(owner_clients_count(owner), 2)
+        self.assertEqual(distinct_emails_count(), 2)
+
+
+class ExportTest(TestCase):
+    """
+    Проверяет, что выгрузка в CSV показывает пользователю только его клиентов.
+    """
+
+    def test_client_export_is_scoped_to_owner(self):
+        owner = Users.objects.create(email='owner@example.com')
+        other = Users.objects.create(email='other@example.com')
+        Client.objects.create(email='mine@example.com', full_name='Мой, клиент', owner=owner)
+        Client.objects.create(email='theirs@example.com', full_name='Чужой', owner=other)
+        self.client.force_login(owner)
+
+        response = self.client.get(reverse('mailing:client-export'))
+
+        rows = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode('utf-8-sig'))))
+        self.assertEqual([row[1:3] for row in rows], [['email', 'full_name'], ['mine@example.com', 'Мой, клиент']])
+
+    def test_formulas_are_escaped(self):
+        owner = Users.objects.create(email='owner@example.com')
+        Client.objects.create(email='a@example.com', full_name='=HYPERLINK("http://evil")', comment='-1+1', owner=owner)
+        self.client.force_login(owner)
+
+        response = self.client.get(reverse('mailing:client-export'))
+
+        rows = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode('utf-8-sig'))))
+        self.assertIn('\'=HYPERLINK("http://evil")', rows[1])
+        self.assertIn("'-1+1", rows[1])
+        self.assertIn('a@example.com', rows[1])
+
+
+class ClientPickerTest(TestCase):
+    """
+    Проверяет выбор получателей рассылки без загрузки всех клиентов владельца.
+    """
+
+    def setUp(self):
+        self.owner = Users.objects.create(email='owner@example.com')
+        self.clients = Client.objects.bulk_create(
+            Client(email=f'client{number}@example.com', full_name=f'Клиент {number}', owner=self.owner)
+            for number in range(5)
+        )
+        other = Users.objects.create(email='other@example.com')
+        self.foreign = Client.objects.create(email='foreign@example.com', owner=other)
+
+    @override_settings(MAILING_CLIENT_SEARCH_PAGE_SIZE=2)
+    def test_search_pages_owner_clients(self):
+        self.client.force_login(self.owner)
+        pages, after = [], ''
+        while after is not None:
+            data = self.client.get(reverse('mailing:client-search'), {'q': 'client', 'after': after}).json()
+            pages.append([result['id'] for result in data['results']])
+            after = data['next']
+        self.assertEqual(pages, [[client.pk for client in self.clients[start:start + 2]] for start in (0, 2, 4)])
+
+    def test_form_checks_clients_with_one_query(self):
+        now = timezone.now()
+        data = {
+            'start_datetime': now, 'end_datetime': now + timedelta(days=1), 'periodicity': Mailing.DAILY,
+            'status': Mailing.CREATED, 'message': Message.objects.create(subject='Тема', body='Текст').pk,
+            'clients': [client.pk for client in self.clients],
+        }
+        form = MailingForm(data, owner=self.owner)
+        with CaptureQueriesContext(connection) as queries:
+            form.fields['clients'].clean(data['clients'])
+        self.assertEqual(len(queries), 1)
+        self.assertTrue(form.is_valid())
+
+        data['clients'].append(self.foreign.pk)
+        self.assertIn('clients', MailingForm(data, owner=self.owner).errors)
+
+
+class MailingScheduleTest(TestCase):
+    """
+    Проверяет пересчёт next_send_at при сохранении рассылки и выборку подошедших рассылок.
+    """
+
+    def test_next_send_at_follows_schedule_changes(self):
+        mailing = create_mailing(1)
+        self.assertEqual(mailing.next_send_at, mailing.start_datetime)
+
+        mailing = Mailing.objects.get(pk=mailing.pk)
+        mailing.start_datetime += timedelta(days=2)
+        mailing.save()
+        self.assertEqual(mailing.next_send_at, mailing.start_datetime)
+
+        attempt = MailingAttempt.objects.create(mailing=mailing, status='success')
+        mailing = Mailing.objects.get(pk=mailing.pk)
+        mailing.periodicity = Mailing.WEEKLY
+        mailing.save()
+        self.assertEqual(mailing.next_send_at, attempt.attempt_datetime + timedelta(weeks=1))
+
+        # Без изменения расписания next_send_at, выставленный отправкой, не трогается
+        Mailing.objects.filter(pk=mailing.pk).update(next_send_at=mailing.start_datetime)
+        mailing = Mailing.objects.get(pk=mailing.pk)
+        mailing.status = Mailing.STARTED
+        mailing.save()
+        mailing.refresh_from_db()
+        self.assertEqual(mailing.next_send_at, mailing.start_datetime)
+
+    def test_due_mailings_are_active_only(self):
+        statuses = [Mailing.CREATED, Mailing.STARTED, Mailing.COMPLETED, Mailing.STOPPED]
+        mailings = {status: create_mailing(1) for status in statuses}
+        for status, mailing in mailings.items():
+            Mailing.objects.filter(pk=mailing.pk).update(status=status)
+        due = get_due_mailings(timezone.now() + timedelta(seconds=1))
+
+        self.assertEqual(set(due.values_list('pk', flat=True)), {mailings[Mailing.CREATED].pk, mailings[Mailing.STARTED].pk})
+
+
+class TickQueryCountTest(TestCase):
+    """
+    Проверяет, что число запросов тика планировщика не зависит от количества рассылок.
+    """
+
+    def create_due_mailings(self, count):
+        now = timezone.now()
+        message = Message.objects.create(subject='Тема', body='Текст')
+        client = Client.objects.create(email='client@example.com', full_name='Клиент')
+        mailings = Mailing.objects.bulk_create(
+            Mailing(
+                start_datetime=now - timedelta(hours=1),
+                end_datetime=now + timedelta(days=1),
+                next_send_at=now - timedelta(minutes=1),
+                periodicity=Mailing.DAILY,
+                status=Mailing.STARTED if number % 2 else Mailing.CREATED,
+                message=message,
+            )
+            for number in range(count)
+        )
+        Mailing.clients.through.objects.bulk_create(
+            Mailing.clients.through(mailing_id=mailing.id, client_id=client.id) for mailing in mailings
+        )
+        return now
+
+    def count_tick_queries(self, count):
+        now = self.create_due_mailings(count)
+        ids = list(get_due_mailings(now).values_list('pk', flat=True))
+        writer = RecordingWriter()
+        with CaptureQueriesContext(connection) as queries:
+            SyncEngine().run(load_mailings(ids), SMTPConnectionPool(), writer)
+        self.assertEqual(len(writer.recorded), Mailing.objects.count())
+        return len(queries)
+
+    def test_query_count_is_constant(self):
+        self.assertEqual(self.count_tick_queries(10), 3)
+        self.assertEqual(self.count_tick_queries(10_000), 3)
+
+    def count_send_mailing_queries(self, count):
+        self.create_due_mailings(count)
+        with CaptureQueriesContext(connection) as queries:
+            send_mailing(engine='sync')
+        return len(queries)
+
+    def test_send_mailing_writes_in_batches(self):
+        self.assertEqual(self.count_send_mailing_queries(10), self.count_send_mailing_queries(100))
+        self.assertEqual(MailingAttempt.objects.filter(status='success').count(), 110)
+
+
+class LeaseTest(TestCase):
+    """
+    Проверяет аренду рассылок: захват, повторный захват после истечения и потерю аренды во время отправки.
+    """
+
+    def test_leased_mailing_is_skipped_until_lease_expires(self):
+        mailing = create_mailing(1)
+        now = timezone.now()
+        Mailing.objects.filter(pk=mailing.pk).update(
+            next_send_at=now, lease_until=now + timedelta(minutes=5), leased_by='other:1',
+        )
+        self.assertEqual(claim_due_mailings(now), [])
+
+        Mailing.objects.filter(pk=mailing.pk).update(lease_until=now - timedelta(seconds=1))
+        self.assertEqual(claim_due_mailings(now), [mailing.pk])
+        mailing.refresh_from_db()
+        self.assertEqual(mailing.leased_by, worker_id())
+
+    def test_lost_lease_stops_sending(self):
+        now = timezone.now()
+        mailing = create_mailing(5)
+        Mailing.objects.filter(pk=mailing.pk).update(lease_until=now, leased_by=worker_id())
+        writer = TickWriter(now, worker_id(), checkpoint_size=1)
+        mailings = writer.begin(load_mailings([mailing.pk]))
+        # Пока обработчик отправлял, аренда истекла и рассылку захватил другой обработчик
+        Mailing.objects.filter(pk=mailing.pk).update(leased_by='other:1')
+
+        SyncEngine(chunk_size=1).run(mailings, SMTPConnectionPool(), writer)
+        writer.flush()
+
+        self.assertEqual(len(mail.outbox), 1)
+        mailing.refresh_from_db()
+        self.assertEqual(mailing.leased_by, 'other:1')
+        self.assertFalse(MailingAttempt.objects.exists())
+
+
+class RejectingHandler(SinkHandler):
+    """
+    SMTP-приёмник, который отклоняет каждое письмо на этапе DATA.
+    """
+
+    async def handle_DATA(self, server, session, envelope):
+        await super().handle_DATA(server, session, envelope)
+        return '554 Message rejected'
+
+
+class SessionCountingHandler(SinkHandler):
+    """
+    SMTP-приёмник, который дополнительно считает открытые сессии по команде EHLO.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.sessions = 0
+
+    async def handle_EHLO(self, server, session, envelope, hostname, responses):
+        self.sessions += 1
+        session.host_name = hostname
+        return responses
+
+
+class SMTPConnectionPoolTest(TestCase):
+    """
+    Проверяет пул SMTP-соединений на локальном приёмнике: повторное использование соединения
+    между тиками, проверку простаивавшего соединения командой NOOP и переподключение при обрыве.
+    """
+
+    def message(self):
+        return EmailMessage('Тема', 'Текст', 'from@example.com', ['to@example.com'])
+
+    def test_connection_is_reused_checked_and_reopened(self):
+        with local_smtp_sink(handler=SessionCountingHandler()) as sink:
+            pool = SMTPConnectionPool(breaker=CircuitBreaker())
+            self.addCleanup(pool.close)
+            # Два тика подряд отправляют письма через одно соединение
+            self.assertEqual(pool.send_messages([self.message()]) + pool.send_messages([self.message()]), [None, None])
+            self.assertEqual(sink.sessions, 1)
+
+            # Оборванное простаивавшее соединение не проходит NOOP и заменяется новым
+            connection, _ = pool._idle.queue[0]
+            connection.connection.close()
+            self.assertEqual(pool.send_messages([self.message()]), [None])
+            self.assertEqual(sink.sessions, 2)
+
+            # Соединение, оборвавшееся уже во время отправки, открывается заново, письмо уходит один раз
+            connection, _ = pool._idle.get_nowait()
+            connection.connection.close()
+            connection, errors = pool._send(connection, self.message())
+            pool._checkin(connection)
+            self.assertEqual(errors, [None])
+            self.assertEqual((sink.sessions, sink.messages), (3, 4))
+
+
+class CircuitBreakerTest(TestCase):
+    """
+    Проверяет автоматический выключатель SMTP-релея и откладывание рассылки, пока он разомкнут.
+    """
+
+    def test_breaker_opens_probes_and_closes(self):
+        breaker = CircuitBreaker(threshold=2, reset_timeout=30)
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())  # до истечения reset_timeout отправка сразу завершается ошибкой
+
+        breaker._opened_at -= breaker.reset_timeout
+        self.assertTrue(breaker.allow())  # пробная отправка
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(breaker.allow())  # проба одна
+        breaker.failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        breaker._opened_at -= breaker.reset_timeout
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.allow())
+
+    def test_rejected_message_does_not_open_breaker(self):
+        breaker = CircuitBreaker(threshold=1)
+        messages = [EmailMessage('Тема', 'Текст', 'from@example.com', [f'to{number}@example.com']) for number in range(2)]
+
+        with local_smtp_sink(handler=RejectingHandler()) as sink:
+            pool = SMTPConnectionPool(breaker=breaker)
+            errors = pool.send_messages(messages)
+            pool.close()
+
+        self.assertTrue(all(isinstance(error, smtplib.SMTPDataError) for error in errors))
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(sink.messages, 2)  # каждое письмо отправлено один раз
+
+    def test_deferred_mailing_waits_for_probe(self):
+        mailing = create_mailing(2)
+        now = timezone.now()
+        Mailing.objects.filter(pk=mailing.pk).update(lease_until=now, leased_by=worker_id())
+        writer = TickWriter(now, worker_id())
+        mailing, = writer.begin(load_mailings([mailing.pk]))
+        breaker = CircuitBreaker()
+        results = [(client, breaker.error()) for client in mailing.clients.all()]
+        writer.checkpoint(mailing, results)
+        writer.record(mailing, results)
+        writer.flush()
+
+        mailing.refresh_from_db()
+        self.assertEqual(mailing.status, Mailing.STARTED)
+        self.assertEqual(mailing.retry_count, 0)
+        self.assertEqual(mailing.next_send_at, now + timedelta(seconds=settings.MAILING_BREAKER_RESET_SECONDS))
+        self.assertEqual(mailing.leased_by, '')
+        self.assertEqual(
+            set(MailingDelivery.objects.filter(mailing=mailing).values_list('status', flat=True)),
+            {MailingDelivery.DEFERRED},
+        )
+
+
+class ResumeTest(TestCase):
+    """
+    Проверяет, что после сбоя посреди отправки следующий тик продолжает тот же прогон с последней контрольной точки.
+    """
+
+    def test_crashed_run_resumes_with_remaining_recipients(self):
+        mailing = create_mailing(5)
+        now = timezone.now()
+        Mailing.objects.filter(pk=mailing.pk).update(next_send_at=now, lease_until=now, leased_by=worker_id())
+        writer = TickWriter(now, worker_id(), checkpoint_size=1)
+        mailing, = writer.begin(load_mailings([mailing.pk]))
+        sent = list(pending_clients(mailing))[:2]
+        for client in sent:
+            writer.checkpoint(mailing, [(client, None)])
+        # Сбой: ни record, ни flush не вызываются, аренда истекает
+        Mailing.objects.filter(pk=mailing.pk).update(lease_until=now - timedelta(seconds=1))
+
+        send_mailing(engine='sync')
+
+        remaining = mailing.clients.exclude(pk__in=[client.pk for client in sent]).values_list('email', flat=True)
+        recipients = {recipient for message in mail.outbox for recipient in message.recipients()}
+        self.assertEqual(recipients, set(remaining))
+        mailing.refresh_from_db()
+        self.assertEqual((mailing.run, mailing.status), (1, Mailing.COMPLETED))
+        self.assertEqual(MailingDelivery.objects.filter(mailing=mailing, run=1, status=MailingDelivery.SENT).count(), 5)
+
+
+    def test_recipients_after_last_checkpoint_are_resent(self):
+        class Crash(Exception):
+            pass
+
+        class CrashingWriter(TickWriter):
+            # Процесс падает после отправки третьего получателя, до следующей контрольной точки
+            calls = 0
+
+            def checkpoint(self, mailing, results):
+                self.calls += 1
+                if self.calls == 3:
+                    raise Crash
+                return super().checkpoint(mailing, results)
+
+        mailing = create_mailing(5)
+        clients = list(mailing.clients.order_by('pk'))
+        now = timezone.now()
+        Mailing.objects.filter(pk=mailing.pk).update(next_send_at=now, lease_until=now, leased_by=worker_id())
+        writer = CrashingWriter(now, worker_id(), checkpoint_size=2)
+        with self.assertRaises(Crash):
+            SyncEngine(chunk_size=1).run(writer.begin(load_mailings([mailing.pk])), SMTPConnectionPool(), writer)
+        self.assertEqual((len(mail.outbox), MailingDelivery.objects.count()), (3, 2))
+        Mailing.objects.filter(pk=mailing.pk).update(lease_until=now - timedelta(seconds=1))
+        mail.outbox = []
+
+        send_mailing(engine='sync')
+
+        # Третий получатель отправлен до сбоя, но не попал в контрольную точку, поэтому получает письмо повторно
+        recipients = {recipient for message in mail.outbox for recipient in message.recipients()}
+        self.assertEqual(recipients, {client.email for client in clients[2:]})
+
+
+@override_settings(MAILING_RETRY_BASE_SECONDS=60, MAILING_RETRY_MAX_SECONDS=600, MAILING_RETRY_MAX_ATTEMPTS=2)
+class RetryTest(TestCase):
+    """
+    Проверяет экспоненциальную задержку повторов и разделение временных (4xx) и окончательных (5xx) отказов.
+    """
+
+    def tick(self, mailing, code):
+        """
+        Записывает попытку рассылки, в которой сервер ответил кодом code всем получателям.
+        """
+        now = timezone.now()
+        Mailing.objects.filter(pk=mailing.pk).update(lease_until=now, leased_by=worker_id())
+        writer = TickWriter(now, worker_id())
+        mailing, = writer.begin(load_mailings([mailing.pk]))
+        results = [
+            (client, smtplib.SMTPRecipientsRefused({client.email: (code, b'refused')}))
+            for client in mailing.clients.all()
+        ]
+        writer.checkpoint(mailing, results)
+        writer.record(mailing, results)
+        writer.flush()
+        mailing.refresh_from_db()
+        return now, mailing
+
+    def test_retry_delay_grows_up_to_cap(self):
+        now = timezone.now()
+        mailing = Mailing()
+        for retry_count, delay in [(1, 60), (2, 120), (3, 240), (4, 480), (5, 600), (20, 600)]:
+            mailing.retry_count = retry_count
+            retry_at = mailing.get_retry_at(now)
+            self.assertTrue(now + timedelta(seconds=delay / 2) <= retry_at <= now + timedelta(seconds=delay))
+
+    def test_transient_errors_are_retried_until_attempts_run_out(self):
+        mailing = create_mailing(2)
+        for retry_count in (1, 2):
+            now, mailing = self.tick(mailing, 450)
+            self.assertEqual((mailing.status, mailing.retry_count), (Mailing.STARTED, retry_count))
+            self.assertTrue(now < mailing.next_send_at <= now + timedelta(seconds=60 * 2 ** (retry_count - 1)))
+        self.assertEqual(
+            set(MailingDelivery.objects.filter(mailing=mailing).values_list('status', flat=True)),
+            {MailingDelivery.FAILED},
+        )
+
+        _, mailing = self.tick(mailing, 450)
+        self.assertEqual((mailing.status, mailing.retry_count), (Mailing.CREATED, 0))
+
+    def test_permanent_errors_are_not_retried(self):
+        _, mailing = self.tick(create_mailing(2), 550)
+        self.assertEqual((mailing.status, mailing.retry_count), (Mailing.COMPLETED, 0))
+        self.assertEqual(
+            set(MailingDelivery.objects.filter(mailing=mailing).values_list('status', flat=True)),
+            {MailingDelivery.REJECTED},
+        )
+
+
+class SchedulerTest(TestCase):
+    """
+    Проверяет планировщик: сон до ближайшей отправки или окончания аренды, уведомление о сохранённой
+    рассылке и повторный тик при полностью занятом захвате.
+    """
+
+    def test_sleeps_until_earliest_send_time_or_lease_expiry(self):
+        now = timezone.now()
+        later, leased = create_mailing(1), create_mailing(1)
+        Mailing.objects.filter(pk=later.pk).update(next_send_at=now + timedelta(hours=1))
+        Mailing.objects.filter(pk=leased.pk).update(
+            next_send_at=now - timedelta(minutes=1), lease_until=now + timedelta(minutes=10), leased_by='other:1',
+        )
+        scheduler = DispatchScheduler(tick=lambda: 0, max_sleep=60)
+
+        scheduler._load()
+
+        self.assertEqual(scheduler._heap[0], (now + timedelta(minutes=10), leased.pk))
+        scheduler.schedule(timezone.now() + timedelta(seconds=0.2))
+        started = time.monotonic()
+        self.assertTrue(scheduler._wait())
+        self.assertGreaterEqual(time.monotonic() - started, 0.15)
+
+    def test_saved_mailing_is_pushed_after_commit(self):
+        scheduler = DispatchScheduler(tick=lambda: 0, max_sleep=60)
+        with mock.patch.object(scheduler_module, '_scheduler', scheduler):
+            with self.captureOnCommitCallbacks(execute=True):
+                mailing = create_mailing(1)
+                self.assertEqual(scheduler._heap, [])
+
+        self.assertIn((mailing.next_send_at, mailing.pk), scheduler._heap)
+
+    @override_settings(MAILING_CLAIM_LIMIT=2)
+    def test_full_claim_batch_ticks_again_at_once(self):
+        for _ in range(3):
+            create_mailing(1)
+        claimed = []
+        scheduler = DispatchScheduler(tick=lambda: claimed.append(send_mailing(engine='sync')), max_sleep=0.1)
+
+        with mock.patch.object(scheduler_module, 'close_old_connections'):
+            for _ in range(2):
+                scheduler._load()
+                self.assertTrue(scheduler._wait())  # подошедшие рассылки остались — тик сразу
+                scheduler._run_tick()
+            scheduler._load()
+            self.assertFalse(scheduler._wait())
+
+        self.assertEqual(claimed, [2, 1])
+
+
+@override_settings(MAILING_HEARTBEAT_SECONDS=0.05, MAILING_SCHEDULER_MAX_SLEEP=1)
+class RunDispatcherTest(TransactionTestCase):
+    """
+    Проверяет остановку обработчика: освобождение захваченных рассылок, отметку обработчика
+    и остановку команды run_dispatcher по SIGTERM. Данные фиксируются в базе, потому что
+    планировщик и отметка работают в своих потоках.
+    """
+
+    def test_draining_releases_claimed_mailings(self):
+        mailing = create_mailing(2)
+        draining.set()
+        self.addCleanup(draining.clear)
+
+        self.assertEqual(send_mailing(engine='sync'), 1)
+
+        mailing.refresh_from_db()
+        self.assertEqual((mailing.leased_by, mailing.lease_until), ('', None))
+        self.assertEqual(mail.outbox, [])
+        self.assertTrue(get_due_mailings(timezone.now()).filter(pk=mailing.pk).exists())
+
+    def test_sigterm_drains_and_removes_heartbeat(self):
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            self.addCleanup(signal.signal, signum, signal.getsignal(signum))
+        self.addCleanup(draining.clear)
+        self.addCleanup(setattr, scheduler_module, '_scheduler', None)
+        heartbeats = []
+
+        def terminate():
+            # Дожидаемся обновления отметки и останавливаем обработчик, как это сделал бы systemd
+            try:
+                deadline = time.monotonic() + 5
+                while time.monotonic() < deadline and not heartbeats:
+                    heartbeat = DispatcherHeartbeat.objects.filter(worker_id=worker_id()).first()
+                    if heartbeat is not None and heartbeat.last_seen > heartbeat.started_at:
+                        heartbeats.append(heartbeat)
+                    time.sleep(0.05)
+            finally:
+                connection.close()
+                os.kill(os.getpid(), signal.SIGTERM)
+
+        threading.Timer(0.1, terminate).start()
+        call_command('run_dispatcher', engine='sync', stdout=io.StringIO())
+
+        self.assertEqual(len(heartbeats), 1)
+        self.assertTrue(draining.is_set())
+        self.assertFalse(scheduler_module._scheduler.is_alive())
+        self.assertFalse(DispatcherHeartbeat.objects.exists())
@@ -1,25 +1,37 @@
 from django.urls import path
-from .views import ClientListView, ClientCreateView, ClientUpdateView, ClientDeleteView, MessageListView, \
+from .views import ClientListView, ClientCreateView, ClientUpdateView, ClientDeleteView, ClientImportView, \
+    ClientImportStatusView, ClientSearchView, SegmentListView, SegmentCreateView, SegmentUpdateView, SegmentDeleteView, MessageListView, \
     MessageCreateView, MessageUpdateView, MessageDeleteView, MailingListView, MailingCreateView, MailingUpdateView, \
-    MailingDeleteView, AttemptListView, home
+    MailingDeleteView, AttemptListView, ClientExportView, MailingExportView, AttemptExportView, home, metrics
 from mailing.apps import MailingConfig
 
 app_name = MailingConfig.name
 
 urlpatterns = [
     path('', home, name='home'),
+    path('metrics', metrics, name='metrics'),
     path('clients/', ClientListView.as_view(), name='client-list'),
     path('clients/create/', ClientCreateView.as_view(), name='client-create'),
     path('clients/<int:pk>/update/', ClientUpdateView.as_view(), name='client-update'),
     path('clients/<int:pk>/delete/', ClientDeleteView.as_view(), name='client-delete'),
+    path('clients/search/', ClientSearchView.as_view(), name='client-search'),
+    path('clients/export/', ClientExportView.as_view(), name='client-export'),
+    path('clients/import/', ClientImportView.as_view(), name='client-import'),
+    path('clients/import/<str:import_id>/', ClientImportStatusView.as_view(), name='client-import-status'),
+    path('segments/', SegmentListView.as_view(), name='segment-list'),
+    path('segments/create/', SegmentCreateView.as_view(), name='segment-create'),
+    path('segments/<int:pk>/update/', SegmentUpdateView.as_view(), name='segment-update'),
+    path('segments/<int:pk>/delete/', SegmentDeleteView.as_view(), name='segment-delete'),
     path('message/', MessageListView.as_view(), name='message-list'),
     path('message/create/', MessageCreateView.as_view(), name='message-create'),
     path('message/<int:pk>/update/', MessageUpdateView.as_view(), name='message-update'),
     path('message/<int:pk>/delete/', MessageDeleteView.as_view(), name='message-delete'),
     path('mailings/', MailingListView.as_view(), name='mailing-list'),
+    path('mailings/export/', MailingExportView.as_view(), name='mailing-export'),
     path('mailings/create/', MailingCreateView.as_view(), name='mailing-create'),
     path('mailings/<int:pk>/update/', MailingUpdateView.as_view(), name='mailing-update'),
     path('mailings/<int:pk>/delete/', MailingDeleteView.as_view(), name='mailing-delete'),
     path('attempt/', AttemptListView.as_view(), name='attempt-list'),
+    path('attempt/export/', AttemptExportView.as_view(), name='attempt-export'),
 
 ]
@@ -1,13 +1,26 @@
+import csv
+import hmac
+import io
+import os
+import tempfile
 from datetime import timedelta
 
-from django.urls import reverse_lazy
-from django.views.generic import ListView, CreateView, UpdateView, DeleteView
+from django.conf import settings
+from django.db.models import ProtectedError, Q
+from django.http import Http404, HttpResponse, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.urls import reverse, reverse_lazy
+from django.views.generic import ListView, CreateView, UpdateView, DeleteView, FormView, TemplateView, View
 from django.contrib.auth.mixins import UserPassesTestMixin, LoginRequiredMixin
-from django.shortcuts import render, get_object_or_404
+from django.shortcuts import redirect, render, get_object_or_404
 
 from blog.models import Blog
-from .forms import MailingForm, ClientForm, MessageForm, MailingAttemptForm
-from .models import Client, Message, Mailing, MailingAttempt
+from .audience import distinct_emails_count, owner_clients_count
+from .forms import MailingForm, ClientForm, ClientImportForm, MessageForm, MailingAttemptForm, SegmentForm, client_label
+from .importer import get_import_progress, start_import
+from .metrics import DUE_MAILINGS, registry
+from .models import Client, Message, Mailing, MailingAttempt, Segment
+from .tasks import get_due_mailings
 
 
 def home(request):
@@ -19,7 +32,10 @@ def home(request):
     - mailings_count: Общее количество рассылок.
     - mailings_count_active: Количество активных рассылок (кроме остановленных).
     - clients_count: Количество уникальных клиентов.
+    - own_clients_count: Количество клиентов текущего пользователя.
     - articles: Случайные три блога.
+
+    Количество клиентов берётся из поддерживаемых счётчиков аудитории (см. audience) одним запросом по ключу.
     """
     mailings = Mailing.objects.all()
     blogs = Blog.objects.order_by("?")[:3]  # Получаем случайные блоги
@@ -27,13 +43,32 @@ def home(request):
     context = {
         "mailings_count": mailings.count(),
         "mailings_count_active": mailings.exclude(status=Mailing.CREATED).count(),
-        "clients_count": Client.objects.all().values("email").distinct().count(),
+        "clients_count": distinct_emails_count(),
+        "own_clients_count": owner_clients_count(request.user) if request.user.is_authenticated else None,
         "articles": blogs,  # Передаём блоги в контекст
     }
 
     return render(request, "base.html", context)
 
 
+def metrics(request):
+    """
+    Отдаёт метрики отправки рассылок и веб-приложения в текстовом формате Prometheus.
+
+    Доступ есть у сотрудников (is_staff) и у запросов с заголовком Authorization: Bearer <токен>,
+    если задан MAILING_METRICS_TOKEN. Без токена в настройках метрики видят только сотрудники.
+    Число подошедших рассылок считается при каждом запросе.
+    """
+    token = settings.MAILING_METRICS_TOKEN
+    authorized = bool(token) and hmac.compare_digest(
+        request.headers.get('Authorization', '').encode(), f'Bearer {token}'.encode(),
+    )
+    if not (authorized or request.user.is_staff):
+        return HttpResponseForbidden()
+    DUE_MAILINGS.set(get_due_mailings(timezone.now()).count())
+    return HttpResponse(registry.exposition(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 from django.contrib.auth.mixins import UserPassesTestMixin
 
 class CanViewAttemptsMixin(UserPassesTestMixin):
@@ -159,6 +194,15 @@ class ClientCreateView(CreateView):
     template_name = 'clients/client_form.html'
     success_url = reverse_lazy('mailing:client-list')
 
+    def get_form_kwargs(self):
+        """
+        Передаёт форме клиента с текущим пользователем-владельцем, чтобы форма проверила уникальность адреса.
+        """
+        kwargs = super().get_form_kwargs()
+        if self.request.user.is_authenticated:
+            kwargs['instance'] = Client(owner=self.request.user)
+        return kwargs
+
     def form_valid(self, form):
         """
         Устанавливает текущего пользователя владельцем клиента.
@@ -208,6 +252,158 @@ class ClientDeleteView(CanViewMailingsMixin, DeleteView):
         return Client.objects.filter(owner=self.request.user)
 
 
+class ClientImportView(LoginRequiredMixin, FormView):
+    """
+    Представление для загрузки клиентов из файла CSV или XLSX.
+
+    Файл копируется во временный файл по частям и импортируется в фоновом потоке
+    (см. importer.start_import), после чего открывается страница с ходом импорта.
+
+    Шаблон: clients/client_import.html
+    """
+    form_class = ClientImportForm
+    template_name = 'clients/client_import.html'
+
+    def form_valid(self, form):
+        upload = form.cleaned_data['file']
+        with tempfile.NamedTemporaryFile(suffix=os.path.splitext(upload.name)[1].lower(), delete=False) as file:
+            for chunk in upload.chunks():
+                file.write(chunk)
+        import_id = start_import(file.name, self.request.user)
+        return redirect(reverse('mailing:client-import-status', args=[import_id]))
+
+
+class ClientSearchView(LoginRequiredMixin, View):
+    """
+    Поиск клиентов текущего пользователя для выбора получателей рассылки (см. forms.ClientPickerWidget).
+
+    Параметры запроса: q — подстрока имени или email, after — id последнего клиента предыдущей страницы.
+    Возвращает JSON {"results": [{"id", "text"}], "next"}, где next — значение after для следующей
+    страницы или null. Страницы выбираются по id, а не смещением, поэтому дальние страницы не медленнее первой.
+    """
+
+    def get(self, request):
+        clients = Client.objects.filter(owner=request.user).only('id', 'email', 'full_name').order_by('pk')
+        query = request.GET.get('q', '').strip()
+        if query:
+            clients = clients.filter(Q(email__icontains=query) | Q(full_name__icontains=query))
+        after = request.GET.get('after', '')
+        if after.isdigit():
+            clients = clients.filter(pk__gt=after)
+        page_size = settings.MAILING_CLIENT_SEARCH_PAGE_SIZE
+        page = list(clients[:page_size + 1])
+        return JsonResponse({
+            'results': [{'id': client.pk, 'text': client_label(client)} for client in page[:page_size]],
+            'next': page[page_size - 1].pk if len(page) > page_size else None,
+        })
+
+
+class ClientImportStatusView(LoginRequiredMixin, TemplateView):
+    """
+    Представление для отображения хода импорта клиентов. Страница обновляется, пока импорт не завершится.
+
+    Шаблон: clients/client_import.html
+    """
+    template_name = 'clients/client_import.html'
+
+    def get_context_data(self, **kwargs):
+        """
+        Добавляет в контекст состояние импорта. Чужой или неизвестный импорт не показывается.
+        """
+        progress = get_import_progress(self.kwargs['import_id'])
+        if progress is None or progress['owner_id'] != self.request.user.pk:
+            raise Http404
+        return super().get_context_data(progress=progress, **kwargs)
+
+
+class SegmentListView(LoginRequiredMixin, ListView):
+    """
+    Представление для отображения списка сегментов клиентов.
+
+    Шаблон: segments/segment_list.html
+    """
+    model = Segment
+    template_name = "segments/segment_list.html"
+    context_object_name = "segments"
+
+    def get_queryset(self):
+        """
+        Суперпользователь видит все сегменты, обычные пользователи видят только свои.
+        """
+        if self.request.user.is_superuser:
+            return Segment.objects.all()
+        return Segment.objects.filter(owner=self.request.user)
+
+
+class SegmentCreateView(LoginRequiredMixin, CreateView):
+    """
+    Представление для создания нового сегмента.
+
+    Шаблон: segments/segment_form.html
+    """
+    model = Segment
+    form_class = SegmentForm
+    template_name = 'segments/segment_form.html'
+    success_url = reverse_lazy('mailing:segment-list')
+
+    def form_valid(self, form):
+        """
+        Устанавливает текущего пользователя владельцем сегмента.
+        """
+        segment = form.save(commit=False)
+        segment.owner = self.request.user
+        segment.save()
+        return super().form_valid(form)
+
+
+class SegmentUpdateView(LoginRequiredMixin, UpdateView):
+    """
+    Представление для обновления сегмента.
+
+    Шаблон: segments/segment_form.html
+    """
+    model = Segment
+    form_class = SegmentForm
+    template_name = 'segments/segment_form.html'
+    success_url = reverse_lazy('mailing:segment-list')
+
+    def get_queryset(self):
+        """
+        Суперпользователь может редактировать все сегменты, обычные пользователи — только свои.
+        """
+        if self.request.user.is_superuser:
+            return Segment.objects.all()
+        return Segment.objects.filter(owner=self.request.user)
+
+
+class SegmentDeleteView(LoginRequiredMixin, DeleteView):
+    """
+    Представление для удаления сегмента.
+
+    Шаблон: segments/segment_confirm_delete.html
+    """
+    model = Segment
+    template_name = 'segments/segment_confirm_delete.html'
+    success_url = reverse_lazy('mailing:segment-list')
+
+    def get_queryset(self):
+        """
+        Суперпользователь может удалять все сегменты, обычные пользователи — только свои.
+        """
+        if self.request.user.is_superuser:
+            return Segment.objects.all()
+        return Segment.objects.filter(owner=self.request.user)
+
+    def form_valid(self, form):
+        """
+        Не удаляет сегмент, на который направлены рассылки, и показывает их число.
+        """
+        try:
+            return super().form_valid(form)
+        except ProtectedError as error:
+            return self.render_to_response(self.get_context_data(protected=len(error.protected_objects)))
+
+
 class MessageListView(LoginRequiredMixin, ListView):
     """
     Представление для отображения списка сообщений.
@@ -307,7 +503,7 @@ class MailingListView(LoginRequiredMixin, ListView):
         return Mailing.objects.filter(owner=self.request.user)
 
 
-class MailingCreateView(CreateView):
+class MailingCreateView(LoginRequiredMixin, CreateView):
     """
     Представление для создания новой рассылки.
 
@@ -318,6 +514,14 @@ class MailingCreateView(CreateView):
     template_name = 'mailings/mailing_form.html'
     success_url = reverse_lazy('mailing:mailing-list')
 
+    def get_form_kwargs(self):
+        """
+        Передаёт форме текущего пользователя: выбрать можно только его клиентов и сегменты.
+        """
+        kwargs = super().get_form_kwargs()
+        kwargs['owner'] = self.request.user
+        return kwargs
+
     def form_valid(self, form):
         """
         Устанавливает текущего пользователя владельцем рассылки и сохраняет её.
@@ -340,6 +544,14 @@ class MailingUpdateView(IsOwnerOrModeratorMixin, UpdateView):
     template_name = 'mailings/mailing_form.html'
     success_url = reverse_lazy('mailing:mailing-list')
 
+    def get_form_kwargs(self):
+        """
+        Передаёт форме владельца рассылки: выбрать можно только его клиентов и сегменты.
+        """
+        kwargs = super().get_form_kwargs()
+        kwargs['owner'] = self.object.owner
+        return kwargs
+
     def get_form(self, form_class=None):
         form = super().get_form(form_class)
         if self.request.user.groups.filter(name='Moderator').exists():
@@ -350,6 +562,7 @@ class MailingUpdateView(IsOwnerOrModeratorMixin, UpdateView):
                 form.fields['end_datetime'].disabled = True
                 form.fields['periodicity'].disabled = True
                 form.fields['message'].disabled = True
+                form.fields['segment'].disabled = True
                 form.fields['clients'].disabled = True
             else:
                 # Если рассылка принадлежит модератору, разрешите редактирование всех полей
@@ -358,6 +571,7 @@ class MailingUpdateView(IsOwnerOrModeratorMixin, UpdateView):
                 form.fields['end_datetime'].disabled = False
                 form.fields['periodicity'].disabled = False
                 form.fields['message'].disabled = False
+                form.fields['segment'].disabled = False
                 form.fields['clients'].disabled = False
         return form
 
@@ -396,3 +610,106 @@ class AttemptListView(CanViewAttemptsMixin, ListView):
 
         # Возвращаем попытки рассылки, принадлежащие текущему пользователю
         return MailingAttempt.objects.filter(mailing__owner=self.request.user)
+
+
+# Символы, с которых Excel и другие табличные редакторы начинают формулу
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+def csv_cell(value):
+    """
+    Возвращает значение ячейки CSV. Строку, которую табличный редактор принял бы за формулу
+    (например, имя клиента из импортированного файла), предваряет апострофом.
+    """
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+class CsvExportMixin:
+    """
+    Миксин, отдающий queryset списка в виде CSV-файла.
+
+    Подмешивается к представлению списка, поэтому экспорт видит ровно те же строки и проверяет
+    те же права, что и сам список. Строки читаются курсором на стороне сервера
+    (values_list(...).iterator) порциями по MAILING_EXPORT_CHUNK_SIZE и сразу отправляются
+    клиентом, поэтому память не растёт с размером выгрузки. Ячейки, похожие на формулы,
+    экранируются (см. csv_cell).
+
+    Атрибуты:
+        export_fields: Пары (поле для values_list, заголовок столбца).
+        export_filename: Имя выгружаемого файла.
+    """
+    export_fields = ()
+    export_filename = 'export.csv'
+
+    def get(self, request, *args, **kwargs):
+        response = StreamingHttpResponse(self.stream_rows(), content_type='text/csv; charset=utf-8')
+        response['Content-Disposition'] = f'attachment; filename="{self.export_filename}"'
+        return response
+
+    def stream_rows(self):
+        """
+        Возвращает генератор частей CSV-файла: сначала заголовок, затем по части на порцию строк.
+        """
+        chunk_size = settings.MAILING_EXPORT_CHUNK_SIZE
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(header for _, header in self.export_fields)
+        # Заголовок отправляется до запроса к базе; BOM нужен, чтобы Excel открыл файл в UTF-8
+        yield '\ufeff' + buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        rows = (
+            self.get_queryset()
+            .order_by('pk')
+            .values_list(*(field for field, _ in self.export_fields))
+            .iterator(chunk_size=chunk_size)
+        )
+        for number, row in enumerate(rows, 1):
+            writer.writerow([csv_cell(value) for value in row])
+            if number % chunk_size == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+
+class ClientExportView(CsvExportMixin, ClientListView):
+    """
+    Представление для выгрузки клиентов в CSV.
+    """
+    export_fields = (
+        ('id', 'id'), ('email', 'email'), ('full_name', 'full_name'), ('comment', 'comment'), ('tag', 'tag'),
+    )
+    export_filename = 'clients.csv'
+
+
+class MailingExportView(CsvExportMixin, MailingListView):
+    """
+    Представление для выгрузки рассылок в CSV.
+    """
+    export_fields = (
+        ('id', 'id'),
+        ('message__subject', 'subject'),
+        ('start_datetime', 'start_datetime'),
+        ('end_datetime', 'end_datetime'),
+        ('periodicity', 'periodicity'),
+        ('status', 'status'),
+        ('owner__email', 'owner'),
+    )
+    export_filename = 'mailings.csv'
+
+
+class AttemptExportView(CsvExportMixin, AttemptListView):
+    """
+    Представление для выгрузки попыток рассылок в CSV.
+    """
+    export_fields = (
+        ('id', 'id'),
+        ('mailing_id', 'mailing_id'),
+        ('attempt_datetime', 'attempt_datetime'),
+        ('status', 'status'),
+        ('server_response', 'server_response'),
+    )
+    export_filename = 'attempts.csv'
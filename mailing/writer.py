@@ -0,0 +1,261 @@
+import time
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .breaker import CircuitOpenError
+from .dispatch import is_permanent, reply_code
+from .metrics import PHASE_SECONDS, RECIPIENTS
+from .models import Mailing, MailingAttempt, MailingDelivery
+
+# Значения метки status метрики mailing_recipients_total
+STATUS_LABELS = {
+    MailingDelivery.SENT: 'sent',
+    MailingDelivery.FAILED: 'failed',
+    MailingDelivery.REJECTED: 'rejected',
+    MailingDelivery.DEFERRED: 'deferred',
+}
+
+
+def delivery_status(error):
+    """
+    Возвращает статус журнала доставки для результата отправки письма.
+    """
+    if error is None:
+        return MailingDelivery.SENT
+    if isinstance(error, CircuitOpenError):
+        return MailingDelivery.DEFERRED
+    return MailingDelivery.REJECTED if is_permanent(error) else MailingDelivery.FAILED
+
+
+class TickWriter:
+    """
+    Буфер записей одного тика планировщика.
+
+    Перед отправкой begin фиксирует начало новых прогонов. Движки отправки передают
+    результаты порций в checkpoint, а итог рассылки — в record. Журнал доставки
+    записывается контрольными точками по checkpoint_size получателей, поэтому после сбоя
+    следующий тик продолжает рассылку с последней записанной точки. Попытки и изменения
+    рассылок накапливаются в памяти и записываются flush пакетными запросами.
+
+    Доставка выполняется как минимум один раз, а не ровно один: письма, отправленные после последней
+    контрольной точки, после сбоя уходят повторно. Такое письмо получает тот же Message-ID
+    (см. dispatch.message_id), но убирают ли его как дубликат, зависит от почтовой системы получателя.
+
+    Вместе с журналом доставки, но не реже чем через треть MAILING_LEASE_SECONDS, продлевается аренда
+    захваченных рассылок (см. renew_leases). Если аренду рассылки уже забрал другой обработчик,
+    checkpoint возвращает False, движок прекращает её отправку, а итог рассылки не записывается:
+    изменения в базе делаются только для рассылок, которые всё ещё арендует этот обработчик.
+
+    Атрибуты:
+    - current_datetime (datetime): Время начала тика.
+    - worker (str): Идентификатор обработчика, захватившего рассылки (см. tasks.worker_id).
+    - batch_size (int): Сколько строк записывается одним запросом.
+    - checkpoint_size (int): После скольких отправленных писем журнал доставки записывается в базу.
+    - lost (set): id рассылок, аренду которых забрал другой обработчик.
+    """
+
+    def __init__(self, current_datetime, worker, batch_size=None, checkpoint_size=None):
+        self.current_datetime = current_datetime
+        self.worker = worker
+        self.batch_size = batch_size or settings.MAILING_WRITE_BATCH_SIZE
+        self.checkpoint_size = checkpoint_size or settings.MAILING_CHECKPOINT_SIZE
+        self.attempts = []
+        self.deliveries = []
+        self.mailings = []
+        self.claimed = set()
+        self.lost = set()
+        self.renewed_at = time.monotonic()
+
+    def begin(self, mailings):
+        """
+        Начинает новый прогон для созданных рассылок и сохраняет это до начала отправки.
+
+        Если процесс упадёт во время отправки, рассылка останется в статусе STARTED
+        с тем же номером прогона, и следующий тик отправит письма только тем,
+        у кого нет успешной доставки в этом прогоне.
+        """
+        mailings = list(mailings)
+        self.claimed.update(mailing.pk for mailing in mailings)
+        created = [mailing for mailing in mailings if mailing.status == Mailing.CREATED]
+        if created:
+            Mailing.objects.filter(pk__in=[mailing.pk for mailing in created]).update(
+                run=F('run') + 1, status=Mailing.STARTED,
+            )
+            for mailing in created:
+                mailing.run += 1
+                mailing.status = Mailing.STARTED
+                mailing.delivered = []  # в новом прогоне доставок ещё нет
+        return mailings
+
+    def checkpoint(self, mailing, results):
+        """
+        Запоминает результаты отправки порции получателей и записывает журнал доставки,
+        как только накопится checkpoint_size записей или подойдёт время продлить аренду.
+
+        Возвращает False, если аренду рассылки забрал другой обработчик и её отправку нужно прекратить.
+        """
+        deliveries = [
+            MailingDelivery(
+                mailing=mailing,
+                client=client,
+                run=mailing.run,
+                status=delivery_status(error),
+                reply_code=reply_code(error),
+            )
+            for client, error in results
+        ]
+        for status, count in Counter(delivery.status for delivery in deliveries).items():
+            RECIPIENTS.inc(count, status=STATUS_LABELS[status])
+        self.deliveries.extend(deliveries)
+        if (len(self.deliveries) >= self.checkpoint_size
+                or time.monotonic() - self.renewed_at >= settings.MAILING_LEASE_SECONDS / 3):
+            self.flush_deliveries()
+        return mailing.pk not in self.lost
+
+    def flush_deliveries(self):
+        """
+        Записывает накопленный журнал доставки и продлевает аренду рассылок. Ключ (рассылка, прогон, клиент)
+        уникален, поэтому повторная отправка того же получателя обновляет его запись, а не дублирует её.
+        """
+        if self.deliveries:
+            with PHASE_SECONDS.time(phase='persist'), transaction.atomic():
+                MailingDelivery.objects.bulk_create(
+                    self.deliveries,
+                    batch_size=self.batch_size,
+                    update_conflicts=True,
+                    unique_fields=['mailing', 'run', 'client'],
+                    update_fields=['status', 'reply_code'],
+                )
+            self.deliveries = []
+        self.renew_leases()
+
+    def held(self, ids):
+        """
+        Блокирует и возвращает id рассылок из ids, которые всё ещё арендует этот обработчик.
+        Вызывается внутри транзакции.
+        """
+        return set(
+            Mailing.objects.select_for_update()
+            .filter(pk__in=ids, leased_by=self.worker)
+            .values_list('pk', flat=True)
+        )
+
+    def renew_leases(self):
+        """
+        Продлевает аренду захваченных рассылок на MAILING_LEASE_SECONDS от текущего момента.
+
+        Рассылки, которые за время отправки захватил другой обработчик (аренда истекла раньше,
+        чем её успели продлить), попадают в lost.
+        """
+        self.renewed_at = time.monotonic()
+        active = self.claimed - self.lost
+        if not active:
+            return
+        lease_until = timezone.now() + timedelta(seconds=settings.MAILING_LEASE_SECONDS)
+        with transaction.atomic():
+            held = self.held(active)
+            Mailing.objects.filter(pk__in=held).update(lease_until=lease_until)
+        self.lost |= active - held
+
+    def record(self, mailing, results):
+        """
+        Запоминает попытку рассылки по результатам отправки всех её получателей в этом тике.
+
+        Движки отправки вызывают этот метод из одного потока.
+
+        Если часть писем не ушла из-за временных ошибок, рассылка повторяется с экспоненциальной
+        задержкой (см. Mailing.get_retry_at). После MAILING_RETRY_MAX_ATTEMPTS повторов подряд
+        прогон прекращается и рассылка ждёт следующего периода. Окончательно отклонённые
+        сервером письма (коды 5xx) не повторяются. Письма, отложенные разомкнутым выключателем,
+        отправляются после его пробного замыкания и не считаются неудачным повтором.
+        """
+        if mailing.pk in self.lost:
+            return  # рассылкой теперь занимается другой обработчик
+        errors = [error for _, error in results if error is not None]
+        deferred = [error for error in errors if isinstance(error, CircuitOpenError)]
+        transient = [error for error in errors if not is_permanent(error)]
+        # Рассылка обработана, аренда освобождается
+        mailing.lease_until = None
+        mailing.leased_by = ''
+        # Следующая отправка — через период рассылки после этой попытки
+        mailing.next_send_at = mailing.get_next_send_at(self.current_datetime)
+
+        if not errors:
+            # Зарегистрируйте успешную попытку
+            attempt = MailingAttempt(mailing=mailing, status='success')
+            mailing.status = Mailing.COMPLETED
+            mailing.end_datetime = self.current_datetime
+            mailing.retry_count = 0
+        elif deferred:
+            # Релей недоступен: откладываем рассылку до пробного замыкания выключателя
+            attempt = MailingAttempt(
+                mailing=mailing,
+                status='failed',
+                server_response=f"Отложено {len(deferred)} из {len(results)}: {deferred[0]}",
+            )
+            mailing.status = Mailing.STARTED
+            mailing.next_send_at = self.current_datetime + timedelta(seconds=settings.MAILING_BREAKER_RESET_SECONDS)
+        elif not transient:
+            # Повторять нечего: все недоставленные письма отклонены сервером окончательно
+            attempt = MailingAttempt(
+                mailing=mailing,
+                status='failed',
+                server_response=f"Отклонено {len(errors)} из {len(results)}: {errors[0]}",
+            )
+            mailing.status = Mailing.COMPLETED
+            mailing.end_datetime = self.current_datetime
+            mailing.retry_count = 0
+        elif mailing.retry_count >= settings.MAILING_RETRY_MAX_ATTEMPTS:
+            # Повторы исчерпаны: следующий период начнёт новый прогон
+            attempt = MailingAttempt(
+                mailing=mailing,
+                status='failed',
+                server_response=f"Повторы исчерпаны, не доставлено {len(errors)} из {len(results)}: {transient[0]}",
+            )
+            mailing.status = Mailing.CREATED
+            mailing.retry_count = 0
+        else:
+            # Зарегистрируйте неудачную попытку с ответом или ошибкой сервера.
+            attempt = MailingAttempt(
+                mailing=mailing,
+                status='failed',
+                server_response=f"Не доставлено {len(errors)} из {len(results)}: {transient[0]}",
+            )
+            mailing.status = Mailing.STARTED  # Оставьте статус «НАЧАТО», чтобы повторить попытку позже.
+            mailing.retry_count += 1
+            mailing.next_send_at = mailing.get_retry_at(self.current_datetime)
+
+        self.attempts.append(attempt)
+        self.mailings.append(mailing)
+
+    def flush(self):
+        """
+        Записывает оставшийся журнал доставки, попытки и изменения рассылок.
+
+        Рассылки, которые движок не успел отправить до остановки обработчика, освобождаются,
+        чтобы их сразу подхватил другой обработчик. Записываются только рассылки, аренда которых
+        всё ещё принадлежит этому обработчику.
+        """
+        self.flush_deliveries()
+        unfinished = self.claimed.difference(mailing.pk for mailing in self.mailings)
+        if unfinished:
+            Mailing.objects.filter(pk__in=unfinished, leased_by=self.worker).update(lease_until=None, leased_by='')
+        self.claimed, self.lost = set(), set()
+        if not self.mailings:
+            return
+        with PHASE_SECONDS.time(phase='persist'), transaction.atomic():
+            held = self.held([mailing.pk for mailing in self.mailings])
+            MailingAttempt.objects.bulk_create(
+                [attempt for attempt in self.attempts if attempt.mailing_id in held], batch_size=self.batch_size,
+            )
+            Mailing.objects.bulk_update(
+                [mailing for mailing in self.mailings if mailing.pk in held],
+                fields=['status', 'end_datetime', 'next_send_at', 'lease_until', 'leased_by', 'retry_count'],
+                batch_size=self.batch_size,
+            )
+        self.attempts, self.mailings = [], []
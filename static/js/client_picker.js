@@ -0,0 +1,109 @@
+// Выбор клиентов рассылки с поиском (см. ClientPickerWidget в mailing/forms.py).
+// Варианты подгружаются страницами из поиска клиентов по мере ввода запроса,
+// а в форме остаются только выбранные клиенты.
+document.addEventListener('DOMContentLoaded', function () {
+    document.querySelectorAll('select.client-picker').forEach(initClientPicker);
+});
+
+function initClientPicker(select) {
+    if (select.disabled) {
+        return;  // поле только для просмотра: выбранные клиенты уже выведены
+    }
+    var url = select.dataset.searchUrl;
+    var chosen = document.createElement('ul');
+    var search = document.createElement('input');
+    var results = document.createElement('ul');
+    var more = document.createElement('button');
+    var query = '';
+    var next = null;
+    var timer = null;
+    var request = 0;
+
+    select.style.display = 'none';
+    search.type = 'search';
+    search.placeholder = 'Поиск по имени или email';
+    more.type = 'button';
+    more.textContent = 'Показать ещё';
+    more.hidden = true;
+    select.after(chosen, search, results, more);
+
+    function addChosen(option) {
+        var item = document.createElement('li');
+        var remove = document.createElement('button');
+        item.textContent = option.textContent + ' ';
+        remove.type = 'button';
+        remove.textContent = '×';
+        remove.addEventListener('click', function () {
+            option.remove();
+            item.remove();
+        });
+        item.appendChild(remove);
+        chosen.appendChild(item);
+    }
+
+    function choose(client) {
+        var exists = Array.from(select.options).some(function (option) {
+            return option.value === String(client.id);
+        });
+        if (!exists) {
+            var option = new Option(client.text, client.id, true, true);
+            select.appendChild(option);
+            addChosen(option);
+        }
+    }
+
+    function load(reset) {
+        var params = new URLSearchParams({q: query});
+        if (!reset && next !== null) {
+            params.set('after', next);
+        }
+        var current = ++request;
+        fetch(url + '?' + params, {credentials: 'same-origin'})
+            .then(function (response) {
+                return response.json();
+            })
+            .then(function (data) {
+                if (current !== request) {
+                    return;  // пока ждали ответ, запрос изменился
+                }
+                if (reset) {
+                    results.replaceChildren();
+                }
+                data.results.forEach(function (client) {
+                    var item = document.createElement('li');
+                    var link = document.createElement('a');
+                    link.href = '#';
+                    link.textContent = client.text;
+                    link.addEventListener('click', function (event) {
+                        event.preventDefault();
+                        choose(client);
+                    });
+                    item.appendChild(link);
+                    results.appendChild(item);
+                });
+                next = data.next;
+                more.hidden = next === null;
+            });
+    }
+
+    Array.from(select.options).forEach(function (option) {
+        option.selected = true;
+        addChosen(option);
+    });
+    search.addEventListener('keydown', function (event) {
+        if (event.key === 'Enter') {
+            event.preventDefault();  // Enter в поиске не отправляет форму
+        }
+    });
+    search.addEventListener('input', function () {
+        clearTimeout(timer);
+        timer = setTimeout(function () {
+            query = search.value.trim();
+            load(true);
+        }, 300);
+    });
+    more.addEventListener('click', function () {
+        load(false);
+    });
+    load(true);
+}